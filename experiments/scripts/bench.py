@@ -3,11 +3,12 @@ import os
 import helpers
 
 import s3fs
-from prefetch.core import S3PrefetchFileSystem
+import fsspec
+from prefetch.core import S3PrefetchFileSystem, PrefetchFileSystem
 
 import random
 import subprocess as sp
-from time import perf_counter
+from time import perf_counter, sleep
 
 s3_path = "vhs-bucket/rand"
 
@@ -28,25 +29,63 @@ def gen_random(start, end):
             f.write(data)
 
 
-def write_benchmark(output, fs, rep, action, size, time, blocksize=-1, read_size=-1, read_len=None):
+def write_benchmark(output, fs, rep, action, size, time, blocksize=-1, read_size=-1, read_len=None, compute=0, model="none"):
 
     with open(output, "a+") as f:
-        f.write(f"{fs},{rep},{action},{size},{time},{blocksize},{read_size},{read_len}\n")
+        f.write(f"{fs},{rep},{action},{size},{time},{blocksize},{read_size},{read_len},{compute},{model}\n")
 
 
-def read_chunks(f, chunk_size, file_size, fs, rep, size, bs, output):
+def simulate_compute(data, compute, model="sleep"):
+    """Simulate a consumer processing `data` for `compute` seconds per byte
+
+    model is one of "none", "sleep" (releases the GIL, like I/O-bound or
+    native compute), "spin" (busy loop holding the GIL, like pure Python
+    compute) or "numpy" (repeated histograms over the data until the
+    compute budget is spent, at least one pass).
+    """
+    duration = compute * len(data)
+
+    if model == "none" or duration <= 0:
+        return
+    elif model == "sleep":
+        sleep(duration)
+    elif model == "spin":
+        deadline = perf_counter() + duration
+        while perf_counter() < deadline:
+            pass
+    elif model == "numpy":
+        import numpy as np
+
+        arr = np.frombuffer(data, dtype=np.uint8)
+        deadline = perf_counter() + duration
+        while True:
+            np.histogram(arr, bins=256, range=(0, 256))
+            if perf_counter() >= deadline:
+                break
+    else:
+        raise ValueError(f"Unknown compute model {model}")
+
+
+def read_chunks(f, chunk_size, file_size, fs, rep, size, bs, output, compute=0, model="none"):
+
+    end = perf_counter()
 
     for i in range(int(file_size // chunk_size)):
         start = perf_counter()
         data = f.read(chunk_size)
         end = perf_counter()
 
-        write_benchmark(output, fs, rep, f"read_{i}", size, end-start, bs, chunk_size, file_size)
+        write_benchmark(output, fs, rep, f"read_{i}", size, end-start, bs, chunk_size, file_size, compute, model)
+
+        if model != "none":
+            simulate_compute(data, compute, model)
+            start, end = end, perf_counter()
+            write_benchmark(output, fs, rep, f"compute_{i}", size, end-start, bs, chunk_size, file_size, compute, model)
 
     return end
 
 
-def bench_aws(size, rep, output, block_size=None, read_size=-1,read_len=None):
+def bench_aws(size, rep, output, block_size=None, read_size=-1, read_len=None, compute=0, model="none"):
     fs = "aws"
 
     if read_len is None:
@@ -68,13 +107,13 @@ def bench_aws(size, rep, output, block_size=None, read_size=-1,read_len=None):
 
     with s3.open(f"{s3_path}{size}.out", "rb", block_size=block_size) as f:
         end_open = perf_counter()
-        end = read_chunks(f, read_size, read_len, fs, rep, size, block_size, output)
+        end = read_chunks(f, read_size, read_len, fs, rep, size, block_size, output, compute, model)
 
-    write_benchmark(output, fs, rep, "total", size, end - start_open, block_size, read_size, read_len)
-    write_benchmark(output, fs, rep, "open", size, end_open - start_open, block_size, read_size, read_len)
+    write_benchmark(output, fs, rep, "total", size, end - start_open, block_size, read_size, read_len, compute, model)
+    write_benchmark(output, fs, rep, "open", size, end_open - start_open, block_size, read_size, read_len, compute, model)
 
 
-def bench_prefetch(size, rep, output, block_size=None, prefetch_storage=[("/dev/shm", 5*1024**2)], read_size=-1, read_len=None):
+def bench_prefetch(size, rep, output, block_size=None, prefetch_storage=[("/dev/shm", 5*1024**2)], read_size=-1, read_len=None, compute=0, model="none"):
     fs = "pf"
 
     if read_len is None:
@@ -94,13 +133,45 @@ def bench_prefetch(size, rep, output, block_size=None, prefetch_storage=[("/dev/
     start_open = perf_counter()
     with s3.open(f"{s3_path}{size}.out", "rb", block_size=block_size, prefetch_storage=prefetch_storage) as f:
         end_open = perf_counter()
-        end = read_chunks(f, read_size, read_len, fs, rep, size, block_size, output)
+        end = read_chunks(f, read_size, read_len, fs, rep, size, block_size, output, compute, model)
+
+    write_benchmark(output, fs, rep, "total", size, end - start_open, block_size, read_size, read_len, compute, model)
+    write_benchmark(output, fs, rep, "open", size, end_open - start_open, block_size, read_size, read_len, compute, model)
+
+
+def bench_engine(url, size, rep, output, block_size=None, prefetch_storage=[("/dev/shm", 5*1024**2)], read_size=-1, read_len=None, compute=0, model="none"):
+    """Benchmark the prefetch engine against any fsspec URL
+
+    e.g. a local file or a local HTTP server, to measure the engine itself
+    without S3 in the way.
+    """
+    target, path = fsspec.core.url_to_fs(url)
+    fs = f"pf_{target.protocol if isinstance(target.protocol, str) else target.protocol[0]}"
+
+    if read_len is None:
+        read_len = size
+
+    if read_size == -1:
+        read_size = size
+
+    if block_size is None:
+        block_size = size
+
+    # clear caches
+    helpers.drop_caches()
+
+    pfs = PrefetchFileSystem(fs=target)
+
+    start_open = perf_counter()
+    with pfs.open(path, "rb", block_size=block_size, prefetch_storage=prefetch_storage) as f:
+        end_open = perf_counter()
+        end = read_chunks(f, read_size, read_len, fs, rep, size, block_size, output, compute, model)
 
-    write_benchmark(output, fs, rep, "total", size, end - start_open, block_size, read_size, read_len)
-    write_benchmark(output, fs, rep, "open", size, end_open - start_open, block_size, read_size, read_len)
+    write_benchmark(output, fs, rep, "total", size, end - start_open, block_size, read_size, read_len, compute, model)
+    write_benchmark(output, fs, rep, "open", size, end_open - start_open, block_size, read_size, read_len, compute, model)
 
 
-def bench_local(size, rep, fs, output, read_size=-1, read_len=None):
+def bench_local(size, rep, fs, output, read_size=-1, read_len=None, compute=0, model="none"):
 
     block_size = -1
     path = f"/dev/shm/rand{size}.out"
@@ -125,10 +196,10 @@ def bench_local(size, rep, fs, output, read_size=-1, read_len=None):
     with open(path, "rb") as f:
         end_open = perf_counter()
 
-        end = read_chunks(f, read_size, read_len, fs, rep, size, block_size, output)
+        end = read_chunks(f, read_size, read_len, fs, rep, size, block_size, output, compute, model)
 
-    write_benchmark(output, fs, rep, "total", size, end - start_open, block_size, read_size, read_len)
-    write_benchmark(output, fs, rep, "open", size, end_open - start_open, block_size, read_size, read_len)
+    write_benchmark(output, fs, rep, "total", size, end - start_open, block_size, read_size, read_len, compute, model)
+    write_benchmark(output, fs, rep, "open", size, end_open - start_open, block_size, read_size, read_len, compute, model)
 
     # cleanup
     os.unlink(path)
@@ -137,7 +208,7 @@ def bench_local(size, rep, fs, output, read_size=-1, read_len=None):
 def create_header(output):
 
     with open(output, "w+") as f:
-        f.write("fs,repetition,action,size,time,blocksize,readsize,readlen\n")
+        f.write("fs,repetition,action,size,time,blocksize,readsize,readlen,compute,model\n")
 
 
 def bench_storage():
@@ -194,5 +265,41 @@ def bench_blocksize():
                     print("executing prefetch", r, size, b)
                     bench_prefetch(size, r, output, block_size=b, read_size=b // 4)
 
+
+def bench_overlap(model="sleep"):
+    """Measure how much I/O is hidden behind a consumer's compute
+
+    Sweeps the compute time per byte for s3fs and prefetch. Overlap
+    efficiency for a run is sum(compute_*) / total, and prefetching stops
+    helping once s3fs reaches the same total, i.e. when compute dominates.
+    """
+    reps = 5
+    size = 2048*1024**2
+    bsizes = [2**i for i in range(24, 29)]
+    # seconds per byte, from pure I/O to ~8 s of compute per GiB
+    computes = [0] + [2**-i for i in range(27, 32)]
+    output = f"../results/us-west-2-xlarge/overlap_{model}.bench"
+
+    create_header(output)
+
+    fs = ["s3fs", "prefetch"]
+
+    for r in range(reps):
+        random.shuffle(bsizes)
+        random.shuffle(computes)
+
+        for b in bsizes:
+            for c in computes:
+                random.shuffle(fs)
+                m = model if c > 0 else "none"
+
+                for f in fs:
+                    print("executing", f, r, size, b, c, m)
+                    if "s3fs" in f:
+                        bench_aws(size, r, output, block_size=b, read_size=b // 4, compute=c, model=m)
+                    else:
+                        bench_prefetch(size, r, output, block_size=b, read_size=b // 4, compute=c, model=m)
+
 #bench_blocksize()
+#bench_overlap()
 bench_storage()
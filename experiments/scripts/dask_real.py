@@ -6,6 +6,7 @@ from time import perf_counter_ns
 from os import path as op, system
 from s3fs import S3FileSystem
 from prefetch.core import S3PrefetchFileSystem
+from prefetch.dask import map_partitions
 from dask.distributed import Client, LocalCluster
 
 from AFQ import api
@@ -212,7 +213,13 @@ def segmentation_s3fs(
 @click.option("--reps", type=int, default=5)
 @click.option("--types", type=click.Choice(["prefetch", "s3fs"]), multiple=True)
 @click.option("--nworkers", type=int, default=3)
-def main(prefetch_storage, block_size, n_files, reps, types, nworkers):
+@click.option(
+    "--files_per_task",
+    type=int,
+    default=None,
+    help="Files segmented per prefetch task (default: n_files // nworkers)",
+)
+def main(prefetch_storage, block_size, n_files, reps, types, nworkers, files_per_task):
 
     types = list(types)
     header = ["vhs-bucket/hydi-header.trk"]
@@ -263,19 +270,27 @@ def main(prefetch_storage, block_size, n_files, reps, types, nworkers):
             else:
                 print(t)
 
-                for i in range(nworkers):
-                    f_per_w = n_files // nworkers
-                    print(files[i * f_per_w : (i + 1) * f_per_w])
-                    seg = client.submit(
-                        segmentation_prefetch,
-                        header + files[i * f_per_w : (i + 1) * f_per_w],
-                        False,
-                        block_size,
-                        prefetch_storage,
-                        **data,
-                        bfile=bfile,
-                    )
-                    results.append(seg)
+                # tasks are placed according to what each worker has cached
+                # and the next task of each worker is prefetched ahead
+                f_per_t = files_per_task or n_files // nworkers
+                partitions = [
+                    header + files[i : i + f_per_t]
+                    for i in range(0, f_per_t * (n_files // f_per_t), f_per_t)
+                ]
+                print(partitions)
+                results = map_partitions(
+                    client,
+                    segmentation_prefetch,
+                    partitions,
+                    False,
+                    block_size,
+                    prefetch_storage,
+                    block_size=block_size,
+                    prefetch_storage=prefetch_storage,
+                    header_bytes=1000,
+                    **data,
+                    bfile=bfile,
+                )
 
             print(client.gather(results))
             system("pkill -f joblib")
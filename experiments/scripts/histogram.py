@@ -9,6 +9,7 @@ from time import perf_counter_ns
 from os import path as op, system, makedirs
 from s3fs import S3FileSystem
 from prefetch.core import S3PrefetchFileSystem
+from prefetch.formats import trk
 from dask.distributed import Client, LocalCluster
 from matplotlib import pyplot as plt
 
@@ -58,6 +59,34 @@ def histogram_prefetch(
     create_fig(output_file, nnodes, nbins)
 
 
+@helpers.benchmark
+def histogram_prefetch_trk(
+    path,
+    lazy,
+    block_size,
+    prefetch_storage,
+    nbins=20,
+    output_dir="../outputs",
+    bfile="real.out",
+):
+    print("In prefetch_trk", path)
+
+    fs = S3PrefetchFileSystem()
+    fs.invalidate_cache()
+
+    # node counts come straight from the record headers, no streamline is built
+    with fs.open(
+        path,
+        block_size=block_size,
+        prefetch_storage=prefetch_storage,
+        header_bytes=1000,
+    ) as f:
+        nnodes = trk.count_nodes(f)
+
+    output_file = op.join(output_dir, f"histogram_prefetch_trk_{len(path)}.pdf")
+    create_fig(output_file, nnodes, nbins)
+
+
 @helpers.benchmark
 def histogram_s3fs(
     path,
@@ -97,7 +126,9 @@ def histogram_s3fs(
 @click.option("--block_size", type=int, default=64 * 2 ** 20)
 @click.option("--n_files", type=int, default=5)
 @click.option("--reps", type=int, default=5)
-@click.option("--types", type=click.Choice(["prefetch", "s3fs"]), multiple=True)
+@click.option(
+    "--types", type=click.Choice(["prefetch", "prefetch_trk", "s3fs"]), multiple=True
+)
 @click.option("--output_dir", type=str, default="../outputs")
 @click.option("--nbins", type=int, default=20)
 @click.option("--dask", type=bool, default=False)
@@ -177,7 +208,9 @@ def main(
                         f_per_w = n_files // nworkers
                         print(files[i * f_per_w : (i + 1) * f_per_w])
                         seg = client.submit(
-                            histogram_prefetch,
+                            histogram_prefetch_trk
+                            if t == "prefetch_trk"
+                            else histogram_prefetch,
                             header + files[i * f_per_w : (i + 1) * f_per_w],
                             lazy,
                             block_size,
@@ -200,7 +233,11 @@ def main(
                         bfile=bfile,
                     )
                 else:
-                    histogram_prefetch(
+                    (
+                        histogram_prefetch_trk
+                        if t == "prefetch_trk"
+                        else histogram_prefetch
+                    )(
                         header + files,
                         lazy,
                         block_size,
@@ -4,7 +4,9 @@ import click
 import helpers
 import random
 from time import perf_counter_ns
-from os import path as op, system, makedirs
+from os import path as op, system, makedirs, unlink
+from shutil import copyfileobj
+from tempfile import gettempdir
 from s3fs import S3FileSystem
 from prefetch.core import S3PrefetchFileSystem
 from dask.distributed import Client, LocalCluster
@@ -103,9 +105,21 @@ def save_fg(fiber_groups, img, output_dir, bname):
     for kk in fiber_groups:
         print(kk, len(fiber_groups[kk]["sl"].streamlines))
         sft = StatefulTractogram(fiber_groups[kk]["sl"].streamlines, img, Space.RASMM)
-        save_tractogram(
-            sft, op.join(output_dir, f"{bname}_{kk}_reco.trk"), bbox_valid_check=False
-        )
+        fname = f"{bname}_{kk}_reco.trk"
+
+        if not output_dir.startswith("s3://"):
+            save_tractogram(sft, op.join(output_dir, fname), bbox_valid_check=False)
+            continue
+
+        # trk headers are rewritten once all streamlines are written, so the
+        # file is saved locally first then uploaded in parallel parts
+        local = op.join(gettempdir(), fname)
+        save_tractogram(sft, local, bbox_valid_check=False)
+
+        fs = S3PrefetchFileSystem()
+        with open(local, "rb") as fi, fs.open(f"{output_dir}/{fname}", "wb") as fo:
+            copyfileobj(fi, fo, 2 ** 20)
+        unlink(local)
 
 
 @helpers.benchmark
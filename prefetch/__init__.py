@@ -1 +1,15 @@
-from .core import S3PrefetchFileSystem, S3PrefetchFile
+from fsspec import register_implementation
+
+from .core import (
+    S3PrefetchFileSystem,
+    S3PrefetchFile,
+    PrefetchFileSystem,
+    PrefetchFile,
+)
+from .asyn import AsyncPrefetchFile
+from .eviction import EvictionPolicy, KeepLastBlocks, LRUEviction, PinnedRanges
+
+# s3prefetch:// URLs open files through rolling prefetch
+register_implementation("s3prefetch", S3PrefetchFileSystem, clobber=True)
+# prefetch:: chained URLs prefetch from any other filesystem
+register_implementation("prefetch", PrefetchFileSystem, clobber=True)
@@ -0,0 +1,165 @@
+import asyncio
+from functools import partial
+
+
+class AsyncPrefetchFile:
+    """Prefetched file read from an event loop
+
+    Wraps the PrefetchFile of fs.open, such that reads await the prefetched
+    blocks instead of blocking a thread. Data already prefetched is read from
+    the storage tiers directly, while the rest (e.g. blocks that were evicted
+    or not prefetched) is read, and checkpoints are saved, in the loop's
+    default executor. The file is opened on first await, e.g.
+
+    >>> async with fs.open_async(paths) as f:
+    ...     data = await f.read(n)
+
+    or
+
+    >>> f = await fs.open_async(paths)
+
+    Parameters
+    ----------
+    fs : S3PrefetchFileSystem or PrefetchFileSystem
+        Filesystem opening the file
+    path : str or list of str
+        Path of the file, or of the files read as a single stream
+    mode : str
+        Only "rb" is supported
+    kwargs : dict
+        Arguments of fs.open
+    """
+
+    def __init__(self, fs, path, mode="rb", **kwargs):
+        if "r" not in mode:
+            raise NotImplementedError(f"Async files can't be opened in mode {mode}")
+
+        self.fs = fs
+        self.path = path
+        self.mode = mode
+        self.kwargs = kwargs
+        self.f = None
+
+    async def open(self):
+        """Open the file, without blocking the event loop"""
+        if self.f is None:
+            # fetching the size of the files is blocking
+            self.f = await self._run(
+                partial(self.fs.open, self.path, self.mode, **self.kwargs)
+            )
+        return self
+
+    def __await__(self):
+        return self.open().__await__()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    @property
+    def closed(self):
+        return self.f is None or self.f.closed
+
+    @property
+    def size(self):
+        return self.f.size
+
+    def seek(self, loc, whence=0):
+        """Set the position in the logical (concatenated) stream"""
+        return self.f.seek(loc, whence)
+
+    def tell(self):
+        """Current position in the logical (concatenated) stream"""
+        return self.f.tell()
+
+    async def read(self, length=-1):
+        """Read length bytes (if <0, all remaining bytes), see PrefetchFile.read
+
+        Returns the data once the prefetched blocks holding it are written,
+        awaiting them rather than blocking the event loop.
+        """
+        f = self.f
+        length = -1 if length is None else int(length)
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+
+        remaining = f.size - f.tell()
+        if length < 0 or length > remaining:
+            length = remaining
+
+        out = []
+        while length > 0:
+            data = await self._read_piece(length)
+            if not data:
+                break
+            out.append(data)
+            length -= len(data)
+
+        return b"".join(out)
+
+    async def _read_piece(self, length):
+        """Read up to length bytes, up to the end of the current block"""
+        f = self.f
+        if f._engine is not None:
+            # the prefetch stream is started on first read
+            await self._run(lambda: f.stream)
+        stream = f.stream
+        cache = f.cache
+
+        header = f.file_idx == 0 and f.loc < stream.pinned
+        if header:
+            bid, end = None, stream.pinned
+        else:
+            bid, (_, end) = f._get_block(wait=False)
+
+        if end <= f.loc:
+            # e.g. a file holding only its header, read moves to the next file
+            return await self._run(partial(f.read, length))
+        length = min(length, end - f.loc)
+
+        if header:
+            ready = stream.header_ready.is_set()
+        elif bid is not None:
+            nbytes = f.loc + length - cache.blocks[bid][1]
+            ready = await cache.wait_async(bid, nbytes) and cache.available(bid, nbytes)
+        else:
+            ready = False
+
+        data = None
+        if ready and header:
+            data = stream.read_header(f.loc, f.loc + length)
+        elif ready:
+            # read from the storage tiers, without waiting
+            data = cache.read(bid, f.loc, length)
+            if data is not None:
+                f.eviction.accessed(bid)
+
+        if data is None:
+            # the header is not fetched yet, or the range was evicted or isn't
+            # prefetched, it is fetched from the source
+            return await self._run(partial(f.read, length))
+
+        if f.trace is not None:
+            f.trace.record(f.file_idx, f.loc, length)
+        f.loc += length
+
+        if bid is not None and f.loc >= end:
+            if f.resume is not None:
+                # saving the checkpoint syncs it to disk
+                await self._run(partial(f._finish_block, bid))
+            else:
+                f._finish_block(bid)
+        return data
+
+    async def close(self):
+        """Close the file, which may wait for the prefetch stream to stop"""
+        if self.f is not None and not self.f.closed:
+            await self._run(self.f.close)
+
+    async def _run(self, fn):
+        return await asyncio.get_running_loop().run_in_executor(None, fn)
+
+    def __repr__(self):
+        return f"<AsyncPrefetchFile {self.path}>"
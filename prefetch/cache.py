@@ -0,0 +1,898 @@
+import os
+import mmap
+import errno
+import asyncio
+import ctypes
+import ctypes.util
+import threading
+import weakref
+from bisect import bisect_left, bisect_right
+from shutil import disk_usage
+from contextlib import contextmanager
+
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _fallocate = _libc.fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    _fallocate.restype = ctypes.c_int
+except (OSError, AttributeError, TypeError):
+    # not Linux, hole punching is unavailable
+    _fallocate = None
+
+# errors of sendfile for file descriptors it doesn't support
+_SENDFILE_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+
+# open block caches of the process, the caches using the same directory share
+# the space budget of its tier
+_caches = weakref.WeakSet()
+_caches_lock = threading.Lock()
+
+
+def tier_usage(path):
+    """Bytes held in directory path by the open block caches of the process"""
+    path = os.path.abspath(path)
+    with _caches_lock:
+        caches = list(_caches)
+
+    return sum(
+        cache.used[i]
+        for cache in caches
+        for i, tier in enumerate(cache.dirs)
+        if tier == path
+    )
+
+
+def _allocate(fd, offset, length):
+    """Reserve disk space for a region of fd so writes to it cannot fail midway"""
+    try:
+        os.posix_fallocate(fd, offset, length)
+    except AttributeError:
+        pass
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+
+
+def _punch_hole(fd, offset, length):
+    """Deallocate a region of fd, returns False if the filesystem can't"""
+    if _fallocate is None:
+        return False
+    return (
+        _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length)
+        == 0
+    )
+
+
+def _holds_data(fd, offset, length):
+    """Whether a region of fd holds data, i.e. has no hole punched in it"""
+    try:
+        return os.lseek(fd, offset, os.SEEK_HOLE) >= offset + length
+    except AttributeError:
+        # holes can't be detected, nor punched
+        return True
+    except OSError as e:
+        # past the end of the file
+        if e.errno == errno.ENXIO:
+            return False
+        return True
+
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+# cgroup v1 reports no limit as a page-aligned maximum value
+UNLIMITED = 2 ** 60
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _Condition(threading.Condition):
+    """Condition also waking up the coroutines waiting on it, see wait_async"""
+
+    def __init__(self):
+        super().__init__()
+        self._futures = []
+
+    def add_future(self, loop, future):
+        """Set the result of future, in loop, on the next notify_all"""
+        self._futures.append((loop, future))
+
+    def notify_all(self):
+        super().notify_all()
+
+        futures, self._futures = self._futures, []
+        for loop, future in futures:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                # the event loop was closed
+                pass
+
+
+def _copy_fd(in_fd, out_fd, offset, length):
+    """Copy length bytes at offset of in_fd to out_fd, with sendfile if supported"""
+    end = offset + length
+    try:
+        while offset < end:
+            sent = os.sendfile(out_fd, in_fd, offset, end - offset)
+            if sent == 0:
+                raise EOFError(f"Unexpected end of file at {offset}")
+            offset += sent
+    except (AttributeError, OSError) as e:
+        # e.g. no sendfile on the platform or out_fd opened with O_APPEND
+        if isinstance(e, OSError) and e.errno not in _SENDFILE_UNSUPPORTED:
+            raise
+
+    while offset < end:
+        data = os.pread(in_fd, min(end - offset, 2 ** 22), offset)
+        if not data:
+            raise EOFError(f"Unexpected end of file at {offset}")
+        write_all(out_fd, data)
+        offset += len(data)
+
+
+def write_all(fd, data):
+    """Write all of data to file descriptor fd"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def _read_int(path):
+    try:
+        with open(path, "r") as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    return None if value == "max" else int(value)
+
+
+def _cgroup_memory():
+    """(limit, usage) in bytes of the memory cgroups of this process
+
+    The cgroup of the process and its ancestors are all checked, returns the
+    one closest to its limit, or None if none is limited.
+    """
+    try:
+        with open("/proc/self/cgroup", "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+
+    candidates = []
+    for line in lines:
+        _, controllers, path = line.split(":", 2)
+
+        if controllers == "":
+            # cgroup v2
+            base, limit, usage = CGROUP_ROOT, "memory.max", "memory.current"
+        elif "memory" in controllers.split(","):
+            base = os.path.join(CGROUP_ROOT, "memory")
+            limit, usage = "memory.limit_in_bytes", "memory.usage_in_bytes"
+        else:
+            continue
+
+        parts = [p for p in path.split("/") if p]
+        for i in range(len(parts), -1, -1):
+            d = os.path.join(base, *parts[:i])
+            mem_limit = _read_int(os.path.join(d, limit))
+            mem_usage = _read_int(os.path.join(d, usage))
+
+            if mem_limit is not None and mem_usage is not None and mem_limit < UNLIMITED:
+                candidates.append((mem_limit, mem_usage))
+
+    return min(candidates, key=lambda c: c[0] - c[1], default=None)
+
+
+def memory_available():
+    """(available, total) memory in bytes, considering the cgroup limits
+
+    Returns None if it can't be measured.
+    """
+    memory = None
+    try:
+        with open("/proc/meminfo", "r") as f:
+            info = dict(line.split(":", 1) for line in f)
+        memory = (
+            int(info["MemAvailable"].split()[0]) * 1024,
+            int(info["MemTotal"].split()[0]) * 1024,
+        )
+    except (OSError, KeyError, ValueError):
+        pass
+
+    cgroup = _cgroup_memory()
+    if cgroup is not None:
+        limit, usage = cgroup
+        if memory is None or limit - usage < memory[0]:
+            memory = (max(limit - usage, 0), limit)
+
+    return memory
+
+
+def _memory_backed(path):
+    """Whether path is on a filesystem stored in memory, e.g. /dev/shm"""
+    path = os.path.realpath(path)
+    fstype = None
+    longest = -1
+
+    try:
+        with open("/proc/mounts", "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1]
+                if (
+                    path == mount or path.startswith(mount.rstrip("/") + "/")
+                ) and len(mount) > longest:
+                    fstype = fields[2]
+                    longest = len(mount)
+    except OSError:
+        return False
+
+    return fstype in ("tmpfs", "ramfs")
+
+
+def _cover(spans, start, end):
+    """Add range [start, end) to spans, returns the parts it didn't cover yet
+
+    spans is a sorted list of disjoint (start, end) ranges, updated in place
+    """
+    first = bisect_left(spans, (start,))
+    if first > 0 and spans[first - 1][1] > start:
+        first -= 1
+
+    pieces = []
+    pos = start
+    last = first
+    while last < len(spans) and spans[last][0] < end:
+        if spans[last][0] > pos:
+            pieces.append((pos, spans[last][0]))
+        pos = max(pos, spans[last][1])
+        last += 1
+    if pos < end:
+        pieces.append((pos, end))
+
+    if last > first:
+        start = min(start, spans[first][0])
+        end = max(end, spans[last - 1][1])
+    spans[first:last] = [(start, end)]
+    return pieces
+
+
+def block_layout(path_sizes, blocksize, header_bytes=0, ranges=None, pinned_header=False):
+    """Split a list of sequentially-related files into blocks
+
+    Parameters
+    ----------
+    path_sizes : list of int
+        Size of each file in bytes
+    blocksize : int
+        Maximum size of a block
+    header_bytes : int
+        Header size skipped in all files but the first
+    ranges : list of tuple (int, int, int)
+        (file_idx, start, end) ranges to split into blocks, in the order they
+        will be read. Parts of a range already covered by an earlier range are
+        left out, such that blocks never overlap, and consecutive adjacent
+        ranges of the same file are coalesced. Defaults to the files in their
+        entirety.
+    pinned_header : bool
+        Leave the global header (the first header_bytes of the first file) out
+        of the blocks, e.g. as it is kept in memory
+
+    Returns
+    -------
+    blocks : list of tuple (int, int, int, int)
+        (file_idx, start, end, offset) of each block, where start and end are
+        positions within file file_idx and offset is the position of the block
+        in the logical (concatenated) stream
+    """
+    first = [header_bytes if i > 0 else 0 for i in range(len(path_sizes))]
+
+    # position of each file in the logical stream
+    bases = []
+    base = 0
+    for i, size in enumerate(path_sizes):
+        bases.append(base - first[i])
+        base += max(size - first[i], 0)
+
+    lower = list(first)
+    if pinned_header and lower:
+        lower[0] = header_bytes
+
+    if ranges is None:
+        ranges = [(i, lower[i], size) for i, size in enumerate(path_sizes)]
+
+    # sorted, disjoint (start, end) spans of each file covered so far
+    covered = [[] for _ in path_sizes]
+    coalesced = []
+    for i, start, end in ranges:
+        start = max(start, lower[i])
+        end = min(end, path_sizes[i])
+
+        if start >= end:
+            continue
+
+        # blocks sharing a region of the cache files would evict each other's
+        # data, only the parts of the range not covered yet are kept
+        for p_start, p_end in _cover(covered[i], start, end):
+            if coalesced:
+                prev_i, prev_start, prev_end = coalesced[-1]
+                if prev_i == i and prev_end == p_start:
+                    coalesced[-1] = (i, prev_start, p_end)
+                    continue
+            coalesced.append((i, p_start, p_end))
+
+    blocks = []
+    for i, start, end in coalesced:
+        while start < end:
+            b_end = min(start + blocksize, end)
+            blocks.append((i, start, b_end, bases[i] + start))
+            start = b_end
+
+    return blocks
+
+
+class Tier:
+    """Space budget of a prefetch storage directory
+
+    Prefetching into the tier pauses once its used space would exceed
+    high_watermark of its capacity and only resumes once it has dropped to
+    low_watermark. The capacity is re-measured on every check, as other
+    processes may be using the same filesystem.
+
+    Tiers stored in memory (e.g. /dev/shm) compete with the memory of the
+    processes, their capacity is also limited to the memory available to the
+    process (cgroup limits included), less memory_reserve of its total.
+
+    Parameters
+    ----------
+    path : str
+        Directory to cache blocks to
+    space : int
+        Space allocated to the tier in MiB, 0 for all free space. It is shared
+        by all block caches of the process using the directory
+    high_watermark : float
+        Fraction of the capacity at which prefetching pauses
+    low_watermark : float
+        Fraction of the capacity at which prefetching resumes (default:
+        high_watermark)
+    memory_reserve : float
+        Fraction of the memory kept free for processes, for tiers stored in
+        memory
+    """
+
+    def __init__(
+        self, path, space=0, high_watermark=1.0, low_watermark=None, memory_reserve=0.1
+    ):
+        if low_watermark is None:
+            low_watermark = high_watermark
+        if not 0 < low_watermark <= high_watermark <= 1:
+            raise ValueError(
+                "Watermarks must satisfy 0 < low_watermark <= high_watermark <= 1"
+            )
+        if not 0 <= memory_reserve < 1:
+            raise ValueError("memory_reserve must satisfy 0 <= memory_reserve < 1")
+
+        self.path = path
+        self.space = int(space * 1024 ** 2)
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.memory_reserve = memory_reserve
+        self.memory_backed = _memory_backed(path)
+        self.paused = False
+
+    def capacity(self, used):
+        """Bytes the tier may hold, given the bytes it already holds"""
+        avail = used + disk_usage(self.path).free
+
+        if self.memory_backed:
+            memory = memory_available()
+            if memory is not None:
+                # the tier's own pages are already accounted as used memory
+                available, total = memory
+                avail = min(avail, used + available - int(self.memory_reserve * total))
+
+        avail = max(avail, 0)
+        if not self.space:
+            return avail
+        # the space is shared with the other streams of the process using the
+        # directory, e.g. files prefetched ahead on a worker
+        others = max(tier_usage(self.path) - used, 0)
+        return min(max(self.space - others, 0), avail)
+
+    def excess(self, used):
+        """Bytes the tier holds beyond its capacity, e.g. under memory pressure"""
+        return max(used - self.capacity(used), 0)
+
+    def admit(self, used, nbytes):
+        """Whether nbytes more can be written to the tier"""
+        capacity = self.capacity(used)
+
+        if self.paused:
+            if used > self.low_watermark * capacity:
+                return False
+            self.paused = False
+
+        if used + nbytes > self.high_watermark * capacity:
+            self.paused = True
+            return False
+        return True
+
+    def full(self, used, nbytes):
+        """Whether admit would refuse nbytes more, without changing its state"""
+        capacity = self.capacity(used)
+
+        if self.paused and used > self.low_watermark * capacity:
+            return True
+        return used + nbytes > self.high_watermark * capacity
+
+
+class BlockCache:
+    """Prefetched blocks of a logical stream, one sparse cache file per tier
+
+    Every tier holds a single cache file the size of the logical stream.
+    Blocks are written at their logical offset, their state is tracked in
+    memory and consumed blocks are released by punching holes in the file,
+    such that no files are created, renamed or deleted per block.
+
+    Each block also exposes how many of its leading bytes have been written
+    so far (filled), so readers can consume a block while it is still being
+    downloaded.
+    """
+
+    EMPTY = 0
+    READY = 1
+    CONSUMED = 2
+    EVICTED = 3
+
+    def __init__(self, name, tiers, blocks, size=None):
+        self.name = name
+        self.tiers = list(tiers)
+        self.blocks = blocks
+        if size is None:
+            size = max((b[3] + b[2] - b[1] for b in blocks), default=0)
+        self.size = size
+        self.paths = [os.path.join(t, name) for t in self.tiers]
+        self.dirs = [os.path.abspath(t) for t in self.tiers]
+
+        self.state = bytearray(len(blocks))
+        self.location = [None] * len(blocks)
+        self.filled = [0] * len(blocks)
+        self.used = [0] * len(self.tiers)
+        self.closed = False
+        self.cond = _Condition()
+
+        # blocks sorted by position, as they may be prefetched in any order
+        self._order = sorted(range(len(blocks)), key=lambda b: blocks[b][:2])
+        self._keys = [blocks[b][:2] for b in self._order]
+        self._fds = [None] * len(self.tiers)
+        self._consumed = []
+        # blocks read from the source while being written, consumed once complete
+        self._deferred = set()
+        # bytes of each tier being released by evict
+        self._evicting = [0] * len(self.tiers)
+        # number of copies and views of each block, which are only evicted after
+        self._exports = {}
+        self._busy = 0
+
+        with _caches_lock:
+            _caches.add(self)
+
+    def find(self, file_idx, pos):
+        """Return the id of the block holding position pos of file file_idx"""
+        idx = bisect_right(self._keys, (file_idx, pos)) - 1
+
+        if idx >= 0:
+            bid = self._order[idx]
+            f, start, end, _ = self.blocks[bid]
+            if f == file_idx and start <= pos < end:
+                return bid
+        return None
+
+    def next_start(self, file_idx, pos):
+        """Start of the first block after position pos of file file_idx
+
+        Returns None if no block of file file_idx starts after pos
+        """
+        idx = bisect_right(self._keys, (file_idx, pos))
+
+        if idx < len(self._keys) and self._keys[idx][0] == file_idx:
+            return self._keys[idx][1]
+        return None
+
+    def between(self, first, last):
+        """Ids of the blocks from position first that end at or before position last
+
+        Positions are (file_idx, pos) tuples, the block holding first is
+        included if it ends at or before last.
+        """
+        idx = max(bisect_right(self._keys, first) - 1, 0)
+
+        bids = []
+        for bid in self._order[idx:]:
+            f, _, end, _ = self.blocks[bid]
+            if (f, end) > last:
+                break
+            if (f, end) > first:
+                bids.append(bid)
+        return bids
+
+    @contextmanager
+    def _io(self, tier):
+        # file descriptors are only closed once no I/O is in flight
+        with self.cond:
+            if self.closed:
+                raise ValueError("I/O operation on closed cache.")
+            if self._fds[tier] is None:
+                fd = os.open(self.paths[tier], os.O_RDWR | os.O_CREAT, 0o600)
+                os.ftruncate(fd, self.size)
+                self._fds[tier] = fd
+            self._busy += 1
+        try:
+            yield self._fds[tier]
+        finally:
+            with self.cond:
+                self._busy -= 1
+                # only close waits for the I/O in flight
+                if self.closed and self._busy == 0:
+                    self.cond.notify_all()
+
+    def allocate(self, bid, tier):
+        """Reserve the space of block bid in tier before it is written
+
+        Returns False if the block was released before being prefetched, e.g.
+        skipped by a forward seek, it is then not to be fetched.
+        """
+        _, start, end, offset = self.blocks[bid]
+
+        with self._io(tier) as fd:
+            with self.cond:
+                if self.state[bid] != self.EMPTY:
+                    return False
+            _allocate(fd, offset, end - start)
+
+            with self.cond:
+                # a failed download may be retried on another tier
+                if self.location[bid] is not None:
+                    self.used[self.location[bid]] -= end - start
+                self.location[bid] = tier
+                self.filled[bid] = 0
+                self.used[tier] += end - start
+        return True
+
+    def write(self, bid, data, pos=0):
+        """Write data at position pos within allocated block bid"""
+        _, start, end, offset = self.blocks[bid]
+
+        if pos + len(data) > end - start:
+            raise ValueError(f"Write past the end of block {bid}")
+
+        with self._io(self.location[bid]) as fd:
+            os.pwrite(fd, data, offset + pos)
+
+        with self.cond:
+            # only the contiguous prefix of the block is readable
+            if pos <= self.filled[bid] < pos + len(data):
+                self.filled[bid] = pos + len(data)
+                self.cond.notify_all()
+
+    def complete(self, bid):
+        """Flag block bid as entirely written"""
+        _, start, end, _ = self.blocks[bid]
+
+        with self.cond:
+            # the block may already have been read while being written
+            if self.state[bid] == self.EMPTY:
+                self.state[bid] = self.READY
+            self.filled[bid] = end - start
+            if bid in self._deferred:
+                self._deferred.discard(bid)
+                self.consume(bid)
+            self.cond.notify_all()
+
+    def available(self, bid, nbytes=None):
+        """Whether the first nbytes (default: all) of block bid can be read"""
+        _, start, end, _ = self.blocks[bid]
+        nbytes = end - start if nbytes is None else nbytes
+
+        return self.state[bid] != self.EVICTED and self.filled[bid] >= nbytes
+
+    def wait(self, bid, nbytes=None, timeout=None, until=None):
+        """Block until the first nbytes (default: all) of block bid are written
+
+        With until, a callable, waiting also stops once it returns True (see
+        notify). Returns False on timeout or if the cache was closed
+        """
+        with self.cond:
+            return (
+                self.cond.wait_for(
+                    lambda: self.closed
+                    or self.state[bid] != self.EMPTY
+                    or self.available(bid, nbytes)
+                    or (until is not None and until()),
+                    timeout,
+                )
+                and not self.closed
+            )
+
+    async def wait_async(self, bid, nbytes=None, timeout=None):
+        """Wait for the first nbytes (default: all) of block bid without blocking
+
+        Awaitable version of wait, for readers driven by an event loop.
+        Returns False on timeout or if the cache was closed
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+
+        while True:
+            with self.cond:
+                if self.closed:
+                    return False
+                if self.state[bid] != self.EMPTY or self.available(bid, nbytes):
+                    return True
+                future = loop.create_future()
+                self.cond.add_future(loop, future)
+
+            try:
+                await asyncio.wait_for(
+                    future, None if deadline is None else deadline - loop.time()
+                )
+            except asyncio.TimeoutError:
+                return False
+
+    def notify(self):
+        """Wake up all threads waiting on the cache"""
+        with self.cond:
+            self.cond.notify_all()
+
+    def read(self, bid, pos, length):
+        """Read length bytes at position pos of the file holding block bid
+
+        Returns None if the requested bytes are not available
+        """
+        _, start, _, offset = self.blocks[bid]
+
+        with self.cond:
+            if not self.available(bid, pos - start + length):
+                return None
+            tier = self.location[bid]
+
+        with self._io(tier) as fd:
+            data = os.pread(fd, length, offset + pos - start)
+
+        # eviction may have punched the region while it was being read
+        with self.cond:
+            if self.state[bid] == self.EVICTED:
+                return None
+        return data
+
+    def sendfile(self, bid, pos, length, out_fd):
+        """Copy length bytes at position pos of the file holding block bid to out_fd
+
+        Bytes are copied by the kernel (os.sendfile) where possible, without
+        going through user space. The block is not evicted while being copied.
+        Returns None if the requested bytes are not available
+        """
+        _, start, _, offset = self.blocks[bid]
+
+        with self.cond:
+            if not self.available(bid, pos - start + length):
+                return None
+            tier = self.location[bid]
+            self._exports[bid] = self._exports.get(bid, 0) + 1
+
+        try:
+            with self._io(tier) as fd:
+                _copy_fd(fd, out_fd, offset + pos - start, length)
+        finally:
+            self._unexport(bid)
+        return length
+
+    def view(self, bid, pos, length):
+        """Read-only view of length bytes at position pos of the file holding block bid
+
+        The view maps the cache file, such that the data isn't copied. The
+        block is not evicted until the view is released (see release).
+        Returns None if the requested bytes are not available
+        """
+        _, start, _, offset = self.blocks[bid]
+
+        with self.cond:
+            if not self.available(bid, pos - start + length):
+                return None
+            tier = self.location[bid]
+            self._exports[bid] = self._exports.get(bid, 0) + 1
+
+        position = offset + pos - start
+        # mappings start at a multiple of the allocation granularity
+        aligned = position - position % mmap.ALLOCATIONGRANULARITY
+        try:
+            with self._io(tier) as fd:
+                mm = mmap.mmap(
+                    fd, position + length - aligned, access=mmap.ACCESS_READ, offset=aligned
+                )
+        except BaseException:
+            self._unexport(bid)
+            raise
+
+        return memoryview(mm)[position - aligned :]
+
+    def release(self, bid, view):
+        """Release a view of block bid, such that the block may be evicted"""
+        mm = view.obj
+        view.release()
+        try:
+            mm.close()
+        except BufferError:
+            # views of the view are still held, the mapping is closed with them
+            pass
+        self._unexport(bid)
+
+    def _unexport(self, bid):
+        with self.cond:
+            self._exports[bid] -= 1
+            if not self._exports[bid]:
+                del self._exports[bid]
+                self.cond.notify_all()
+
+    def present(self, exclude=None):
+        """Directory of the tier holding each ready block, by block id"""
+        with self.cond:
+            return {
+                bid: self.tiers[self.location[bid]]
+                for bid in range(len(self.blocks))
+                if self.state[bid] == self.READY and bid != exclude
+            }
+
+    def adopt(self, blocks, skip=()):
+        """Reuse blocks written to the cache files by a previous run
+
+        Blocks, a dict of tier by block id, are only adopted if their region of
+        the cache file still holds data, i.e. they were not evicted since.
+        Blocks in skip are flagged evicted so they are never prefetched. The
+        space of all blocks not adopted is released. Returns the number of
+        blocks adopted.
+        """
+        skip = set(skip)
+        existing = [t for t in range(len(self.tiers)) if os.path.exists(self.paths[t])]
+        adopted = 0
+
+        for bid, (_, start, end, offset) in enumerate(self.blocks):
+            tier = blocks.get(bid)
+
+            if tier in existing and bid not in skip:
+                with self._io(tier) as fd:
+                    valid = _holds_data(fd, offset, end - start)
+                if valid:
+                    with self.cond:
+                        self.state[bid] = self.READY
+                        self.location[bid] = tier
+                        self.filled[bid] = end - start
+                        self.used[tier] += end - start
+                    adopted += 1
+                    continue
+
+            if bid in skip:
+                self.state[bid] = self.EVICTED
+            # e.g. blocks that were being written or consumed
+            for t in existing:
+                with self._io(t) as fd:
+                    _punch_hole(fd, offset, end - start)
+
+        return adopted
+
+    def consume(self, bid):
+        """Flag block bid as read entirely so it may be evicted
+
+        Blocks still being written are flagged once complete.
+        """
+        with self.cond:
+            if self.state[bid] not in (self.EMPTY, self.READY):
+                return
+            if self.location[bid] is None:
+                # never prefetched, the prefetcher skips it
+                self.state[bid] = self.EVICTED
+                self.cond.notify_all()
+                return
+            if not self.available(bid):
+                self._deferred.add(bid)
+                return
+            self.state[bid] = self.CONSUMED
+            self._consumed.append(bid)
+            self.cond.notify_all()
+
+    def pending(self, tier):
+        """Bytes of tier released but not yet freed by evict"""
+        with self.cond:
+            return self._evicting[tier] + sum(
+                self.blocks[bid][2] - self.blocks[bid][1]
+                for bid in self._consumed
+                if self.location[bid] == tier
+            )
+
+    def drop(self, tier, nbytes):
+        """Flag the blocks prefetched furthest ahead in tier as consumed
+
+        Blocks are flagged until at least nbytes would be freed by evict, and
+        are then read from the source instead. Blocks already awaiting
+        eviction count towards nbytes. Returns the bytes that will be freed.
+        """
+        with self.cond:
+            # space already on its way to being released counts towards nbytes
+            flagged = self.pending(tier)
+
+            for bid in range(len(self.blocks) - 1, -1, -1):
+                if flagged >= nbytes:
+                    break
+                if self.location[bid] != tier or self.state[bid] != self.READY:
+                    continue
+
+                _, start, end, _ = self.blocks[bid]
+                self.state[bid] = self.CONSUMED
+                self._consumed.append(bid)
+                flagged += end - start
+
+        return flagged
+
+    def evict(self):
+        """Release the space of all consumed blocks, returns the bytes freed"""
+        with self.cond:
+            # blocks being copied out or viewed are evicted once released
+            bids = [b for b in self._consumed if b not in self._exports]
+            self._consumed = [b for b in self._consumed if b in self._exports]
+            for bid in bids:
+                self.state[bid] = self.EVICTED
+                self.filled[bid] = 0
+                _, start, end, _ = self.blocks[bid]
+                self._evicting[self.location[bid]] += end - start
+
+        freed = 0
+        for bid in bids:
+            _, start, end, offset = self.blocks[bid]
+            tier = self.location[bid]
+
+            # holes are left in place if the filesystem can't punch them,
+            # the space is then only reclaimed when the cache is closed
+            with self._io(tier) as fd:
+                _punch_hole(fd, offset, end - start)
+
+            with self.cond:
+                self.used[tier] -= end - start
+                self._evicting[tier] -= end - start
+                self.cond.notify_all()
+            freed += end - start
+
+        return freed
+
+    def close(self, delete=True):
+        """Delete the cache files of all tiers
+
+        Without delete, the files are only closed, e.g. to be adopted later.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            self.cond.wait_for(lambda: self._busy == 0)
+
+            for i, fd in enumerate(self._fds):
+                if fd is None:
+                    continue
+                os.close(fd)
+                if not delete:
+                    continue
+                try:
+                    os.remove(self.paths[i])
+                except FileNotFoundError:
+                    pass
+            self._fds = [None] * len(self.tiers)
+
+        with _caches_lock:
+            _caches.discard(self)
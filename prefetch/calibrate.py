@@ -0,0 +1,129 @@
+import os
+import json
+import socket
+from time import perf_counter
+from uuid import uuid4
+from shutil import disk_usage
+
+
+# results of this process, by tier
+_results = {}
+
+
+def cache_file():
+    """File calibration results are saved to"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "rolling-prefetch", "calibration.json")
+
+
+def measure(path, nbytes=64 * 2 ** 20, block_size=4 * 2 ** 20):
+    """Measure the write and read throughput of directory path
+
+    A temporary file of nbytes is written block by block and synced, then
+    read back once dropped from the page cache. The size is reduced if the
+    filesystem doesn't have enough free space.
+
+    Returns
+    -------
+    result : dict
+        "write" and "read" throughput in bytes/s
+    """
+    nbytes = min(nbytes, disk_usage(path).free // 2)
+    nbytes -= nbytes % block_size
+    if nbytes <= 0:
+        return {"write": 0.0, "read": 0.0}
+
+    block = os.urandom(block_size)
+    fname = os.path.join(path, f".calibration.{uuid4().hex[:8]}")
+    fd = os.open(fname, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+
+    try:
+        start = perf_counter()
+        for offset in range(0, nbytes, block_size):
+            os.pwrite(fd, block, offset)
+        os.fsync(fd)
+        write = perf_counter() - start
+
+        try:
+            os.posix_fadvise(fd, 0, nbytes, os.POSIX_FADV_DONTNEED)
+        except (AttributeError, OSError):
+            pass
+
+        start = perf_counter()
+        for offset in range(0, nbytes, block_size):
+            os.pread(fd, block_size, offset)
+        read = perf_counter() - start
+    finally:
+        os.close(fd)
+        os.remove(fname)
+
+    return {"write": nbytes / max(write, 1e-9), "read": nbytes / max(read, 1e-9)}
+
+
+def calibrate(path, refresh=False, **kwargs):
+    """Throughput of directory path, measured on first use
+
+    Results are cached in memory and in cache_file(), per host and directory,
+    such that each tier of an instance is only measured once.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the tier
+    refresh : bool
+        Measure the tier again, even if it was already calibrated
+    kwargs : dict
+        Arguments of measure
+
+    Returns
+    -------
+    result : dict
+        "write" and "read" throughput in bytes/s
+    """
+    key = f"{socket.gethostname()}:{os.path.realpath(path)}"
+
+    if not refresh and key in _results:
+        return _results[key]
+
+    saved = {}
+    try:
+        with open(cache_file(), "r") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    if refresh or key not in saved:
+        saved[key] = measure(path, **kwargs)
+
+        try:
+            fname = cache_file()
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            tmp_fname = f"{fname}.{uuid4().hex[:8]}.tmp"
+            with open(tmp_fname, "w") as f:
+                json.dump(saved, f)
+            # concurrent calibrations never see a partial file
+            os.replace(tmp_fname, fname)
+        except OSError as e:
+            # results are then only kept for this process
+            print(str(e))
+
+    _results[key] = saved[key]
+    return saved[key]
+
+
+def bandwidth(result):
+    """Throughput of a block written then read once, in bytes/s"""
+    if not result["write"] or not result["read"]:
+        return 0.0
+    return 1 / (1 / result["write"] + 1 / result["read"])
+
+
+def order_tiers(tiers, **kwargs):
+    """Sort tiers by calibrated bandwidth, fastest first
+
+    Blocks are prefetched to the first tier with enough space, such that the
+    fastest tier is filled first.
+    """
+    return sorted(tiers, key=lambda t: bandwidth(calibrate(t.path, **kwargs)), reverse=True)
@@ -0,0 +1,117 @@
+import os
+import json
+
+
+class Checkpoint:
+    """Progress of a reader, persisted to resume reading after an interruption
+
+    A checkpoint identifies the files read, their versions and the block
+    layout, such that a checkpoint is only resumed from when the files are
+    opened again in the same way. It records the position of the reader and
+    the blocks present in each tier, whose cache files outlive a crash.
+
+    Parameters
+    ----------
+    file_list : list of str
+        Files read
+    path_sizes : list of int
+        Size of each file in bytes
+    versions : list of str
+        Version of each file, e.g. its ETag
+    block_size : int
+        Size of the prefetched blocks
+    header_bytes : int
+        Header size skipped in all files but the first
+    ranges : list of tuple (int, int, int)
+        Planned (file_idx, start, end) ranges, None without a plan
+    name : str
+        Name of the cache files in the tiers
+    offset : int
+        Position of the reader in the logical (concatenated) stream
+    blocks : dict
+        Directory of the tier holding each present block, by block id
+    """
+
+    version = 1
+
+    def __init__(
+        self,
+        file_list,
+        path_sizes,
+        versions,
+        block_size,
+        header_bytes=0,
+        ranges=None,
+        name=None,
+        offset=0,
+        blocks=None,
+    ):
+        self.file_list = list(file_list)
+        self.path_sizes = list(path_sizes)
+        self.versions = [None if v is None else str(v) for v in versions]
+        self.block_size = block_size
+        self.header_bytes = header_bytes
+        self.ranges = None if ranges is None else [list(r) for r in ranges]
+        self.name = name
+        self.offset = offset
+        self.blocks = dict(blocks or {})
+
+    def matches(self, other):
+        """Whether other refers to the same files, read in the same way"""
+        return (
+            self.file_list == other.file_list
+            and self.path_sizes == other.path_sizes
+            and self.versions == other.versions
+            and self.block_size == other.block_size
+            and self.header_bytes == other.header_bytes
+            and self.ranges == other.ranges
+        )
+
+    def save(self, path):
+        """Write the checkpoint to path"""
+        tmp_path = f"{path}.tmp"
+
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "version": self.version,
+                    "files": self.file_list,
+                    "sizes": self.path_sizes,
+                    "versions": self.versions,
+                    "block_size": self.block_size,
+                    "header_bytes": self.header_bytes,
+                    "ranges": self.ranges,
+                    "name": self.name,
+                    "offset": self.offset,
+                    # JSON keys are strings
+                    "blocks": [[bid, tier] for bid, tier in self.blocks.items()],
+                },
+                f,
+                separators=(",", ":"),
+            )
+            # the checkpoint must survive a crash of the host
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a checkpoint written by save"""
+        with open(path, "r") as f:
+            data = json.load(f)
+
+        if data.get("version") != cls.version:
+            raise ValueError(f"Unsupported checkpoint version {data.get('version')}")
+
+        return cls(
+            data["files"],
+            data["sizes"],
+            data["versions"],
+            data["block_size"],
+            header_bytes=data["header_bytes"],
+            ranges=data["ranges"],
+            name=data["name"],
+            offset=data["offset"],
+            blocks={bid: tier for bid, tier in data["blocks"]},
+        )
@@ -0,0 +1,213 @@
+import os
+import sys
+import argparse
+from time import perf_counter
+
+from fsspec.core import url_to_fs
+from glob import has_magic
+from s3fs import S3FileSystem
+
+from .core import S3PrefetchFileSystem, PrefetchFileSystem, _StreamRegistry
+
+
+def _storage(value):
+    """Parse a DIR:MIB prefetch storage tier"""
+    path, sep, space = value.rpartition(":")
+    if not sep:
+        return value, 0
+    try:
+        return path, int(space)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid storage {value}, expected DIR:MIB")
+
+
+def _filesystem(url, calibrate=False):
+    """Prefetching filesystem of url, and the path of url on it"""
+    fs, path = url_to_fs(url)
+
+    if isinstance(fs, _StreamRegistry):
+        fs.calibrate_tiers = fs.calibrate_tiers or calibrate
+        return fs, path
+    if isinstance(fs, S3FileSystem):
+        return S3PrefetchFileSystem(calibrate=calibrate), path
+    return PrefetchFileSystem(fs=fs, calibrate=calibrate), path
+
+
+def _expand(urls, calibrate=False):
+    """Filesystem of urls and their paths, with globs expanded"""
+    fs = None
+    paths = []
+
+    for url in urls:
+        url_fs, path = _filesystem(url, calibrate)
+        if fs is not None and type(url_fs) is not type(fs):
+            raise ValueError("All paths must be on the same filesystem")
+        fs = url_fs
+        # globs are expanded in order, like the shell would
+        paths.extend(sorted(fs._target.glob(path)) if has_magic(path) else [path])
+
+    if not paths:
+        raise ValueError(f"No files match {' '.join(urls)}")
+    return fs, paths
+
+
+def warm(args):
+    """Stage the first blocks of the files in the tiers, see stage"""
+    fs, paths = _expand(args.paths, args.calibrate)
+
+    staged = fs.stage(
+        paths,
+        args.resume,
+        block_size=args.block_size,
+        prefetch_storage=args.storage,
+        header_bytes=args.header_bytes,
+        high_watermark=args.high_watermark,
+        memory_reserve=args.memory_reserve,
+        concurrency=args.concurrency,
+    )
+    total = sum(fs._target.sizes(paths))
+
+    print(
+        f"Staged {staged / 2 ** 20:.1f} of {total / 2 ** 20:.1f} MiB from "
+        f"{len(paths)} file(s), open them with resume={args.resume!r}"
+    )
+
+
+def _open(args, fs, paths):
+    """Open paths as a single prefetched stream, with the options of args"""
+    return fs.open(
+        paths,
+        "rb",
+        block_size=args.block_size,
+        prefetch_storage=args.storage,
+        header_bytes=args.header_bytes,
+        high_watermark=args.high_watermark,
+        memory_reserve=args.memory_reserve,
+    )
+
+
+def _copy(args, fs, paths, out):
+    """Write the stream of paths to out, returns the throughput"""
+    start = perf_counter()
+
+    with _open(args, fs, paths) as f:
+        try:
+            fd = out.fileno()
+        except (AttributeError, OSError):
+            # e.g. captured output, data goes through user space
+            fd = None
+
+        if fd is not None:
+            out.flush()
+            nbytes = f.sendfile(fd)
+        else:
+            nbytes = 0
+            while True:
+                data = f.read(f.blocksize)
+                if not data:
+                    break
+                out.write(data)
+                nbytes += len(data)
+            out.flush()
+
+    elapsed = perf_counter() - start
+    return (
+        f"Copied {nbytes / 2 ** 20:.1f} MiB in {elapsed:.2f} s "
+        f"({nbytes / 2 ** 20 / max(elapsed, 1e-9):.1f} MiB/s)"
+    )
+
+
+def cat(args):
+    """Write the stream of the files to stdout"""
+    fs, paths = _expand(args.paths, args.calibrate)
+    stats = _copy(args, fs, paths, sys.stdout.buffer)
+    if args.stats:
+        print(stats, file=sys.stderr)
+
+
+def cp(args):
+    """Write the stream of the files to a local file"""
+    fs, paths = _expand(args.paths, args.calibrate)
+
+    dest = args.dest
+    if os.path.isdir(dest):
+        # named after the first file, rather than the glob matching it
+        dest = os.path.join(dest, os.path.basename(paths[0].rstrip("/")))
+
+    with open(dest, "wb") as out:
+        stats = _copy(args, fs, paths, out)
+    print(stats)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="rolling-prefetch", description="Rolling prefetch utilities"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    # options of the prefetch stream, shared by all commands
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--block-size", type=int, default=None, help="in bytes")
+    common.add_argument(
+        "--storage",
+        type=_storage,
+        action="append",
+        default=None,
+        help="prefetch storage tier as DIR:MIB, in order of priority (repeatable)",
+    )
+    common.add_argument("--header-bytes", type=int, default=0)
+    common.add_argument("--high-watermark", type=float, default=1.0)
+    common.add_argument("--memory-reserve", type=float, default=0.1)
+    common.add_argument(
+        "--calibrate", action="store_true", help="order tiers by measured throughput"
+    )
+
+    parser_warm = commands.add_parser(
+        "warm",
+        parents=[common],
+        help="stage files into the prefetch storage ahead of a job",
+        description="Download the first blocks of a list of files (read as a "
+        "single stream, like fs.open(paths)) into the prefetch storage, until it "
+        "is full. Jobs opening the same files with the same block size, header "
+        "bytes and resume checkpoint start with the staged blocks.",
+    )
+    parser_warm.add_argument("paths", nargs="+", help="files or globs to stage")
+    parser_warm.add_argument(
+        "--resume", required=True, help="checkpoint the job opens the files with"
+    )
+    parser_warm.add_argument(
+        "--concurrency", type=int, default=16, help="blocks downloaded at once"
+    )
+    parser_warm.set_defaults(func=warm)
+
+    parser_cat = commands.add_parser(
+        "cat",
+        parents=[common],
+        help="write files to stdout",
+        description="Write a list of files, read as a single stream (the header "
+        "of all files but the first is skipped with --header-bytes), to stdout.",
+    )
+    parser_cat.add_argument("paths", nargs="+", help="files or globs to read")
+    parser_cat.add_argument(
+        "--stats", action="store_true", help="print the throughput to stderr"
+    )
+    parser_cat.set_defaults(func=cat)
+
+    parser_cp = commands.add_parser(
+        "cp",
+        parents=[common],
+        help="copy files to a local file",
+        description="Write a list of files, read as a single stream (the header "
+        "of all files but the first is skipped with --header-bytes), to a local "
+        "file, and print the throughput.",
+    )
+    parser_cp.add_argument("paths", nargs="+", help="files or globs to read")
+    parser_cp.add_argument("dest", help="local file or directory")
+    parser_cp.set_defaults(func=cp)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import io
 import os
 import asyncio
 import threading
@@ -6,19 +7,234 @@ import multiprocessing as mp
 from time import sleep
 from copy import deepcopy
 from pathlib import Path
-from shutil import disk_usage
+from bisect import bisect_right
 from s3fs import S3FileSystem, S3File
-from s3fs.core import _fetch_range
-from contextlib import contextmanager
+from fsspec import filesystem
+from fsspec.spec import AbstractFileSystem, AbstractBufferedFile
+from fsspec.asyn import _run_coros_in_chunks
+
+try:
+    from fsspec.implementations.chained import ChainedFileSystem
+except ImportError:
+    # older fsspec, chained URLs must then include the path of the target
+    ChainedFileSystem = AbstractFileSystem
+from fsspec.utils import merge_offset_ranges
+
+from .asyn import AsyncPrefetchFile
+from .cache import Tier, write_all
+from .calibrate import order_tiers
+from .stream import PrefetchStream
+from .trace import AccessTrace
+from .checkpoint import Checkpoint
+from .eviction import get_policy
+from .upload import UploadStream
 
 import logging
 import logging.config
 
 
-class S3PrefetchFileSystem(S3FileSystem):
+def _version(info):
+    """Version of a file from its info, e.g. its ETag, None if unknown"""
+    for key in ("ETag", "VersionId", "mtime", "LastModified"):
+        if info.get(key) is not None:
+            return str(info[key])
+    return None
+
+
+class _StreamRegistry:
+    """Prefetch streams shared by concurrent opens of the same files
+
+    Filesystems using the registry fetch data from their _target filesystem.
+    With calibrate_tiers, tiers are ordered by their measured throughput
+    rather than by their order in prefetch_storage.
+    """
+
+    calibrate_tiers = False
+
+    def _init_streams(self):
+        self._streams = {}
+        self._streams_lock = threading.Lock()
+
+    def _attach(
+        self,
+        reader,
+        file_list,
+        block_size,
+        prefetch_storage,
+        header_bytes=0,
+        high_watermark=1.0,
+        low_watermark=None,
+        req_kw=None,
+        plan=None,
+        passive=False,
+        memory_reserve=0.1,
+        path_sizes=None,
+        resume=None,
+    ):
+        """Attach reader to the prefetch stream of file_list, creating it if needed
+
+        A new stream resumes from the Checkpoint resume, if given.
+        """
+        ranges = self._plan_ranges(file_list, plan)
+
+        key = (
+            tuple(file_list),
+            block_size,
+            header_bytes,
+            tuple(tuple(p) for p in prefetch_storage),
+            high_watermark,
+            low_watermark,
+            memory_reserve,
+            None if ranges is None else tuple(ranges),
+        )
+
+        with self._streams_lock:
+            stream = self._streams.get(key)
+
+            if stream is None or stream.closed:
+                stream = PrefetchStream(
+                    self._target,
+                    file_list,
+                    path_sizes or self._target.sizes(file_list),
+                    block_size,
+                    self._tiers(
+                        prefetch_storage, high_watermark, low_watermark, memory_reserve
+                    ),
+                    header_bytes=header_bytes,
+                    req_kw=req_kw,
+                    ranges=ranges,
+                    resume=resume,
+                )
+                stream.key = key
+                stream.start()
+                self._streams[key] = stream
+
+            stream.attach(reader, passive=passive)
+
+        return stream
+
+    def stage(
+        self,
+        file_list,
+        resume,
+        block_size=None,
+        prefetch_storage=None,
+        header_bytes=0,
+        high_watermark=1.0,
+        memory_reserve=0.1,
+        plan=None,
+        concurrency=16,
+    ):
+        """Download the first blocks of file_list to the tiers ahead of a job
+
+        Blocks are fetched concurrently until the tiers are full, in the layout
+        of the files opened with the same parameters. The cache files are kept
+        and a Checkpoint is saved to resume, such that opening the files with
+        the same resume path starts with the staged blocks.
+
+        Returns
+        -------
+        staged : int
+            Bytes staged
+        """
+        file_list = self._strip_protocol(list(file_list))
+        block_size = block_size or self.default_block_size
+        prefetch_storage = prefetch_storage or self.default_prefetch_storage
+        path_sizes = self._target.sizes(file_list)
+        ranges = self._plan_ranges(file_list, plan)
+
+        stream = PrefetchStream(
+            self._target,
+            file_list,
+            path_sizes,
+            block_size,
+            self._tiers(prefetch_storage, high_watermark, None, memory_reserve),
+            header_bytes=header_bytes,
+            req_kw=getattr(self, "req_kw", None),
+            ranges=ranges,
+        )
+
+        try:
+            staged = stream.stage(concurrency)
+
+            checkpoint = self._checkpoint(
+                file_list, path_sizes, block_size, header_bytes, ranges
+            )
+            checkpoint.name = stream.cache.name
+            checkpoint.blocks = stream.cache.present()
+            checkpoint.save(resume)
+        except BaseException:
+            stream.cache.close()
+            raise
+
+        # the staged blocks are left for the job
+        stream.cache.close(delete=False)
+        return staged
+
+    def open_async(self, path, mode="rb", **kwargs):
+        """Open a file to be read from an event loop
+
+        Takes the same arguments as open. The returned AsyncPrefetchFile is
+        opened once awaited, or entered with ``async with``, and its reads
+        await the prefetched blocks without blocking the event loop.
+        """
+        return AsyncPrefetchFile(self, path, mode, **kwargs)
+
+    def _tiers(self, prefetch_storage, high_watermark, low_watermark, memory_reserve):
+        """Tiers of prefetch_storage, fastest first with calibrate_tiers"""
+        tiers = [
+            Tier(path, space, high_watermark, low_watermark, memory_reserve)
+            for path, space in prefetch_storage
+        ]
+        if self.calibrate_tiers:
+            tiers = order_tiers(tiers)
+        return tiers
+
+    def _checkpoint(self, file_list, path_sizes, block_size, header_bytes, ranges):
+        """Empty Checkpoint of file_list, identifying the current file versions"""
+        return Checkpoint(
+            self._strip_protocol(list(file_list)),
+            path_sizes,
+            [_version(self._target.info(p)) for p in file_list],
+            block_size,
+            header_bytes=header_bytes,
+            ranges=ranges,
+        )
+
+    def _plan_ranges(self, file_list, plan):
+        """Ranges of a plan as (file_idx, start, end), None without a plan"""
+        if plan is None:
+            return None
+
+        strip = self._target._strip_protocol
+        file_idx = {strip(p): i for i, p in enumerate(file_list)}
+        try:
+            return [
+                (file_idx[strip(p)], int(start), int(end)) for p, start, end in plan
+            ]
+        except KeyError as e:
+            raise ValueError(f"Planned path {e} is not part of {file_list}")
+
+    def _detach(self, reader, stream):
+        """Detach reader from stream, closing the stream after its last reader"""
+        with self._streams_lock:
+            last = stream.detach(reader) == 0
+            if last and self._streams.get(stream.key) is stream:
+                del self._streams[stream.key]
+
+        # other files are opened while the stream shuts down
+        if last:
+            stream.close()
+
+
+class S3PrefetchFileSystem(_StreamRegistry, S3FileSystem):
+
+    protocol = ("s3prefetch", "s3", "s3a")
 
     default_block_size = 32 * 2 ** 20
     default_prefetch_storage = [("/dev/shm", 0)]
+    # ranges closer than this are fetched in a single request by cat_ranges
+    default_max_gap = 2 ** 16
 
     # init debugger
     # logfile = "logging.conf"
@@ -30,24 +246,39 @@ class S3PrefetchFileSystem(S3FileSystem):
     #     # if logger config file is not found
     #     logging.disable()
 
-    def __init__(self, default_block_size=None, **kwargs):
+    def __init__(
+        self, default_block_size=None, prefetch_storage=None, calibrate=False, **kwargs
+    ):
 
         super().__init__(**kwargs)
 
         self.default_block_size = default_block_size or self.default_block_size
+        # defaults of files opened through URLs, e.g. with fsspec.open
+        self.default_prefetch_storage = (
+            prefetch_storage or self.default_prefetch_storage
+        )
+        # measure the throughput of tiers on first use
+        self.calibrate_tiers = calibrate
+
+        # prefetch streams shared by concurrent opens of the same files
+        self._init_streams()
         # self.logger.info(
         #     "Initializing S3PrefetchFileSystem with default_block_size %d",
         #     self.default_block_size,
         # )
 
+    @property
+    def _target(self):
+        return self
+
     # much of this function consists of what's done in s3fs
     # main differences are setting the cache to None
     # and prefetch_storage (might switch to cache_storage later??)
-    # for now forcing mode to be "rb" TODO change?
-    @contextmanager
+    # files opened for writing are uploaded by S3UploadFile
     def _open(
         self,
         path,
+        mode="rb",
         block_size=None,
         acl="",
         version_id=None,
@@ -55,6 +286,17 @@ class S3PrefetchFileSystem(S3FileSystem):
         autocommit=True,
         requester_pays=None,
         header_bytes=0,
+        high_watermark=1.0,
+        low_watermark=None,
+        memory_reserve=0.1,
+        plan=None,
+        record=None,
+        replay=None,
+        resume=None,
+        race_bytes=2 ** 16,
+        eviction=None,
+        concurrency=None,
+        cache_options=None,
         **kwargs,
     ):
         # path can be a list of files
@@ -78,12 +320,30 @@ class S3PrefetchFileSystem(S3FileSystem):
                 "version_id cannot be specified if the filesystem "
                 "is not version aware"
             )
+
+        if "r" not in mode:
+            return S3UploadFile(
+                self,
+                path,
+                mode,
+                block_size=block_size,
+                acl=acl,
+                s3_additional_kwargs=kw,
+                autocommit=autocommit,
+                requester_pays=requester_pays,
+                prefetch_storage=prefetch_storage,
+                high_watermark=high_watermark,
+                low_watermark=low_watermark,
+                memory_reserve=memory_reserve,
+                concurrency=concurrency or self.max_concurrency,
+            )
+
         fill_cache = False
         cache_type = "none"
         mode = "rb"
         self.get_object = S3PrefetchFileSystem
 
-        f = S3PrefetchFile(
+        return S3PrefetchFile(
             self,
             path,
             mode,
@@ -97,38 +357,337 @@ class S3PrefetchFileSystem(S3FileSystem):
             autocommit=autocommit,
             requester_pays=requester_pays,
             header_bytes=header_bytes,
+            high_watermark=high_watermark,
+            low_watermark=low_watermark,
+            memory_reserve=memory_reserve,
+            plan=plan,
+            record=record,
+            replay=replay,
+            resume=resume,
+            race_bytes=race_bytes,
+            eviction=eviction,
         )
 
-        try:
-            yield f
-        finally:
-            f.close()
+    async def _cat_file(self, path, version_id=None, start=None, end=None, **kwargs):
+        """Fetch a file, or a range of it, in blocks fetched concurrently"""
+        out = await self._cat_ranges(
+            [path], [start], [end], on_error="raise", version_id=version_id, **kwargs
+        )
+        return out[0]
+
+    async def _cat_ranges(
+        self,
+        paths,
+        starts,
+        ends,
+        max_gap=None,
+        batch_size=None,
+        on_error="return",
+        **kwargs,
+    ):
+        """Fetch byte ranges of one or more files
+
+        Ranges of the same file less than max_gap bytes apart are coalesced,
+        then split into default_block_size blocks which are all fetched
+        concurrently, batch_size requests at a time.
+
+        Parameters
+        ----------
+        paths : list of str
+            File of each range
+        starts, ends : int or list of int
+            Limits of each range, None or negative values are relative to the
+            end of the file
+        max_gap : int
+            Largest gap between coalesced ranges (default: default_max_gap)
+        batch_size : int
+            Maximum number of concurrent requests
+        on_error : {"return", "raise"}
+            Return exceptions in place of the ranges that failed, or raise the
+            first one
+
+        Returns
+        -------
+        out : list of bytes
+            Content of each range
+        """
+        if not isinstance(paths, list):
+            raise TypeError("paths must be a list")
+        if not isinstance(starts, list):
+            starts = [starts] * len(paths)
+        if not isinstance(ends, list):
+            ends = [ends] * len(paths)
+        if len(starts) != len(paths) or len(ends) != len(paths):
+            raise ValueError("paths, starts and ends must have the same length")
+        if max_gap is None:
+            max_gap = self.default_max_gap
+
+        # limits relative to the end need the file size
+        relative = sorted(
+            {
+                p
+                for p, start, end in zip(paths, starts, ends)
+                if end is None or end < 0 or (start is not None and start < 0)
+            }
+        )
+        infos = await asyncio.gather(
+            *[self._info(p, version_id=kwargs.get("version_id")) for p in relative],
+            return_exceptions=True,
+        )
+        sizes = dict(zip(relative, infos))
+
+        ranges = []
+        errors = {}
+        for p, start, end in zip(paths, starts, ends):
+            size = sizes.get(p)
+            if isinstance(size, Exception):
+                errors[p] = size
+                continue
+            if size is not None:
+                size = size["size"]
+
+            start = 0 if start is None else start + size if start < 0 else start
+            end = size if end is None else end + size if end < 0 else end
+            ranges.append((p, start, max(start, end)))
+
+        m_paths, m_starts, m_ends = merge_offset_ranges(
+            [r[0] for r in ranges],
+            [r[1] for r in ranges],
+            [r[2] for r in ranges],
+            max_gap=max_gap,
+        )
+
+        blocks = [
+            (i, b_start, min(b_start + self.default_block_size, m_ends[i]))
+            for i in range(len(m_paths))
+            for b_start in range(m_starts[i], m_ends[i], self.default_block_size)
+        ]
+        data = await _run_coros_in_chunks(
+            [
+                super(S3PrefetchFileSystem, self)._cat_file(
+                    m_paths[i], start=b_start, end=b_end, **kwargs
+                )
+                for i, b_start, b_end in blocks
+            ],
+            batch_size=batch_size or self.batch_size,
+            nofiles=True,
+            return_exceptions=True,
+        )
+
+        merged = [[] for _ in m_paths]
+        for (i, _, _), d in zip(blocks, data):
+            merged[i].append(d)
+        for i, parts in enumerate(merged):
+            error = next((d for d in parts if isinstance(d, Exception)), None)
+            merged[i] = error if error is not None else b"".join(parts)
+
+        # coalesced ranges of each file, by start
+        index = {}
+        for i, p in enumerate(m_paths):
+            idx, idx_starts = index.setdefault(p, ([], []))
+            idx.append(i)
+            idx_starts.append(m_starts[i])
+
+        out = []
+        ranges = iter(ranges)
+        for p in paths:
+            if p in errors:
+                out.append(errors[p])
+                continue
+
+            _, start, end = next(ranges)
+            idx, idx_starts = index[p]
+            i = idx[bisect_right(idx_starts, start) - 1]
+
+            if isinstance(merged[i], Exception):
+                out.append(merged[i])
+            else:
+                out.append(merged[i][start - m_starts[i] : end - m_starts[i]])
+
+        if on_error != "return":
+            error = next((d for d in out if isinstance(d, Exception)), None)
+            if error is not None:
+                raise error
+        return out
 
     # def _ls_from_cache(self, path):
     #    return None
 
 
-class S3PrefetchFile(S3File):
+class PrefetchFileSystem(_StreamRegistry, ChainedFileSystem):
+    """Rolling prefetch over any fsspec filesystem
 
-    DELETE_STR = ".nibtodelete"
+    Files are prefetched with range reads (cat_file) of the target
+    filesystem, e.g. local files, HTTP, GCS or Azure. All other operations
+    are passed on to the target filesystem.
+
+    Parameters
+    ----------
+    target_protocol : str
+        Protocol of the filesystem to prefetch from (default: "file")
+    target_options : dict
+        Arguments of the target filesystem
+    fs : AbstractFileSystem
+        Filesystem to prefetch from, instead of target_protocol
+    default_block_size : int
+        Size of the prefetched blocks
+    prefetch_storage : list of tuple (str, int)
+        Default storage tiers to prefetch to
+    calibrate : bool
+        Order tiers by their measured throughput, fastest first
+    """
+
+    protocol = "prefetch"
+
+    default_block_size = 32 * 2 ** 20
+    default_prefetch_storage = [("/dev/shm", 0)]
 
-    # @profile
     def __init__(
         self,
-        s3,
+        target_protocol=None,
+        target_options=None,
+        fs=None,
+        default_block_size=None,
+        prefetch_storage=None,
+        calibrate=False,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+
+        if fs is None:
+            fs = filesystem(target_protocol or "file", **(target_options or {}))
+        self.fs = fs
+
+        self.default_block_size = default_block_size or self.default_block_size
+        self.default_prefetch_storage = (
+            prefetch_storage or self.default_prefetch_storage
+        )
+        self.calibrate_tiers = calibrate
+
+        self._init_streams()
+
+        def _strip_protocol(path):
+            # paths are those of the target filesystem
+            if isinstance(path, list):
+                return [_strip_protocol(p) for p in path]
+            return self.fs._strip_protocol(type(self)._strip_protocol(path))
+
+        self._strip_protocol = _strip_protocol
+
+    @property
+    def _target(self):
+        return self.fs
+
+    def _open(
+        self,
         path,
         mode="rb",
+        block_size=None,
         prefetch_storage=None,
-        block_size=5 * 2 ** 20,
-        acl="",
-        version_id=None,
-        fill_cache=False,
-        s3_additional_kwargs=None,
         autocommit=True,
-        cache_type="none",
-        requester_pays=False,
         header_bytes=0,
+        high_watermark=1.0,
+        low_watermark=None,
+        memory_reserve=0.1,
+        plan=None,
+        record=None,
+        replay=None,
+        resume=None,
+        race_bytes=2 ** 16,
+        eviction=None,
+        cache_options=None,
+        **kwargs,
     ):
+        if "r" not in mode:
+            raise NotImplementedError(f"PrefetchFileSystem can't open files in mode {mode}")
+        if block_size is None:
+            block_size = self.default_block_size
+        if prefetch_storage is None:
+            prefetch_storage = self.default_prefetch_storage
+
+        path = self._strip_protocol(path)
+
+        return PrefetchFile(
+            self,
+            path,
+            "rb",
+            block_size=block_size,
+            prefetch_storage=prefetch_storage,
+            header_bytes=header_bytes,
+            high_watermark=high_watermark,
+            low_watermark=low_watermark,
+            memory_reserve=memory_reserve,
+            plan=plan,
+            record=record,
+            replay=replay,
+            resume=resume,
+            race_bytes=race_bytes,
+            eviction=eviction,
+            autocommit=autocommit,
+            cache_type="none",
+        )
+
+    def info(self, path, **kwargs):
+        return self.fs.info(self._strip_protocol(path), **kwargs)
+
+    def ls(self, path, detail=True, **kwargs):
+        return self.fs.ls(self._strip_protocol(path), detail=detail, **kwargs)
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        return self.fs.cat_file(self._strip_protocol(path), start=start, end=end, **kwargs)
+
+
+class PrefetchFile(AbstractBufferedFile):
+    """Read-only file prefetched block by block into local storage
+
+    A list of sequentially-related files is read as a single logical stream,
+    where all files but the first start with a header_bytes header that is
+    skipped. The filesystem must provide _attach and _detach (see
+    _StreamRegistry).
+
+    Opening a file only gets the size of its files, the prefetch stream is
+    started on first read. Reads of up to race_bytes from a block the stream
+    has not started downloading are also requested directly from the source,
+    and served by whichever arrives first.
+
+    Blocks read entirely are handed to the eviction policy (see
+    EvictionPolicy), which releases them right away by default.
+
+    With resume, a Checkpoint of the reader is saved to the resume path every
+    time a block has been read. Opening the same files again with the same
+    resume path reuses the blocks left in the tiers, e.g. after a crash, and
+    prefetching restarts from resume_offset, where the previous reader was.
+    The checkpoint is deleted on close once the stream was read to the end.
+    """
+
+    # @profile
+    def __init__(
+        self,
+        fs,
+        path,
+        mode="rb",
+        block_size="default",
+        prefetch_storage=None,
+        header_bytes=0,
+        high_watermark=1.0,
+        low_watermark=None,
+        memory_reserve=0.1,
+        plan=None,
+        record=None,
+        replay=None,
+        resume=None,
+        race_bytes=2 ** 16,
+        eviction=None,
+        path_sizes=None,
+        **kwargs,
+    ):
+
+        # set before anything can fail, as close is called on deletion
+        self._stream = None
+        self._engine = None
+        self._attached = False
+        self.trace = None
+        self.resume = None
 
         if isinstance(path, list):
             self.file_list = path
@@ -136,102 +695,149 @@ class S3PrefetchFile(S3File):
         else:
             self.file_list = [path]
 
+        # sizes of all files are requested at once
+        if path_sizes is None:
+            path_sizes = fs._target.sizes(self.file_list)
+        self.path_sizes = list(path_sizes)
+
         super().__init__(
-            s3,
-            path,
-            mode,
-            block_size=block_size,
-            acl=acl,
-            version_id=version_id,
-            fill_cache=fill_cache,
-            s3_additional_kwargs=s3_additional_kwargs,
-            autocommit=autocommit,
-            cache_type=cache_type,
-            requester_pays=requester_pays,
+            fs, path, mode, block_size=block_size, size=self.path_sizes[0], **kwargs
         )
 
-        # self.s3.logger.info("Opening S3Prefetch file")
-
-        self.prefetch_storage = []
-
         self.prefetch_storage = prefetch_storage
         self.header_bytes = header_bytes
-        self.path_sizes = [self.s3.du(p) for p in self.file_list]
-        self.file_idx = 0
+        self.race_bytes = race_bytes
+        self.eviction = get_policy(eviction)
 
-        self.size = (
-            sum(
-                self.path_sizes[i] - self.header_bytes
-                for i in range(len(self.path_sizes))
-            )
-            + self.header_bytes
-        )
+        # the reads of a previous run are prefetched with perfect lookahead
+        if plan is None and replay is not None and os.path.exists(replay):
+            plan = AccessTrace.load(replay).to_plan()
 
-        self.fetch = True
-
-        # self.s3.logger.debug("Lauching prefetch thread")
-        self.fetch_thread = threading.Thread(
-            target=self._prefetch,
-            args=(
-                deepcopy(self.file_list),
-                deepcopy(self.prefetch_storage),
-                deepcopy(self.path_sizes),
-                self.blocksize,
-                deepcopy(self.req_kw),
-            ),
-        )
+        self.record = record
+        if record is not None:
+            self.trace = AccessTrace(self.file_list)
+
+        # invalid plans fail on open rather than on first read
+        ranges = self.fs._plan_ranges(self.file_list, plan)
 
-        self.fetch_thread.start()
-
-        # self.s3.logger.debug("Lauching evict thread")
-        self.evict_thread = threading.Thread(
-            target=self._remove,
-            args=(
-                deepcopy(self.prefetch_storage),
-                deepcopy(self.path_sizes),
-                self.blocksize,
-                deepcopy(self.file_list),
-                self.DELETE_STR,
-            ),
+        self.resume_offset = 0
+        previous = None
+        if resume is not None:
+            self.checkpoint = self.fs._checkpoint(
+                self.file_list, self.path_sizes, self.blocksize, header_bytes, ranges
+            )
+            if os.path.exists(resume):
+                previous = Checkpoint.load(resume)
+                if previous.matches(self.checkpoint):
+                    self.resume_offset = previous.offset
+                else:
+                    # the files changed or are read differently
+                    previous = None
+            self.resume = resume
+
+        # arguments of the prefetch stream, attached to on first use
+        self._engine = dict(
+            header_bytes=header_bytes,
+            high_watermark=high_watermark,
+            low_watermark=low_watermark,
+            memory_reserve=memory_reserve,
+            req_kw=getattr(self, "req_kw", None),
+            plan=plan,
+            path_sizes=self.path_sizes,
+            resume=previous,
         )
-        self.evict_thread.start()
+        self.size = sum(self.path_sizes) - header_bytes * (len(self.path_sizes) - 1)
 
+        self.file_idx = 0
         self.global_pos = 0
-        self.b_start = 0
-        self.b_end = self.blocksize
-        self.cf_ = None
-        # self.s3.logger.debug("S3PrefetchFile initialization complete")
+
+    @property
+    def stream(self):
+        """Prefetch stream of the files, started on first use"""
+        if self._engine is not None:
+            kwargs, self._engine = self._engine, None
+            # concurrent opens of the same files share a single prefetch stream
+            self._stream = self.fs._attach(
+                self, self.file_list, self.blocksize, self.prefetch_storage, **kwargs
+            )
+            self._attached = True
+        return self._stream
+
+    @property
+    def cache(self):
+        """Block cache of the prefetch stream, None once detached from it"""
+        stream = self.stream
+        return stream.cache if self._attached else None
+
+    @cache.setter
+    def cache(self, cache):
+        # fsspec's read cache is replaced by the stream's block cache, which
+        # is closed by the stream
+        pass
+
+    def seek(self, loc, whence=0):
+        """Set the position in the logical (concatenated) stream
+
+        Parameters
+        ----------
+        loc: int
+            byte location
+        whence: {0, 1, 2}
+            from start of file, current location or end of file, resp.
+        """
+        loc = int(loc)
+        if whence == 0:
+            nloc = loc
+        elif whence == 1:
+            nloc = self.tell() + loc
+        elif whence == 2:
+            nloc = self.size + loc
+        else:
+            raise ValueError(f"invalid whence ({whence}, should be 0, 1 or 2)")
+        if nloc < 0:
+            raise ValueError("Seek before start of file")
+
+        # find the file holding the position, past the end stays in the last
+        global_pos = 0
+        for file_idx, size in enumerate(self.path_sizes):
+            first = self.header_bytes if file_idx > 0 else 0
+            if nloc < global_pos + size - first or file_idx + 1 == len(self.path_sizes):
+                break
+            global_pos += size - first
+
+        previous = (self.file_idx, self.loc)
+        self._set_file(file_idx, global_pos)
+        self.loc = nloc - global_pos + first
+
+        if self._attached and (self.file_idx, self.loc) > previous:
+            self._skip(previous)
+        return nloc
+
+    def tell(self):
+        """Current position in the logical (concatenated) stream"""
+        return self._logical_loc()
 
     # @profile
     def close(self):
-        # self.s3.logger.debug("Closing S3PrefetchFile")
-        self.fetch = False
+        if not self.closed:
+            # files closed before being read never start their stream
+            self._engine = None
+            if self._attached:
+                if self.resume is not None:
+                    offset = max(self.tell(), self.checkpoint.offset)
+                    if offset >= self.size:
+                        # read to the end, the next run reads from scratch
+                        self._remove_checkpoint()
+                    else:
+                        # the cache files are deleted along with the stream
+                        self._save_checkpoint(present=False)
+                self._attached = False
+                self.fs._detach(self, self._stream)
+            # readers that read nothing don't replace the trace of a previous run
+            if self.trace is not None and self.trace.reads:
+                self.trace.save(self.record)
         super().close()
 
-    def seek(self, pos, whence=0):
-        try:
-            # need to fix
-            if whence == 0:
-                p = pos - self.b_start
-            else:
-                p = pos
-            # self.s3.logger.debug(
-            #     "Seeking to position %d relative to %d in file %s",
-            #     p,
-            #     whence,
-            #     self.cf_.name,
-            # )
-            self.cf_.seek(p, whence)
-        except Exception as e:
-            # self.s3.logger.error(
-            #     "Failed to seek in cached block from %d relative to %d with error message %s",
-            #     pos,
-            #     whence,
-            #     str(e),
-            # )
-            pass
-        super().seek(pos, whence)
-
     # adapted from fsspec code
     # @profile
     def read(self, length=-1):
@@ -242,327 +848,675 @@ class S3PrefetchFile(S3File):
         length: int (-1)
             Number of bytes to read; if <0, all remaining bytes.
         """
-        # self.s3.logger.debug(
-        #     "Reading the next %d bytes from file %s", length, self.path
-        # )
-
         length = -1 if length is None else int(length)
-        if length < 0:
-            length = self.size - self.global_pos
         if self.closed:
             raise ValueError("I/O operation on closed file.")
-        if length == 0:
+
+        remaining = self.size - self._logical_loc()
+        if length < 0 or length > remaining:
+            length = remaining
+        if length <= 0:
             # don't even bother calling fetch
             return b""
-        if self.global_pos + self.loc - self.header_bytes >= self.size:
-            return b""
 
-        # print("read", self.loc, length)
         out = self._fetch_prefetched(self.loc, self.loc + length)
 
         return out
 
-    def _remove(self, prefetch_storage, path_sizes, blocksize, file_list, DELETE_STR):
-        # self.s3.logger.debug("Removing files in cache with extension %s", DELETE_STR)
+    def sendfile(self, out, length=-1):
+        """Copy data to a file, from the prefetched blocks without a user space copy
 
-        header_bytes = self.header_bytes
-        pf_dirs = [p[0] for p in prefetch_storage]
-        file_keys = [f.split("/")[-1] for f in file_list]
-        block_ids = [
-            f"{file_keys[i]}.{int(j*blocksize + (0 if i == 0 else header_bytes))}{DELETE_STR}"
-            for i in range(len(file_keys))
-            for j in range(int(path_sizes[i] // blocksize) + 1)
-        ]
+        The next length bytes (if <0, all remaining bytes) of the logical
+        stream are written to out, as read would return them. Prefetched
+        blocks are copied from the storage tiers by the kernel (os.sendfile),
+        the rest is fetched and written.
 
-        updated_list = deepcopy(block_ids)
+        Parameters
+        ----------
+        out : int or file-like
+            File descriptor, or file with a fileno, opened for writing
+        length : int (-1)
+            Number of bytes to copy; if <0, all remaining bytes.
 
-        def evict(block_ids, pf_dirs, updated_list):
-            for fname in block_ids:
-                for pf in pf_dirs:
-                    try:
-                        os.remove(os.path.join(pf, fname))
-                        updated_list.remove(fname)
-                        # self.s3.logger.debug("Removed %s", fname)
-                        break
-                    except Exception as e:
-                        pass
-            block_ids = deepcopy(updated_list)
+        Returns
+        -------
+        nbytes : int
+            Number of bytes written to out
+        """
+        length = -1 if length is None else int(length)
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
 
-        while self.fetch:
-            sleep(1)
-            evict(block_ids, pf_dirs, updated_list)
+        fd = out if isinstance(out, int) else out.fileno()
 
-        evict(block_ids, pf_dirs, updated_list)
+        remaining = self.size - self._logical_loc()
+        if length < 0 or length > remaining:
+            length = remaining
+        if length <= 0:
+            return 0
 
-        # self.s3.logger.debug("Removal complete")
+        return self._fetch_prefetched(self.loc, self.loc + length, fd=fd)
 
-    def _prefetch(self, file_list, prefetch_storage, path_sizes, blocksize, req_kw):
-        """Concurrently fetch data from S3 in blocks and store in cache"""
+    def iter_blocks(self):
+        """Iterate over the rest of the logical stream, one block at a time
 
-        fs = S3FileSystem()
-        s3 = fs
+        Prefetched blocks are yielded as read-only memoryviews mapping the
+        storage tiers, without copying the data. As with read, the file
+        position is past each view once it is yielded, such that reading
+        resumes after it if the iteration stops. A view is only valid until
+        the next iteration, when it is released and its block may be evicted.
+        The header and the ranges that are not prefetched are yielded as
+        views of the fetched bytes.
 
-        offset = 0
-        file_idx = 0
-        total_bytes = path_sizes[file_idx]
-        total_files = len(file_list)
-        header_bytes = self.header_bytes
+        Yields
+        ------
+        view : memoryview
+            Data of the next block (or part of block at the current position)
+        """
+        while True:
+            if self.closed:
+                raise ValueError("I/O operation on closed file.")
+            remaining = self.size - self._logical_loc()
+            if remaining <= 0:
+                return
+
+            if self.file_idx == 0 and self.loc < self.stream.pinned:
+                bid, end = None, self.stream.pinned
+            else:
+                bid, (_, end) = self._get_block(wait=False)
+            length = min(end - self.loc, remaining)
+
+            if length <= 0:
+                # e.g. a file holding only its header, move to the next file
+                self.seek(self.tell())
+                continue
+
+            view = None
+            if bid is not None:
+                cache = self.cache
+                cache.wait(bid, self.loc + length - cache.blocks[bid][1])
+                view = cache.view(bid, self.loc, length)
+
+            if view is None:
+                # views of bytes are read-only
+                yield memoryview(self.read(length))
+                continue
+
+            # the position moves past the view before it is yielded, as read
+            # does, the block is only evicted once the view is released
+            if self.trace is not None:
+                self.trace.record(self.file_idx, self.loc, length)
+            self.loc += length
+            self.eviction.accessed(bid)
+            self._finish_block(bid)
+            try:
+                yield view
+            finally:
+                cache.release(bid, view)
+
+    def read_ranges(self, ranges, max_gap=2 ** 16):
+        """Read byte ranges of the logical stream, without moving the position
+
+        Ranges of a file less than max_gap bytes apart are coalesced. The
+        coalesced ranges are read from the blocks that are prefetched or being
+        prefetched, while the rest is fetched from the source concurrently.
+        Blocks read entirely are released, as they are by read.
 
-        prefetch_space = {
-            path: {"total": space * 1024 ** 2, "used": 0}
-            for path, space in prefetch_storage
-        }
-        fetched_paths = []
+        Parameters
+        ----------
+        ranges : list of tuple (int, int)
+            (start, end) ranges of the logical stream
+        max_gap : int
+            Largest gap between coalesced ranges
 
-        # Loop until all data has been read
-        # self.s3.logger.debug("Prefetching started")
+        Returns
+        -------
+        out : list of bytes
+            Content of each range
+        """
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
 
-        for path, space in prefetch_storage:
-            if space == 0:
-                avail_cache = disk_usage(path).free
-                prefetch_space[path]["total"] = avail_cache
+        stream = self.stream
+        cache = self.cache
+
+        # logical position of the first byte of each file
+        firsts = [0] + [self.header_bytes] * (len(self.path_sizes) - 1)
+        logical = [0]
+        for size, first in zip(self.path_sizes, firsts):
+            logical.append(logical[-1] + size - first)
+
+        # (file_idx, start, end, range, position in range) of each file
+        pieces = []
+        lengths = []
+        for i, (start, end) in enumerate(ranges):
+            start, end = max(int(start), 0), min(int(end), self.size)
+            lengths.append(max(end - start, 0))
+
+            pos = start
+            while pos < end:
+                k = bisect_right(logical, pos) - 1
+                f_start = firsts[k] + pos - logical[k]
+                f_end = f_start + min(end, logical[k + 1]) - pos
+                pieces.append((k, f_start, f_end, i, pos - start))
+                pos += f_end - f_start
+
+        # coalesced ranges, as [file_idx, start, end, pieces]
+        spans = []
+        for p in sorted(range(len(pieces)), key=lambda p: pieces[p][:2]):
+            k, start, end = pieces[p][:3]
+            if spans and spans[-1][0] == k and start - spans[-1][2] <= max_gap:
+                spans[-1][2] = max(spans[-1][2], end)
+                spans[-1][3].append(p)
+            else:
+                spans.append([k, start, end, [p]])
+
+        # split spans between the pinned header, blocks and the source
+        header, cached, direct = [], [], []
+        for j, (k, start, end, _) in enumerate(spans):
+            pos = start
+            while pos < end:
+                if k == 0 and pos < stream.pinned:
+                    seg_end = min(end, stream.pinned)
+                    header.append((j, pos, seg_end))
+                    pos = seg_end
+                    continue
+
+                bid = cache.find(k, pos)
+                if bid is None:
+                    next_start = cache.next_start(k, pos)
+                    if next_start is None:
+                        next_start = self.path_sizes[k]
+                    seg_end = min(end, next_start)
+                    direct.append((j, k, pos, seg_end))
+                    pos = seg_end
+                    continue
+
+                seg_end = min(end, cache.blocks[bid][2])
+                with cache.cond:
+                    # blocks not being prefetched yet are not waited for
+                    prefetched = cache.location[bid] is not None or cache.available(
+                        bid, seg_end - cache.blocks[bid][1]
+                    )
+                if prefetched:
+                    cached.append((j, bid, pos, seg_end))
+                else:
+                    direct.append((j, k, pos, seg_end))
+                pos = seg_end
+
+        fetched = None
+        if direct:
+            fetched = stream.submit(
+                stream.fetch_ranges, [(k, start, end) for _, k, start, end in direct]
+            )
 
-        while self.fetch and file_idx < len(path_sizes) and total_bytes > offset:
+        buffers = [bytearray(end - start) for _, start, end, _ in spans]
+
+        def fill(j, pos, data):
+            offset = pos - spans[j][1]
+            buffers[j][offset : offset + len(data)] = data
+
+        for j, start, end in header:
+            data = stream.read_header(start, end)
+            if data is None:
+                data = stream.fetch_range(0, start, end)
+            fill(j, start, data)
+
+        for j, bid, start, end in cached:
+            cache.wait(bid, end - cache.blocks[bid][1])
+            data = cache.read(bid, start, end - start)
+            if data is None:
+                # the block was evicted in the meantime
+                data = stream.fetch_range(spans[j][0], start, end)
+            fill(j, start, data)
+
+        if fetched is not None:
+            for (j, _, start, _), data in zip(direct, fetched.result()):
+                fill(j, start, data)
+
+        out = [bytearray(n) for n in lengths]
+        for j, (_, start, _, ps) in enumerate(spans):
+            view = memoryview(buffers[j])
+            for p in ps:
+                _, p_start, p_end, i, offset = pieces[p]
+                out[i][offset : offset + p_end - p_start] = view[
+                    p_start - start : p_end - start
+                ]
+
+        # blocks covered entirely by the ranges are released
+        covered = {}
+        for j, bid, start, end in cached:
+            for p in spans[j][3]:
+                _, p_start, p_end = pieces[p][:3]
+                if p_start < end and p_end > start:
+                    covered.setdefault(bid, []).append(
+                        (max(p_start, start), min(p_end, end))
+                    )
+        for bid, intervals in covered.items():
+            _, b_start, b_end, _ = cache.blocks[bid]
+            pos = b_start
+            for start, end in sorted(intervals):
+                if start > pos:
+                    break
+                pos = max(pos, end)
+            self.eviction.accessed(bid)
+            if pos >= b_end:
+                self._consume(bid)
 
-            for path in prefetch_space.keys():
-                # NOTE: will use a bit of memory to read/write file. Need to warn user
-                # Prefetch to cache
+        if self.trace is not None:
+            for p in sorted(range(len(pieces)), key=lambda p: pieces[p][3:]):
+                k, start, end = pieces[p][:3]
+                self.trace.record(k, start, end - start)
 
-                # try / except as filesystem may be closed by read thread
-                try:
+        return [bytes(o) for o in out]
 
-                    avail_space = (
-                        prefetch_space[path]["total"] - prefetch_space[path]["used"]
-                    )
-                    if avail_space < blocksize:
-                        if len(fetched_paths) > 0:
-                            for i in range(len(fetched_paths)):
-                                if os.path.exists(fetched_paths[i]) or os.path.exists(
-                                    fetched_paths[i] + ".nibtodelete"
-                                ):
-                                    break
-                                elif path in fetched_paths[i]:
-                                    prefetch_space[path]["used"] -= blocksize
-                                    avail_space += blocksize
-                                    # self.s3.logger.warning(
-                                    #     "Path %s has been evicted. Used space on %s now %d/%d",
-                                    #     fetched_paths[i],
-                                    #     path,
-                                    #     prefetch_space[path]["used"],
-                                    #     prefetch_space[path]["total"],
-                                    # )
-
-                            fetched_paths = fetched_paths[i:]
-
-                    if avail_space >= blocksize:
-                        fetch_end = offset + blocksize
-
-                        if fetch_end > path_sizes[file_idx]:
-                            fetch_end = path_sizes[file_idx]
-                        # print("fetch_start", offset, "fetch_end", fetch_end)
-
-                        bucket, key, version_id = s3.split_path(file_list[file_idx])
-                        data = _fetch_range(
-                            fs,
-                            bucket,
-                            key,
-                            version_id,
-                            offset,
-                            fetch_end,
-                            req_kw=req_kw,
-                        )
-
-                        # no need to keep organizational structure of key in cache
-                        obj_name = os.path.basename(key)
-                        # only write to final path when data copy is complete
-                        tmp_path = os.path.join(path, f".{obj_name}.{offset}.tmp")
-                        final_path = os.path.join(path, f"{obj_name}.{offset}")
-                        # print(final_path)
-                        # self.s3.logger.debug("Prefetched data to %s", final_path)
-
-                        with open(tmp_path, "wb") as f:
-                            f.write(data)
-
-                        prefetch_space[path]["used"] += blocksize
-
-                        os.rename(tmp_path, final_path)
-                        fetched_paths.append(final_path)
-
-                        offset += int(blocksize)
-                    else:
-                        sleep(1)
-
-                except Exception as e:
-                    # self.s3.logger.error(
-                    #     "An error occured during prefetch process: %s", str(e)
-                    # )
-                    # pass
-                    print(str(e))
-
-                # if we have already read the entire file terminate prefetching
-                # can use walrus op here
-                if total_bytes <= offset and file_idx + 1 < total_files:
-                    # self.s3.logger.debug(
-                    #     "Prefetched all of file %s data. Moving onto next file %s",
-                    #     file_list[file_idx],
-                    #     file_list[file_idx + 1],
-                    # )
-                    file_idx += 1
-                    total_bytes = path_sizes[file_idx]
-                    offset = header_bytes
-                elif total_bytes <= offset:
-                    # self.fetch = False
-                    # self.s3.logger.debug("Prefetched all bytes")
-                    break
+    def _logical_loc(self):
+        """Position of the file pointer in the logical (concatenated) stream"""
+        return self.global_pos + self.loc - (self.header_bytes if self.file_idx > 0 else 0)
 
     # @profile
-    def _fetch_prefetched(self, start, end):
+    def _fetch_prefetched(self, start, end, fd=None):
+        """Read the range of the current file, continuing into the next files
+
+        With fd, the data is written to file descriptor fd instead of being
+        returned, and the number of bytes written is returned.
+        """
         total_read_len = end - start
-        out = b""
-
-        # print("len out", len(out), total_read_len)
-
-        while len(out) < total_read_len:
-            # print(start, end, len(out), total_read_len)
-            # self.s3.logger.debug("In _fetch_prefetched")
-            block, pos = self._get_block()
-            # print("got block")
-
-            curr_pos = block.tell()
-            read_len = int(min(end, pos[1]) - curr_pos - pos[0])
-            # print("block", block.name, curr_pos, read_len, start, end)
-            # self.s3.logger.debug(
-            #     "Reading data from cached block %s in range [%d, %d]",
-            #     block.name,
-            #     curr_pos,
-            #     curr_pos + read_len,
-            # )
-            out += block.read(read_len)
+        out = []
+        nread = 0
+
+        while nread < total_read_len:
+            header = self.file_idx == 0 and self.loc < self.stream.pinned
+
+            if header:
+                # global header is pinned in memory
+                bid, pos = None, (0, self.stream.pinned)
+            else:
+                bid, pos = self._get_block(end, wait=False)
+
+            read_len = int(min(end, pos[1]) - self.loc)
+
+            data = None
+            if header:
+                data = self.stream.read_header(self.loc, self.loc + read_len)
+            elif bid is not None and fd is not None:
+                data = self._send_block(bid, read_len, fd)
+            elif bid is not None:
+                data = self._read_block(bid, read_len)
+
+            if bid is not None and data is not None:
+                self.eviction.accessed(bid)
+
+            if data is None:
+                # range is not prefetched or was already evicted (e.g. seek
+                # backwards), get it from S3
+                data = self._fetch_direct(self.loc, self.loc + read_len)
+
+            if self.trace is not None:
+                self.trace.record(self.file_idx, self.loc, read_len)
+
+            if fd is None:
+                out.append(data)
+            elif not isinstance(data, int):
+                write_all(fd, data)
+            nread += read_len
             self.loc += read_len
             start = self.loc
 
-            # self.s3.logger.debug("Current position in block %d block size %d", start, pos[1])
-
-            if start >= pos[1]:
-                # self.s3.logger.debug(
-                #     "Block %s read entirely (current position %d). Flagging for deletion",
-                #     block.name,
-                #     self.loc,
-                # )
-                block.close()
-                self.cf_ = None
-                os.rename(block.name, f"{block.name}{self.DELETE_STR}")
+            if bid is not None and start >= pos[1]:
+                self._finish_block(bid)
 
-            # print(len(out), total_read_len, start, self.path_sizes[self.file_idx], self.file_idx, len(self.file_list))
             if start >= self.path_sizes[self.file_idx] and self.file_idx + 1 < len(
                 self.file_list
             ):
-                # self.s3.logger.debug(
-                #     "Current block %s read entirely. Loading new block %s at position %d",
-                #     self.path,
-                #     self.file_list[self.file_idx + 1],
-                #     self.header_bytes,
-                # )
-                self.global_pos += self.path_sizes[self.file_idx]
+                global_pos = self.global_pos + self.path_sizes[self.file_idx]
 
                 if self.file_idx > 0:
-                    self.global_pos -= self.header_bytes
+                    global_pos -= self.header_bytes
 
-                self.file_idx += 1
-                self.path = self.file_list[self.file_idx]
-                self.bucket, self.key, self.version_id = self.s3.split_path(self.path)
-                self.path_size = self.path_sizes[self.file_idx]
+                self._set_file(self.file_idx + 1, global_pos)
                 self.loc = self.header_bytes
                 start = self.loc
-                end = total_read_len - len(out) + self.loc
-                # print("new file start", start, "end", end)
+                end = total_read_len - nread + self.loc
+
+        if fd is not None:
+            return nread
+        return b"".join(out)
+
+    def _finish_block(self, bid):
+        """Block bid was read entirely, save the checkpoint and release it"""
+        if self.resume is not None:
+            # saved first, the block may be evicted once consumed
+            self._save_checkpoint(exclude=bid)
+        self._consume(bid)
+
+    def _consume(self, bid):
+        """Hand block bid, read entirely, to the eviction policy"""
+        cache = self.cache
+        # blocks read from the source once evicted aren't retained again
+        if cache.state[bid] not in (cache.EMPTY, cache.READY):
+            return
+
+        file_idx, start, end, _ = cache.blocks[bid]
+        logical = self.stream.logical
+        for released in self.eviction.consumed(
+            bid, end - start, logical(file_idx, start), logical(file_idx, end)
+        ):
+            self.stream.consume(self, released)
+
+    def _skip(self, previous):
+        """Release the blocks passed over by a forward seek from position previous
+
+        Skipped blocks would otherwise hold the tiers, keeping the blocks at
+        the new position from being prefetched. Blocks not prefetched yet are
+        released right away, such that they aren't fetched at all.
+        """
+        cache = self.cache
+        for bid in cache.between(previous, (self.file_idx, self.loc)):
+            if cache.location[bid] is None:
+                self.stream.consume(self, bid)
+            else:
+                self._consume(bid)
 
-        # if self.file_idx == 2 and end == 1004:
-        #    print(out)
-        #    import sys
-        #    sys.exit(1)
-        return out
+    def _make_room(self, bid):
+        """Release the blocks behind the reader that keep bid from being prefetched
+
+        Blocks are prefetched in order, such that if no tier can admit block
+        bid, the tiers only hold blocks behind it: blocks retained by the
+        eviction policy, and blocks other (lagging) readers have yet to read.
+        Both are released, lagging readers then read them from the source.
+        """
+        cache = self.cache
+        if cache.location[bid] is not None or cache.state[bid] != cache.EMPTY:
+            return
+
+        _, start, end, _ = cache.blocks[bid]
+        # space being freed is not holding the prefetcher back
+        if any(
+            not t.full(cache.used[i] - cache.pending(i), end - start)
+            for i, t in enumerate(self.stream.tiers)
+        ):
+            return
+
+        for released in self.eviction.reclaim():
+            self.stream.consume(self, released)
+        self.stream.overtake(self)
+
+    def _save_checkpoint(self, exclude=None, present=True):
+        """Save the position of the reader and the blocks present in the tiers"""
+        cache = self._stream.cache
+
+        self.checkpoint.name = cache.name
+        self.checkpoint.offset = self.tell()
+        self.checkpoint.blocks = cache.present(exclude) if present else {}
+        try:
+            self.checkpoint.save(self.resume)
+        except OSError as e:
+            # reading goes on, from scratch if interrupted
+            print(str(e))
+
+    def _remove_checkpoint(self):
+        """Delete the checkpoint of a reader that read the stream to the end"""
+        try:
+            os.remove(self.resume)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(str(e))
+
+    def _set_file(self, file_idx, global_pos):
+        """Make file file_idx, starting at global_pos in the stream, current"""
+        self.file_idx = file_idx
+        self.global_pos = global_pos
+        self.path = self.file_list[file_idx]
+        self.path_size = self.path_sizes[file_idx]
+
+    def _read_block(self, bid, length):
+        """Read length bytes at the current position from block bid
+
+        Returns None if the bytes are not available, e.g. the block was
+        evicted. Small reads race a direct read of the source while the block
+        is not being downloaded yet.
+        """
+        cache = self.cache
+        nbytes = self.loc + length - cache.blocks[bid][1]
+
+        race = None
+        if length <= self.race_bytes and not cache.available(bid, nbytes):
+            with cache.cond:
+                if cache.filled[bid] == 0 and cache.state[bid] == cache.EMPTY:
+                    race = self.stream.submit_range(
+                        self.file_idx, self.loc, self.loc + length
+                    )
+            if race is not None:
+                race.add_done_callback(lambda _: cache.notify())
+
+        cache.wait(bid, nbytes, until=None if race is None else race.done)
+
+        if race is not None and race.done() and race.exception() is None:
+            return race.result()
+        if race is not None:
+            race.cancel()
+        return cache.read(bid, self.loc, length)
+
+    def _send_block(self, bid, length, fd):
+        """Copy length bytes at the current position of block bid to fd
+
+        Returns the number of bytes copied, None if they are not available,
+        e.g. the block was evicted.
+        """
+        cache = self.cache
+        cache.wait(bid, self.loc + length - cache.blocks[bid][1])
+        return cache.sendfile(bid, self.loc, length, fd)
+
+    def _fetch_direct(self, start, end):
+        """Read a range of the current file from its source, bypassing the cache"""
+        return self.stream.fetch_range(self.file_idx, start, end)
+
+    def _fetch_range(self, start, end):
+        return self._fetch_direct(start, end)
 
     # @profile
-    def _get_block(self):
-        """Open the cached block fileobj at the necessary file offset
+    def _get_block(self, end=None, wait=True):
+        """Wait for the cached block holding the current file position
+
+        Only the block's bytes up to position end of the file (default: the
+        whole block) need to have been downloaded for it to be returned.
+        Without wait, the block is returned right away.
+
         Returns
         -------
-        cf_ : fileobj
-            Fileobj of the cached file (returns None if it does not exist)
+        bid : int
+            Id of the block in the cache, None if the position is not
+            prefetched
         k : tuple (int, int)
-            The positioning of the opened block respective to the original file
+            The positioning of the block respective to the original file. If
+            the position is not prefetched, the range up to the next block
         """
-        # Get the list of files in cache
-
-        # fn_prefix = os.path.basename(self.path)
-
-        pf_dirs = [p[0] for p in self.prefetch_storage]
-        bid = [
-            (i * int(self.blocksize)) + (self.header_bytes if self.file_idx > 0 else 0)
-            for i in range(0, int(self.path_sizes[self.file_idx] // self.blocksize) + 1)
-            if self.loc - self.blocksize < i * self.blocksize
-        ][0]
-        # self.s3.logger.debug("in get_block %d", max([ i for i in range(0, self.path_sizes[self.file_idx] + 1, self.blocksize)]))
-        cached_files = [
-            os.path.join(fs, f"{os.path.basename(self.key)}.{bid}") for fs in pf_dirs
+        bid = self.cache.find(self.file_idx, self.loc)
+
+        if bid is None:
+            next_start = self.cache.next_start(self.file_idx, self.loc)
+            if next_start is None:
+                next_start = self.path_sizes[self.file_idx]
+            return None, (self.loc, next_start)
+
+        self._make_room(bid)
+
+        _, b_start, b_end, _ = self.cache.blocks[bid]
+        if wait:
+            nbytes = None if end is None else min(end, b_end) - b_start
+            self.cache.wait(bid, nbytes)
+
+        return bid, (b_start, b_end)
+
+
+class S3PrefetchFile(PrefetchFile, S3File):
+
+    # @profile
+    def __init__(
+        self,
+        s3,
+        path,
+        mode="rb",
+        prefetch_storage=None,
+        block_size=5 * 2 ** 20,
+        acl="",
+        version_id=None,
+        fill_cache=False,
+        s3_additional_kwargs=None,
+        autocommit=True,
+        cache_type="none",
+        requester_pays=False,
+        header_bytes=0,
+        high_watermark=1.0,
+        low_watermark=None,
+        memory_reserve=0.1,
+        plan=None,
+        record=None,
+        replay=None,
+        resume=None,
+        race_bytes=2 ** 16,
+        eviction=None,
+        path_sizes=None,
+    ):
+        super().__init__(
+            s3,
+            path,
+            mode,
+            block_size=block_size,
+            prefetch_storage=prefetch_storage,
+            header_bytes=header_bytes,
+            high_watermark=high_watermark,
+            low_watermark=low_watermark,
+            memory_reserve=memory_reserve,
+            plan=plan,
+            record=record,
+            replay=replay,
+            resume=resume,
+            race_bytes=race_bytes,
+            eviction=eviction,
+            path_sizes=path_sizes,
+            acl=acl,
+            version_id=version_id,
+            fill_cache=fill_cache,
+            s3_additional_kwargs=s3_additional_kwargs,
+            autocommit=autocommit,
+            cache_type=cache_type,
+            requester_pays=requester_pays,
+        )
+
+    def _set_file(self, file_idx, global_pos):
+        super()._set_file(file_idx, global_pos)
+        self.bucket, self.key, self.version_id = self.s3.split_path(self.path)
+
+
+class S3UploadFile(S3File):
+    """S3 file written with a rolling parallel multipart upload
+
+    Every block written is staged as a part in the prefetch storage tiers and
+    uploaded in the background, up to concurrency parts at once, while the
+    producer keeps writing. Writes block once the tiers are full, until parts
+    have been uploaded.
+    """
+
+    def __init__(
+        self,
+        s3,
+        path,
+        mode="wb",
+        block_size=5 * 2 ** 20,
+        acl=False,
+        s3_additional_kwargs=None,
+        autocommit=True,
+        requester_pays=False,
+        prefetch_storage=None,
+        high_watermark=1.0,
+        low_watermark=None,
+        memory_reserve=0.1,
+        concurrency=4,
+    ):
+        # set before anything can fail, as close is called on deletion
+        self.uploads = None
+
+        self.tiers = [
+            Tier(p, space, high_watermark, low_watermark, memory_reserve)
+            for p, space in prefetch_storage or S3PrefetchFileSystem.default_prefetch_storage
         ]
+        if getattr(s3, "calibrate_tiers", False):
+            # parts are staged in the fastest tier with space
+            self.tiers = order_tiers(self.tiers)
+        self.concurrency = concurrency
 
-        # self.s3.logger.debug("looking for %s", cached_files[0])
-
-        if self.cf_ is not None and self.loc >= self.b_start and self.loc < self.b_end:
-            # self.cf_.seek
-            # self.s3.logger.debug(
-            #     "Position %d is found in currently loaded file %s which spans ranges [%d, %d]",
-            #     self.loc,
-            #     self.cf_.name,
-            #     self.b_start,
-            #     self.b_end,
-            # )
-            return self.cf_, (self.b_start, self.b_end)
-        try:
-            self.cf_.close()
-            self.cf_ = None
-        except Exception as e:
-            # self.s3.logger.warning("Was not able to close block. exception: %s", str(e))
-            self.cf_ = None
-            pass
+        super().__init__(
+            s3,
+            path,
+            mode,
+            block_size=block_size,
+            acl=acl,
+            s3_additional_kwargs=s3_additional_kwargs,
+            autocommit=autocommit,
+            requester_pays=requester_pays,
+        )
 
-        # Iterate through the cached files/offsets
-        # Possible infinite loop if file gets deleted before it's accessed
-        while True:
-            for f in cached_files:
-                try:
-                    b_start = int(f.split(".")[-1])
-                    b_end = min(
-                        min(b_start + self.blocksize, self.path_sizes[self.file_idx]),
-                        self.size,
-                    )
+    def _initiate_upload(self):
+        super()._initiate_upload()
+
+        if self.mpu is not None:
+            self.uploads = UploadStream(
+                self.fs,
+                self.bucket,
+                self.key,
+                self.mpu["UploadId"],
+                self.tiers,
+                concurrency=self.concurrency,
+                # the existing object may have been copied as the first part
+                first_part=len(self.parts) + 1,
+                s3_additional_kwargs=self.s3_additional_kwargs,
+            )
+
+    def _upload_chunk(self, final=False):
+        if self.uploads is not None:
+            self.buffer.seek(0)
+            left = len(self.buffer.getbuffer())
+
+            # only the last part may be smaller than the block size
+            min_chunk = 1 if final else self.blocksize
+            try:
+                while left >= min_chunk:
+                    data = self.buffer.read(self.blocksize)
+                    self.uploads.stage(data)
+                    left -= len(data)
+            except Exception:
+                # a failed part fails the whole upload, closing then only
+                # releases the file
+                self.discard()
+                self.forced = True
+                raise
+
+        if self.autocommit and final:
+            self.commit()
+        else:
+            self.offset += self.buffer.tell()
+            self.buffer = io.BytesIO(self.buffer.read())
+            self.buffer.seek(0, 2)
+
+        return False
+
+    def commit(self):
+        if self.uploads is not None:
+            try:
+                self.parts.extend(self.uploads.finish())
+            except Exception:
+                self._abort_mpu()
+                raise
+            finally:
+                self.uploads = None
+        super().commit()
+
+    def discard(self):
+        if self.uploads is not None:
+            self.uploads.close()
+            self.uploads = None
+        super().discard()
 
-                    # self.s3.logger.debug(
-                    #     "Position %d found in block %s with range [%d, %d]",
-                    #     self.loc,
-                    #     f,
-                    #     b_start,
-                    #     b_end,
-                    # )
-
-                    self.cf_ = open(f, "rb")
-                    self.b_start = b_start
-                    self.b_end = b_end
-                    # self.cf_.seek(b_start, os.SEEK_SET)
-                    return self.cf_, (self.b_start, self.b_end)
-                except Exception as e:
-                    # self.s3.logger.warning(
-                    #     "Exception occured while opening block at position %d: %s %d",
-                    #     self.loc,
-                    #     str(e),
-                    #     self.loc - self.blocksize
-                    # )
-                    self.cf_ = None
-                    self.b_start = None
-                    self.b_end = None
-
-                sleep(0.1)
-
-        # self.s3.logger.error("Position %d not found in any cached block", self.loc)
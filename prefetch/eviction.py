@@ -0,0 +1,164 @@
+from collections import OrderedDict
+
+
+class EvictionPolicy:
+    """When the blocks read by a reader are released for eviction
+
+    Readers hand every block they have read entirely to their policy, which
+    returns the blocks to release. Blocks retained by the policy stay in the
+    storage tiers, such that reading them again (e.g. after a short backward
+    seek) doesn't fetch them from the source. Retained blocks use tier space
+    that is no longer available to prefetch ahead of the reader, they are all
+    released by reclaim if the tiers are too full to prefetch the next block.
+
+    The base policy releases blocks as soon as they are read.
+    """
+
+    def consumed(self, bid, nbytes, start, end):
+        """Block bid of nbytes, range [start, end) of the logical stream, was read
+
+        Returns
+        -------
+        bids : list of int
+            Blocks to release
+        """
+        return [bid]
+
+    def accessed(self, bid):
+        """Block bid was read from"""
+
+    def reclaim(self):
+        """Release the retained blocks the policy can give up
+
+        Returns
+        -------
+        bids : list of int
+            Blocks to release
+        """
+        return []
+
+
+class KeepLastBlocks(EvictionPolicy):
+    """Retain the last k blocks read
+
+    Parameters
+    ----------
+    k : int
+        Number of blocks retained
+    """
+
+    def __init__(self, k):
+        if k < 0:
+            raise ValueError("k must be positive")
+        self.k = k
+        # bytes of the retained blocks, in the order they were read
+        self.retained = OrderedDict()
+
+    def consumed(self, bid, nbytes, start, end):
+        self.retained[bid] = nbytes
+        self.retained.move_to_end(bid)
+
+        released = []
+        while len(self.retained) > self.k:
+            released.append(self.retained.popitem(last=False)[0])
+        return released
+
+    def reclaim(self):
+        released, self.retained = list(self.retained), OrderedDict()
+        return released
+
+
+class LRUEviction(EvictionPolicy):
+    """Retain the most recently used blocks read, up to budget bytes
+
+    Parameters
+    ----------
+    budget : int
+        Space of the retained blocks in MiB
+    """
+
+    def __init__(self, budget):
+        if budget < 0:
+            raise ValueError("budget must be positive")
+        self.budget = int(budget * 1024 ** 2)
+        self.used = 0
+        # bytes of the retained blocks, least recently used first
+        self.retained = OrderedDict()
+
+    def consumed(self, bid, nbytes, start, end):
+        if bid not in self.retained:
+            self.used += nbytes
+        self.retained[bid] = nbytes
+        self.retained.move_to_end(bid)
+
+        released = []
+        while self.used > self.budget:
+            released_bid, released_bytes = self.retained.popitem(last=False)
+            self.used -= released_bytes
+            released.append(released_bid)
+        return released
+
+    def accessed(self, bid):
+        if bid in self.retained:
+            self.retained.move_to_end(bid)
+
+    def reclaim(self):
+        released, self.retained, self.used = list(self.retained), OrderedDict(), 0
+        return released
+
+
+class PinnedRanges(EvictionPolicy):
+    """Retain the blocks overlapping ranges of the logical stream until closed
+
+    Pinned blocks are never reclaimed, they must fit in the storage tiers
+    along with the blocks prefetched ahead of the reader.
+
+    Parameters
+    ----------
+    ranges : list of tuple (int, int)
+        (start, end) ranges of the logical stream
+    policy : EvictionPolicy
+        Policy of the other blocks (default: released once read)
+    """
+
+    def __init__(self, ranges, policy=None):
+        self.ranges = [(int(start), int(end)) for start, end in ranges]
+        self.policy = EvictionPolicy() if policy is None else policy
+
+    def consumed(self, bid, nbytes, start, end):
+        if any(r_start < end and start < r_end for r_start, r_end in self.ranges):
+            return []
+        return self.policy.consumed(bid, nbytes, start, end)
+
+    def accessed(self, bid):
+        self.policy.accessed(bid)
+
+    def reclaim(self):
+        return self.policy.reclaim()
+
+
+def get_policy(eviction):
+    """Eviction policy of the eviction argument of open
+
+    Parameters
+    ----------
+    eviction : EvictionPolicy, str or None
+        Policy, or one of "immediate" (default), "keep-last:K" and "lru:MiB"
+    """
+    if eviction is None or eviction == "immediate":
+        return EvictionPolicy()
+    if isinstance(eviction, EvictionPolicy):
+        return eviction
+
+    name, _, arg = str(eviction).partition(":")
+    try:
+        if name == "keep-last":
+            return KeepLastBlocks(int(arg))
+        if name == "lru":
+            return LRUEviction(float(arg))
+    except ValueError:
+        pass
+    raise ValueError(
+        f"Invalid eviction policy {eviction}, expected 'immediate', "
+        "'keep-last:K', 'lru:MiB' or an EvictionPolicy"
+    )
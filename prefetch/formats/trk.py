@@ -0,0 +1,245 @@
+"""Streaming TrackVis (TRK) reader
+
+Streamlines are parsed from large reads of a file object (e.g. a
+S3PrefetchFile) straight into contiguous numpy arrays, batch by batch,
+instead of issuing small reads and building Python objects per streamline.
+Records that straddle two reads (and hence blocks or parts of a multi-part
+file) are carried over to the next batch.
+
+Points are returned as stored in the file, in TrackVis voxmm space.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+
+HEADER_SIZE = 1000
+
+header_dtype = np.dtype(
+    [
+        ("id_string", "S6"),
+        ("dimensions", "i2", 3),
+        ("voxel_sizes", "f4", 3),
+        ("origin", "f4", 3),
+        ("nb_scalars_per_point", "i2"),
+        ("scalar_name", "S20", 10),
+        ("nb_properties_per_streamline", "i2"),
+        ("property_name", "S20", 10),
+        ("voxel_to_rasmm", "f4", (4, 4)),
+        ("reserved", "S444"),
+        ("voxel_order", "S4"),
+        ("pad2", "S4"),
+        ("image_orientation_patient", "f4", 6),
+        ("pad1", "S2"),
+        ("invert_x", "S1"),
+        ("invert_y", "S1"),
+        ("invert_z", "S1"),
+        ("swap_xy", "S1"),
+        ("swap_yz", "S1"),
+        ("swap_zx", "S1"),
+        ("nb_streamlines", "i4"),
+        ("version", "i4"),
+        ("hdr_size", "i4"),
+    ]
+)
+
+StreamlineBatch = namedtuple(
+    "StreamlineBatch", ["points", "scalars", "properties", "offsets", "lengths"]
+)
+StreamlineBatch.__doc__ = """Streamlines parsed from a TRK file
+
+points : (n_points, 3) float32 array of the points of all streamlines
+scalars : (n_points, nb_scalars_per_point) float32 array
+properties : (n_streamlines, nb_properties_per_streamline) float32 array
+offsets : (n_streamlines,) int64 array, index of each streamline's first point
+lengths : (n_streamlines,) int64 array, number of points of each streamline
+"""
+
+
+def read_header(f):
+    """Read the TRK header at the current position of f
+
+    Returns
+    -------
+    header : numpy.void
+        Header fields, named as in nibabel. Its dtype has the byte order of
+        the file
+    """
+    buf = f.read(HEADER_SIZE)
+    if len(buf) < HEADER_SIZE:
+        raise ValueError("File is too small to be a TRK file")
+
+    for dtype in (header_dtype.newbyteorder("<"), header_dtype.newbyteorder(">")):
+        header = np.frombuffer(buf, dtype=dtype)[0]
+        if header["hdr_size"] == HEADER_SIZE:
+            break
+    else:
+        raise ValueError("Invalid TRK header size")
+
+    if not header["id_string"].startswith(b"TRACK"):
+        raise ValueError("Not a TRK file")
+
+    return header
+
+
+def _scan(ints, point_words, n_properties, remaining):
+    """Find the complete records at the start of ints, a native int32 array
+
+    Records are chained, the first word of each giving the number of points,
+    hence the position of the next one, such that they are found one at a
+    time. Words are read through a memoryview, which yields Python ints much
+    faster than indexing the array: about 2 million records per second, i.e.
+    over 1 GiB/s with 100-point streamlines, a fraction of the parsing time.
+
+    Returns the start of each record, and the number of words they span
+    """
+    words = memoryview(ints.view(np.uint8)).cast("i")
+    nwords = len(words)
+    fixed = 1 + n_properties
+    starts = []
+    append = starts.append
+    pos = 0
+
+    try:
+        for _ in range(remaining if remaining >= 0 else nwords):
+            end = pos + fixed + words[pos] * point_words
+            if end > nwords:
+                break
+            append(pos)
+            pos = end
+    except IndexError:
+        # all words were scanned
+        pass
+
+    return np.array(starts, dtype=np.int64), pos
+
+
+def _parse(buf, header, remaining, points=True):
+    """Parse the complete records at the start of buf
+
+    Returns the batch and the number of bytes it spans
+    """
+    # use the byte order of the file
+    int_dtype = header.dtype["hdr_size"]
+    float_dtype = header.dtype["voxel_sizes"].base
+    n_scalars = int(header["nb_scalars_per_point"])
+    n_properties = int(header["nb_properties_per_streamline"])
+    point_words = 3 + n_scalars
+
+    words = np.frombuffer(buf, dtype=int_dtype, count=len(buf) // 4)
+    # files of the other byte order are swapped before the scan
+    ints = words.astype(np.int32, copy=False)
+    starts, nwords = _scan(ints, point_words, n_properties, remaining)
+    lengths = ints[starts].astype(np.int64)
+
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    total = int(lengths.sum())
+
+    if not points:
+        return StreamlineBatch(None, None, None, offsets, lengths), nwords * 4
+
+    floats = words[:nwords].view(float_dtype)
+
+    # word index of the first value of every point
+    point_idx = np.repeat(starts + 1, lengths) + (
+        np.arange(total, dtype=np.int64) - np.repeat(offsets, lengths)
+    ) * point_words
+
+    batch = StreamlineBatch(
+        floats[point_idx[:, None] + np.arange(3)].astype(np.float32),
+        floats[point_idx[:, None] + 3 + np.arange(n_scalars)].astype(np.float32),
+        floats[
+            (starts + 1 + lengths * point_words)[:, None] + np.arange(n_properties)
+        ].astype(np.float32),
+        offsets,
+        lengths,
+    )
+    return batch, nwords * 4
+
+
+def iter_batches(f, header=None, read_size=None, points=True):
+    """Iterate over the streamlines of a TRK file in batches
+
+    Parameters
+    ----------
+    f : file object
+        Binary file positioned at the start of the TRK file, or after its
+        header if header is given
+    header : numpy.void
+        Header previously read with read_header
+    read_size : int
+        Number of bytes read per batch (default: the block size of f, 32 MiB
+        otherwise)
+    points : bool
+        Parse the points, scalars and properties of the streamlines. Only
+        the offsets and lengths of the batches are set otherwise
+
+    Yields
+    ------
+    batch : StreamlineBatch
+        Streamlines whose records are complete in the data read so far
+    """
+    if header is None:
+        header = read_header(f)
+    if read_size is None:
+        read_size = getattr(f, "blocksize", None) or 32 * 2 ** 20
+
+    remaining = int(header["nb_streamlines"]) or -1
+    leftover = b""
+
+    while remaining != 0:
+        data = f.read(read_size)
+        if not data:
+            break
+
+        buf = leftover + data if leftover else data
+        batch, nbytes = _parse(buf, header, remaining, points=points)
+        leftover = buf[nbytes:]
+
+        if len(batch.lengths):
+            remaining -= len(batch.lengths)
+            yield batch
+
+    if remaining != 0 and len(leftover) >= 4:
+        raise ValueError("TRK file ended in the middle of a streamline")
+
+
+def _empty(header):
+    return StreamlineBatch(
+        np.empty((0, 3), dtype=np.float32),
+        np.empty((0, int(header["nb_scalars_per_point"])), dtype=np.float32),
+        np.empty((0, int(header["nb_properties_per_streamline"])), dtype=np.float32),
+        np.empty(0, dtype=np.int64),
+        np.empty(0, dtype=np.int64),
+    )
+
+
+def load(f, header=None, read_size=None):
+    """Read all streamlines of a TRK file into a single StreamlineBatch"""
+    if header is None:
+        header = read_header(f)
+
+    batches = [_empty(header)]
+    batches.extend(iter_batches(f, header=header, read_size=read_size))
+
+    lengths = np.concatenate([b.lengths for b in batches])
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+
+    return StreamlineBatch(
+        np.concatenate([b.points for b in batches]),
+        np.concatenate([b.scalars for b in batches]),
+        np.concatenate([b.properties for b in batches]),
+        offsets,
+        lengths,
+    )
+
+
+def count_nodes(f, header=None, read_size=None):
+    """Number of points of every streamline, without parsing the points"""
+    lengths = [
+        b.lengths
+        for b in iter_batches(f, header=header, read_size=read_size, points=False)
+    ]
+    return np.concatenate(lengths) if lengths else np.empty(0, dtype=np.int64)
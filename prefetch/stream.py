@@ -0,0 +1,566 @@
+import os
+import asyncio
+import threading
+from time import monotonic
+from uuid import uuid4
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from s3fs import S3FileSystem
+from s3fs.core import _fetch_range, version_id_kw
+from fsspec.asyn import sync
+
+from .cache import BlockCache, block_layout
+
+
+def _stream_range(
+    fs,
+    bucket,
+    key,
+    version_id,
+    start,
+    end,
+    sink,
+    req_kw=None,
+    chunk_size=2 ** 20,
+    inflight=None,
+):
+    """Stream bytes [start, end) of an S3 object into sink chunk by chunk
+
+    Unlike s3fs' _fetch_range, the response body is never materialized as a
+    whole: sink(data, pos) is called for each chunk with its position
+    relative to start. Interrupted transfers resume from the last byte
+    received. Returns the number of bytes streamed.
+
+    With inflight, a set, the future of the transfer is kept in it while it
+    runs such that it can be cancelled from another thread.
+    """
+    if start >= end:
+        return 0
+    if inflight is None:
+        return sync(
+            fs.loop,
+            _inner_stream,
+            fs,
+            bucket,
+            key,
+            version_id,
+            start,
+            end,
+            sink,
+            req_kw or {},
+            chunk_size,
+        )
+
+    future = asyncio.run_coroutine_threadsafe(
+        _inner_stream(
+            fs, bucket, key, version_id, start, end, sink, req_kw or {}, chunk_size
+        ),
+        fs.loop,
+    )
+    inflight.add(future)
+    try:
+        return future.result()
+    finally:
+        inflight.discard(future)
+
+
+async def _inner_stream(fs, bucket, key, version_id, start, end, sink, req_kw, chunk_size):
+    pos = start
+    body = None
+    retries = 0
+
+    try:
+        while pos < end:
+            try:
+                if body is None:
+                    resp = await fs._call_s3(
+                        "get_object",
+                        Bucket=bucket,
+                        Key=key,
+                        Range="bytes=%i-%i" % (pos, end - 1),
+                        **version_id_kw(version_id),
+                        **req_kw,
+                    )
+                    body = resp["Body"]
+
+                data = await body.read(min(chunk_size, end - pos))
+                if not data:
+                    raise EOFError(f"Stream of {bucket}/{key} ended at {pos}/{end}")
+            except (FileNotFoundError, PermissionError):
+                raise
+            except Exception:
+                if body is not None:
+                    body.close()
+                    body = None
+                retries += 1
+                if retries > fs.retries:
+                    raise
+                continue
+
+            # errors from the sink are not retried
+            sink(data, pos - start)
+            pos += len(data)
+    finally:
+        if body is not None:
+            body.close()
+
+    return pos - start
+
+
+def _fetch(fs, path, start, end, req_kw=None):
+    """Fetch bytes [start, end) of path from any fsspec filesystem"""
+    if isinstance(fs, S3FileSystem):
+        bucket, key, version_id = fs.split_path(path)
+        return _fetch_range(fs, bucket, key, version_id, start, end, req_kw=req_kw)
+    return fs.cat_file(path, start=start, end=end)
+
+
+def _read_range(fs, path, start, end, sink, req_kw=None, inflight=None):
+    """Write bytes [start, end) of path to sink, returns the number of bytes
+
+    S3 responses are streamed into sink as they arrive, and can be cancelled
+    through inflight (see _stream_range). Other filesystems write the whole
+    range at once.
+    """
+    if isinstance(fs, S3FileSystem):
+        bucket, key, version_id = fs.split_path(path)
+        return _stream_range(
+            fs,
+            bucket,
+            key,
+            version_id,
+            start,
+            end,
+            sink,
+            req_kw=req_kw,
+            inflight=inflight,
+        )
+
+    data = _fetch(fs, path, start, end)
+    sink(data, 0)
+    return len(data)
+
+
+class PrefetchStream:
+    """Prefetch engine shared by all readers of a list of files
+
+    A prefetch thread fills the stream's BlockCache ahead of its readers and
+    an evict thread releases the blocks they have read. A block is only
+    evicted once every attached reader has read it entirely, such that the
+    slowest reader sets the pace of eviction.
+
+    With header_bytes, the global header (the first header_bytes of the first
+    file) is fetched first and pinned in memory for the lifetime of the stream
+    rather than cached as a block, as readers often seek back to it.
+
+    Parameters
+    ----------
+    fs : AbstractFileSystem
+        Filesystem to fetch the files from
+    file_list : list of str
+        Sequentially-related files making up the stream
+    path_sizes : list of int
+        Size of each file in bytes
+    blocksize : int
+        Size of the prefetched blocks
+    tiers : list of Tier
+        Storage tiers to prefetch to
+    header_bytes : int
+        Header size skipped in all files but the first
+    req_kw : dict
+        Additional arguments passed to S3 requests
+    ranges : list of tuple (int, int, int)
+        (file_idx, start, end) ranges to prefetch in order, instead of the
+        files in their entirety
+    resume : Checkpoint
+        Checkpoint of a previous run, whose blocks still present in the tiers
+        are reused. Prefetching restarts from its offset.
+    """
+
+    def __init__(
+        self,
+        fs,
+        file_list,
+        path_sizes,
+        blocksize,
+        tiers,
+        header_bytes=0,
+        req_kw=None,
+        ranges=None,
+        resume=None,
+    ):
+        self.fs = fs
+        self.file_list = list(file_list)
+        self.path_sizes = list(path_sizes)
+        self.blocksize = blocksize
+        self.tiers = tiers
+        self.header_bytes = header_bytes
+        self.req_kw = dict(req_kw or {})
+
+        self.size = (
+            sum(
+                self.path_sizes[i] - self.header_bytes
+                for i in range(len(self.path_sizes))
+            )
+            + self.header_bytes
+        )
+
+        # global header, served from memory
+        self.pinned = min(self.header_bytes, self.path_sizes[0]) if self.path_sizes else 0
+        self.header = None
+        self.header_ready = threading.Event()
+
+        name = os.path.basename(fs._strip_protocol(self.file_list[0]).rstrip("/"))
+        if resume is None or resume.name is None:
+            name = f"{name}.{uuid4().hex[:8]}"
+        else:
+            # the cache files of the previous run are reused
+            name = resume.name
+        self.cache = BlockCache(
+            name,
+            [t.path for t in self.tiers],
+            block_layout(
+                self.path_sizes,
+                self.blocksize,
+                self.header_bytes,
+                ranges=ranges,
+                pinned_header=self.pinned > 0,
+            ),
+            size=self.size,
+        )
+
+        if resume is not None:
+            tier_idx = {t.path: i for i, t in enumerate(self.tiers)}
+            self.cache.adopt(
+                {
+                    int(bid): tier_idx[path]
+                    for bid, path in resume.blocks.items()
+                    if path in tier_idx
+                },
+                skip=[
+                    bid
+                    for bid, (file_idx, _, end, _) in enumerate(self.cache.blocks)
+                    if self.logical(file_idx, end) <= resume.offset
+                ],
+            )
+
+        # blocks read entirely by each attached reader
+        self.readers = {}
+        # holders keeping the stream open without reading it
+        self.holders = set()
+        self.lock = threading.Lock()
+        self.fetch = True
+        # transfers of the prefetch thread, cancelled on close
+        self.inflight = set()
+        # reads racing the prefetch thread, see submit_range
+        self._pool = None
+        # set by the filesystem registry the stream belongs to
+        self.key = None
+
+        self.fetch_thread = threading.Thread(target=self._prefetch)
+        self.evict_thread = threading.Thread(target=self._remove)
+
+    @property
+    def closed(self):
+        return not self.fetch
+
+    def start(self):
+        """Launch the prefetch and evict threads"""
+        self.fetch_thread.start()
+        self.evict_thread.start()
+
+    def close(self, timeout=5):
+        """Stop prefetching and delete the cache
+
+        In-flight transfers are cancelled and the threads are given up to
+        timeout seconds to complete. The cache is deleted before returning,
+        such that the space of the tiers is released even if the prefetch
+        thread is still blocked fetching a block, which is then discarded.
+        """
+        self.fetch = False
+
+        for future in list(self.inflight):
+            future.cancel()
+        with self.lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+        self.cache.notify()
+
+        deadline = monotonic() + timeout
+        for thread in (self.fetch_thread, self.evict_thread):
+            while thread.is_alive() and thread is not threading.current_thread():
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                # a transfer registered after the cancellation above, e.g. by
+                # a prefetch started before fetch was cleared, is cancelled too
+                for future in list(self.inflight):
+                    future.cancel()
+                thread.join(min(remaining, 0.1))
+
+        self.cache.close()
+
+    def attach(self, reader, passive=False):
+        """Register a new reader of the stream
+
+        A passive reader keeps the stream open, e.g. to prefetch files before
+        they are opened, but never holds back the eviction of blocks.
+        """
+        with self.lock:
+            if passive:
+                self.holders.add(id(reader))
+            else:
+                self.readers[id(reader)] = set()
+
+    def detach(self, reader):
+        """Unregister a reader, returns the number of readers left
+
+        Returns None if the reader was not attached to the stream
+        """
+        with self.lock:
+            if id(reader) in self.holders:
+                self.holders.discard(id(reader))
+            elif self.readers.pop(id(reader), None) is None:
+                return None
+            else:
+                # blocks may only have been waiting on this reader
+                self._release(set().union(*self.readers.values()))
+            return len(self.readers) + len(self.holders)
+
+    def consume(self, reader, bid):
+        """Flag block bid as read entirely by reader"""
+        with self.lock:
+            consumed = self.readers.get(id(reader))
+            if consumed is None:
+                return
+
+            # blocks released by overtake are not held again
+            if self.cache.state[bid] in (self.cache.EMPTY, self.cache.READY):
+                consumed.add(bid)
+                self._release((bid,))
+
+    def overtake(self, reader):
+        """Release the blocks read by reader that lagging readers still hold
+
+        Called once these blocks keep reader from prefetching further, the
+        lagging readers then fetch them from the source.
+        """
+        with self.lock:
+            consumed = self.readers.get(id(reader))
+            if not consumed:
+                return
+
+            for bid in list(consumed):
+                for c in self.readers.values():
+                    c.discard(bid)
+                self.cache.consume(bid)
+
+    def stage(self, concurrency=16):
+        """Fetch blocks in order, concurrently, until the tiers are full
+
+        Used instead of start to fill the cache once, e.g. ahead of a job.
+        Blocks that fail to download are left empty. Returns the number of
+        bytes fetched.
+        """
+        cache = self.cache
+        futures = []
+
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+            for bid, (_, start, end, _) in enumerate(cache.blocks):
+                tier = next(
+                    (
+                        t
+                        for t in range(len(self.tiers))
+                        if self.tiers[t].admit(cache.used[t], end - start)
+                    ),
+                    None,
+                )
+                if tier is None:
+                    break
+
+                # space is reserved upfront, blocks are then fetched concurrently
+                if not cache.allocate(bid, tier):
+                    continue
+                futures.append(pool.submit(self._stage_block, bid))
+
+        staged = 0
+        for future in futures:
+            try:
+                staged += future.result()
+            except Exception as e:
+                print(str(e))
+        return staged
+
+    def _stage_block(self, bid):
+        file_idx, start, end, _ = self.cache.blocks[bid]
+        _read_range(
+            self.fs,
+            self.file_list[file_idx],
+            start,
+            end,
+            partial(self.cache.write, bid),
+            req_kw=self.req_kw,
+        )
+        self.cache.complete(bid)
+        return end - start
+
+    def logical(self, file_idx, pos):
+        """Position in the logical stream of position pos of file file_idx"""
+        first = self.header_bytes if file_idx > 0 else 0
+        return (
+            sum(self.path_sizes[:file_idx])
+            - self.header_bytes * max(file_idx - 1, 0)
+            + pos
+            - first
+        )
+
+    def fetch_range(self, file_idx, start, end):
+        """Read a range of file file_idx from its source, bypassing the cache"""
+        return _fetch(
+            self.fs, self.file_list[file_idx], start, end, req_kw=self.req_kw
+        )
+
+    def fetch_ranges(self, ranges):
+        """Read (file_idx, start, end) ranges from their source in one batch
+
+        Filesystems with async implementations fetch the ranges concurrently.
+        """
+        return self.fs.cat_ranges(
+            [self.file_list[file_idx] for file_idx, _, _ in ranges],
+            [start for _, start, _ in ranges],
+            [end for _, _, end in ranges],
+            on_error="raise",
+        )
+
+    def submit(self, fn, *args):
+        """Call fn(*args) in the background, returns its Future"""
+        with self.lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=4)
+            return self._pool.submit(fn, *args)
+
+    def submit_range(self, file_idx, start, end):
+        """Read a range like fetch_range in the background, returns its Future"""
+        return self.submit(self.fetch_range, file_idx, start, end)
+
+    def read_header(self, start, end):
+        """Read a range of the pinned global header
+
+        Returns None if the header could not be fetched
+        """
+        self.header_ready.wait()
+
+        if self.header is None:
+            return None
+        return self.header[start:end]
+
+    def _release(self, bids):
+        for bid in bids:
+            if all(bid in c for c in self.readers.values()):
+                for c in self.readers.values():
+                    c.discard(bid)
+                self.cache.consume(bid)
+
+    def _write(self, bid, data, pos):
+        # transfers the close could not cancel are aborted at the next chunk
+        if not self.fetch:
+            raise ValueError("I/O operation on closed stream.")
+        self.cache.write(bid, data, pos)
+
+    def _relieve(self):
+        """Shrink the lookahead of tiers holding more than their capacity
+
+        Under memory pressure the capacity of memory-backed tiers drops below
+        what they hold, the blocks prefetched furthest ahead are then dropped.
+        Prefetching resumes once the pressure drops below the low watermark.
+        """
+        for tier, t in enumerate(self.tiers):
+            excess = t.excess(self.cache.used[tier])
+            if excess:
+                self.cache.drop(tier, excess)
+
+    def _remove(self):
+        """Release the space of consumed blocks until the stream is closed"""
+        cache = self.cache
+
+        while self.fetch:
+            try:
+                self._relieve()
+                cache.evict()
+            except Exception as e:
+                # the cache may have been closed once the close deadline passed
+                if self.fetch:
+                    print(str(e))
+            with cache.cond:
+                cache.cond.wait(1)
+
+        # the prefetch thread may still be writing to the cache
+        if self.fetch_thread.is_alive():
+            self.fetch_thread.join()
+
+        cache.close()
+
+    def _prefetch(self):
+        """Concurrently fetch data in blocks and store in cache"""
+
+        fs = self.fs
+        cache = self.cache
+        tiers = self.tiers
+
+        bid = 0
+        total_blocks = len(cache.blocks)
+
+        if self.pinned:
+            try:
+                self.header = self.fetch_range(0, 0, self.pinned)
+            except Exception as e:
+                # readers fall back to fetching the header themselves
+                print(str(e))
+            finally:
+                self.header_ready.set()
+
+        # Loop until all data has been read
+        while self.fetch and bid < total_blocks:
+
+            # blocks adopted from a previous run, or skipped, are not fetched
+            if cache.state[bid] != cache.EMPTY:
+                bid += 1
+                continue
+
+            for tier in range(len(tiers)):
+                # Prefetch to cache
+
+                # try / except as the cache may be closed by the evict thread
+                try:
+                    file_idx, start, end, _ = cache.blocks[bid]
+
+                    if tiers[tier].admit(cache.used[tier], end - start):
+                        # response body is streamed straight into the tier
+                        if not cache.allocate(bid, tier):
+                            # released before being prefetched, e.g. skipped
+                            break
+                        _read_range(
+                            fs,
+                            self.file_list[file_idx],
+                            start,
+                            end,
+                            partial(self._write, bid),
+                            req_kw=self.req_kw,
+                            inflight=self.inflight,
+                        )
+                        cache.complete(bid)
+
+                        bid += 1
+                    else:
+                        # woken up early when blocks are evicted
+                        with cache.cond:
+                            cache.cond.wait(1)
+
+                except Exception as e:
+                    # transfers cancelled by close are not errors
+                    if self.fetch:
+                        print(str(e))
+
+                # if we have already read the entire file terminate prefetching
+                if bid >= total_blocks:
+                    break
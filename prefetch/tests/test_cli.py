@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+import os
+
+from .. import stream as stream_mod
+from ..cli import main
+from ..core import PrefetchFileSystem
+from ..checkpoint import Checkpoint
+from .test_rolling_prefetch import BLOCK_SIZE, CACHE_DIR, cleanup
+
+
+def test_warm(tmp_path, monkeypatch, capsys):
+    block_size = BLOCK_SIZE // 4
+    data = [os.urandom(3 * block_size + 10), os.urandom(2 * block_size)]
+    paths = [str(tmp_path / f"warmed{i}.bin") for i in range(len(data))]
+    for path, d in zip(paths, data):
+        with open(path, "wb") as f:
+            f.write(d)
+    checkpoint = str(tmp_path / "warmed.ckpt")
+
+    main(
+        [
+            "warm",
+            str(tmp_path / "warmed*.bin"),
+            "--resume",
+            checkpoint,
+            "--block-size",
+            str(block_size),
+            "--storage",
+            f"{CACHE_DIR}:1",
+        ]
+    )
+    assert "Staged" in capsys.readouterr().out
+
+    staged = Checkpoint.load(checkpoint)
+    assert staged.file_list == paths
+    assert staged.offset == 0
+    assert len(staged.blocks) == 6
+
+    fetched = []
+    read_range = stream_mod._read_range
+
+    def count(fs, path, start, end, *args, **kwargs):
+        fetched.append(start)
+        return read_range(fs, path, start, end, *args, **kwargs)
+
+    monkeypatch.setattr(stream_mod, "_read_range", count)
+    fs = PrefetchFileSystem(default_block_size=block_size)
+
+    with fs.open(
+        paths, "rb", prefetch_storage=[(CACHE_DIR, 1)], resume=checkpoint
+    ) as f:
+        assert f.read() == b"".join(data)
+        # the job starts with all blocks staged
+        assert fetched == []
+
+    cleanup("warmed")
+
+
+def test_cp(tmp_path, capsys):
+    header = os.urandom(100)
+    data = [header + os.urandom(BLOCK_SIZE), header + os.urandom(BLOCK_SIZE // 2)]
+    for i, d in enumerate(data):
+        with open(tmp_path / f"copied{i}.bin", "wb") as f:
+            f.write(d)
+
+    main(
+        [
+            "cp",
+            str(tmp_path / "copied*.bin"),
+            str(tmp_path / "out.bin"),
+            "--block-size",
+            str(BLOCK_SIZE // 4),
+            "--header-bytes",
+            str(len(header)),
+            "--storage",
+            f"{CACHE_DIR}:1",
+        ]
+    )
+    assert "MiB/s" in capsys.readouterr().out
+
+    with open(tmp_path / "out.bin", "rb") as f:
+        assert f.read() == data[0] + data[1][len(header) :]
+
+    # copies to a directory are named after the first file the glob matches
+    (tmp_path / "out").mkdir()
+    main(["cp", str(tmp_path / "copied*.bin"), str(tmp_path / "out")])
+    assert os.listdir(tmp_path / "out") == ["copied0.bin"]
+    with open(tmp_path / "out" / "copied0.bin", "rb") as f:
+        assert f.read() == data[0] + data[1]
+
+    cleanup("copied")
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+import os
+import random
+from time import sleep, monotonic
+
+from s3fs.core import S3FileSystem
+from ..core import S3PrefetchFileSystem
+from ..dask import assign_partitions, worker_status, warm, release, _held
+from .test_rolling_prefetch import (
+    s3_base,
+    s3,
+    create_main_file,
+    create_multi_files,
+    CACHE_DIR,
+    cleanup,
+    CACHES,
+    BLOCK_SIZE,
+)
+
+
+def test_assign_partitions():
+    sizes = {"h": 10, "a": 100, "b": 100, "c": 100, "d": 100}
+    partitions = [["h", "a"], ["h", "b"], ["h", "c"], ["h", "d"]]
+
+    # without any cached data, partitions are spread evenly
+    assignment = assign_partitions(partitions, ["w1", "w2"], sizes)
+    assert sorted(len(q) for q in assignment.values()) == [2, 2]
+    assert sorted(sum(assignment.values(), [])) == [0, 1, 2, 3]
+
+    # partitions go to the worker that has their files cached
+    cached = {"w1": {"c": 100, "d": 100}, "w2": {"a": 100, "b": 100}}
+    assignment = assign_partitions(partitions, ["w1", "w2"], sizes, cached=cached)
+    assert assignment == {"w1": [2, 3], "w2": [0, 1]}
+
+    # unless the worker is already busy prefetching
+    assignment = assign_partitions(
+        partitions, ["w1", "w2"], sizes, cached=cached, load={"w2": 1000}
+    )
+    assert assignment == {"w1": [0, 1, 2, 3], "w2": []}
+
+
+def test_assign_partitions_scale():
+    rng = random.Random(0)
+    files = [f"f{i}" for i in range(2400)]
+    sizes = {p: rng.randint(1, 500) * 2 ** 20 for p in files}
+    partitions = [files[i : i + 4] for i in range(0, len(files), 4)]
+    workers = [f"w{i}" for i in range(32)]
+    cached = {w: {p: sizes[p] for p in rng.sample(files, 100)} for w in workers}
+
+    assignment = assign_partitions(partitions, workers, sizes, cached=cached)
+    assert sorted(sum(assignment.values(), [])) == list(range(len(partitions)))
+
+    # the search converges in fewer steps than there are partitions
+    bounded = assign_partitions(
+        partitions, workers, sizes, cached=cached, max_passes=len(partitions)
+    )
+    assert bounded == assignment
+
+    def finish(assignment):
+        return [
+            sum(
+                sizes[p] * (1 if p in cached[w] else 2)
+                for i in queue
+                for p in partitions[i]
+            )
+            for w, queue in assignment.items()
+        ]
+
+    # the search improves on the initial assignment
+    initial = assign_partitions(partitions, workers, sizes, cached=cached, max_passes=0)
+    assert max(finish(assignment)) < max(finish(initial))
+    assert sum(finish(assignment)) < sum(finish(initial))
+
+
+def test_warm(create_main_file):
+    fs = S3PrefetchFileSystem()
+    s3_path = str(create_main_file)
+
+    with S3FileSystem().open(s3_path, "rb") as f:
+        actual = f.read()
+
+    opts = dict(block_size=BLOCK_SIZE, prefetch_storage=list(CACHES.items()))
+    warm([s3_path], **opts)
+    stream = _held[(s3_path,)][2]
+
+    # prefetching starts before the file is opened
+    assert stream.cache.wait(0)
+    status = worker_status()
+    assert status["cached"][s3_path] >= BLOCK_SIZE
+    assert status["cached"][s3_path] + status["pending"] == len(actual)
+
+    with fs.open(s3_path, "rb", **opts) as f:
+        assert f.stream is stream
+        assert f.read() == actual
+        # the warming holder does not hold back eviction
+        assert all(
+            s in (stream.cache.CONSUMED, stream.cache.EVICTED)
+            for s in stream.cache.state
+        )
+
+    # the stream is kept open until released
+    assert not stream.closed
+    release([s3_path])
+    assert stream.closed
+    assert fs._streams == {}
+    assert worker_status() == {"cached": {}, "pending": 0}
+
+    cleanup(os.path.basename(s3_path))
+
+
+def test_warm_budget(create_multi_files):
+    # the lookahead of a worker prefetches several partitions at once
+    budget = 2 ** 20
+    opts = dict(block_size=BLOCK_SIZE // 2, prefetch_storage=[(CACHE_DIR, 1)])
+    for path in create_multi_files:
+        warm([path], **opts)
+    streams = [_held[(path,)][2] for path in create_multi_files]
+
+    def used():
+        return sum(s.cache.used[0] for s in streams)
+
+    try:
+        # together, the files are twice the size of the tier
+        deadline = monotonic() + 5
+        while used() < budget and monotonic() < deadline:
+            sleep(0.05)
+        sleep(0.5)
+        assert used() <= budget
+        assert used() >= budget - BLOCK_SIZE // 2
+    finally:
+        for path in create_multi_files:
+            release([path])
+        cleanup("random_")
@@ -1,25 +1,50 @@
 #!/usr/bin/env python
 import os
+import sys
+import mmap
+import asyncio
+import subprocess
 import threading
 import pytest
 from threading import Thread
 
 import s3fs
+import fsspec
 from moto import mock_s3
 
-from time import sleep
+from time import sleep, monotonic
 from pathlib import Path
 
 from s3fs.core import S3FileSystem
-from ..core import S3PrefetchFileSystem, S3PrefetchFile
+from ..core import (
+    S3PrefetchFileSystem,
+    S3PrefetchFile,
+    PrefetchFileSystem,
+    PrefetchFile,
+)
+from .. import cache as cache_mod
+from .. import stream as stream_mod
+from .. import calibrate as calibrate_mod
+from ..cache import BlockCache, Tier, block_layout
+from ..stream import PrefetchStream, _stream_range
+from ..trace import AccessTrace
+from ..checkpoint import Checkpoint
+from ..eviction import (
+    EvictionPolicy,
+    KeepLastBlocks,
+    LRUEviction,
+    PinnedRanges,
+    get_policy,
+)
+from ..upload import UploadStream
 
 
 CACHE_DIR = "/dev/shm"
 CACHE_SIZE = 1024 ** 2
 CACHES = {CACHE_DIR: CACHE_SIZE}
-DELETE_STR = ".nibtodelete"
 BUCKET_NAME = "s3trk"
 BLOCK_SIZE = CACHE_SIZE // 4
+HEADER_SIZE = 1000
 
 port = 5555
 endpoint_uri = "http://127.0.0.1:%s/" % port
@@ -93,35 +118,43 @@ def create_multi_files(s3):
     return s3_paths
 
 
+@pytest.fixture
+def create_header_files(s3):
+    # global header followed by parts that each start with their own header
+    header = os.urandom(HEADER_SIZE)
+    s3_paths = [os.path.join(BUCKET_NAME, "header.bin")]
+    data = [header]
+
+    fs = s3fs.S3FileSystem()
+    with fs.open(s3_paths[0], "wb") as f:
+        f.write(header)
+
+    for i in range(3):
+        p = os.path.join(BUCKET_NAME, f"part_{i}.bin")
+        part = os.urandom(BLOCK_SIZE + 1000 * i)
+        with fs.open(p, "wb") as f:
+            f.write(os.urandom(HEADER_SIZE) + part)
+        s3_paths.append(p)
+        data.append(part)
+
+    return s3_paths, b"".join(data)
+
+
 @pytest.fixture
 def create_cached(create_main_file):
 
     s3_path = str(create_main_file)
     fname = os.path.basename(s3_path)
 
-    # take a chunk and save it to tmpfs space
     fs = s3fs.S3FileSystem()
     f = fs.open(s3_path, "rb")
 
     csize = BLOCK_SIZE
-    cfname_0 = os.path.join(CACHE_DIR, f"{fname}.0")
-    cfname_1 = os.path.join(CACHE_DIR, f"{fname}.{csize}")
-
-    with open(cfname_0, "wb") as cf_:
-        cf_.write(f.read(csize))
-
-    with open(cfname_1, "wb") as cf_:
-        cf_.write(f.read(csize))
-
-    f.seek(0, os.SEEK_SET)
-
-    cf_ = open(cfname_0, "rb")
 
     return {
         "f": f,
         "nbytes": csize * 2 + 256,
         "fn_prefix": fname,
-        "cf_": cf_,
         "fidx": (0, csize),
         "s3_path": s3_path,
     }
@@ -129,67 +162,256 @@ def create_cached(create_main_file):
 
 def cleanup(fn_prefix):
     for c in Path(CACHE_DIR).glob(fn_prefix + "*"):
-        c.unlink()
+        try:
+            c.unlink()
+        except FileNotFoundError:
+            # closing streams delete their cache files concurrently
+            pass
 
 
-def _skip_init(cls):
-    init = cls.__init__
-    cls.__init__ = lambda *args, **kwargs: None
-    instance = cls()
-    cls.__init__ = init
-    return instance
+def _block_cache(fname, size=CACHE_SIZE):
+    return BlockCache(
+        f"{os.path.basename(fname)}.test",
+        list(CACHES.keys()),
+        block_layout([size], BLOCK_SIZE),
+    )
+
+
+def _stream(fs, fname, size=CACHE_SIZE):
+    return PrefetchStream(fs, [fname], [size], BLOCK_SIZE, [Tier(CACHE_DIR)])
+
+
+def test_block_layout():
+    # the global header is followed by the data of each file past its header
+    blocks = block_layout([10, 25, 15], 10, header_bytes=5)
+    assert blocks == [
+        (0, 0, 10, 0),
+        (1, 5, 15, 10),
+        (1, 15, 25, 20),
+        (2, 5, 15, 30),
+    ]
+
+    # consecutive adjacent or overlapping ranges are coalesced
+    ranges = [(1, 5, 8), (1, 8, 12), (1, 10, 20), (0, 2, 4), (2, 12, 30)]
+    blocks = block_layout([10, 25, 15], 10, header_bytes=5, ranges=ranges)
+    assert blocks == [
+        (1, 5, 15, 10),
+        (1, 15, 20, 20),
+        (0, 2, 4, 2),
+        (2, 12, 15, 37),
+    ]
+
+    # ranges covered by earlier ones are left out, wherever they are planned
+    ranges = [(1, 5, 20), (2, 5, 10), (1, 10, 15), (1, 0, 25), (2, 8, 12)]
+    deduped = block_layout([10, 25, 15], 100, header_bytes=5, ranges=ranges)
+    assert deduped == [(1, 5, 20, 10), (2, 5, 10, 30), (1, 20, 25, 25), (2, 10, 12, 35)]
+
+    # blocks are found by position even if planned out of order
+    cache = BlockCache("layout.test", [], blocks)
+    assert cache.find(0, 3) == 2
+    assert cache.find(1, 15) == 1
+    assert cache.find(0, 5) is None
+    assert cache.next_start(0, 5) is None
+    assert cache.next_start(1, 2) == 5
 
 
 def test_prefetch(create_main_file):
     fname = create_main_file
 
     fs = S3PrefetchFileSystem()
+    stream = _stream(fs, fname)
+    cache = stream.cache
 
-    s3pf = _skip_init(S3PrefetchFile)
-    s3pf.s3 = fs
-    s3pf.fetch = True
-    s3pf._prefetch([fname], list(CACHES.items()), [CACHE_SIZE], BLOCK_SIZE, fs.req_kw)
+    stream._prefetch()
 
     f_bn = os.path.basename(fname)
 
+    # a single cache file holds all the blocks
     cached_files = Path(CACHE_DIR).glob(f"{f_bn}*")
     cf = list(cached_files)
-    assert len(cf) == 4
+    assert len(cf) == 1
+    assert all(s == BlockCache.READY for s in cache.state)
+    assert cache.used == [CACHE_SIZE]
 
+    with S3FileSystem().open(fname, "rb") as f:
+        assert cache.read(3, 3 * BLOCK_SIZE, BLOCK_SIZE) == f.read()[3 * BLOCK_SIZE :]
 
-def evict_timeout(s):
-    sleep(20)
-    s.fetch = False
+    cache.close()
+    assert len(list(Path(CACHE_DIR).glob(f"{f_bn}*"))) == 0
 
 
-def test_eviction(create_main_file):
-    fname = create_main_file
-    f_bn = os.path.basename(fname)
+def evict_timeout(s):
+    sleep(2)
+    s.fetch = False
 
-    for c in Path(CACHE_DIR).glob(f_bn + "*"):
 
-        if DELETE_STR not in c.name:
-            c.rename(os.path.join(CACHE_DIR, f"{c.name}{DELETE_STR}"))
+def test_eviction():
+    fname = "evicted.bin"
+    stream = _stream(S3PrefetchFileSystem(), f"{BUCKET_NAME}/{fname}")
+    cache = stream.cache
 
-    fs = S3PrefetchFileSystem()
+    for bid in range(len(cache.blocks)):
+        cache.allocate(bid, 0)
+        cache.write(bid, os.urandom(BLOCK_SIZE))
+        cache.complete(bid)
 
-    s3pf = _skip_init(S3PrefetchFile)
-    s3pf.s3 = fs
-    s3pf.fetch = True
-    s3pf.loc = 0
-    s3pf.blocksize = BLOCK_SIZE
+    allocated = os.stat(cache.paths[0]).st_blocks
+    cache.consume(0)
+    cache.consume(1)
 
     # to enable some eviction
-    t = threading.Thread(target=evict_timeout, args=[s3pf])
+    t = threading.Thread(target=evict_timeout, args=[stream])
     t.start()
 
-    s3pf._remove(list(CACHES.items()), [CACHE_SIZE], BLOCK_SIZE, [fname], DELETE_STR)
+    stream.evict_thread.start()
+    sleep(1)
 
-    cached_files = Path(CACHE_DIR).glob(f"{f_bn}*")
+    assert cache.state[:2] == bytes([BlockCache.EVICTED] * 2)
+    assert cache.state[2:] == bytes([BlockCache.READY] * 2)
+    assert cache.used == [2 * BLOCK_SIZE]
+    assert cache.read(0, 0, BLOCK_SIZE) is None
+    # consumed regions are released by punching holes in the cache file
+    assert os.stat(cache.paths[0]).st_blocks < allocated
+
+    stream.evict_thread.join()
+
+    cached_files = Path(CACHE_DIR).glob(f"{fname}*")
     cf = list(cached_files)
     assert len(cf) == 0
 
 
+def test_partial_block():
+    fname = "partial.bin"
+    cache = _block_cache(fname)
+    data = os.urandom(BLOCK_SIZE)
+
+    cache.allocate(0, 0)
+    cache.write(0, data[: BLOCK_SIZE // 2])
+
+    # the first half of the block can be read while the rest is in flight
+    assert cache.wait(0, BLOCK_SIZE // 2, timeout=1)
+    assert cache.read(0, 0, BLOCK_SIZE // 2) == data[: BLOCK_SIZE // 2]
+    assert not cache.wait(0, timeout=0.1)
+    assert cache.read(0, 0, BLOCK_SIZE) is None
+
+    cache.write(0, data[BLOCK_SIZE // 2 :], BLOCK_SIZE // 2)
+    assert cache.wait(0, timeout=1)
+    assert cache.read(0, 0, BLOCK_SIZE) == data
+
+    # a block read entirely can be consumed before it is flagged as complete
+    cache.consume(0)
+    cache.complete(0)
+    assert cache.state[0] == BlockCache.CONSUMED
+
+    cache.close()
+
+
+def test_tier_watermarks(tmp_path):
+    kib = 1024
+    tier = Tier(str(tmp_path), space=1, high_watermark=0.5, low_watermark=0.25)
+
+    assert tier.admit(0, 400 * kib)
+    # the last (short) block is admitted based on its actual size
+    assert tier.admit(400 * kib, 112 * kib)
+    assert not tier.admit(400 * kib, 200 * kib)
+
+    # paused until usage drops back to the low watermark
+    assert not tier.admit(300 * kib, 1)
+    assert tier.admit(256 * kib, 1)
+
+    # unbounded tiers are limited by the filesystem's free space
+    shared = Tier(str(tmp_path))
+    assert shared.capacity(kib) > kib
+    assert not shared.admit(0, shared.capacity(0) + 1)
+
+    with pytest.raises(ValueError):
+        Tier(str(tmp_path), high_watermark=0.5, low_watermark=0.75)
+
+
+def test_memory_pressure(tmp_path, monkeypatch):
+    mib = 1024 ** 2
+    memory = {"available": 10 * mib, "total": 20 * mib, "cached": lambda: 0}
+    monkeypatch.setattr(
+        cache_mod,
+        "memory_available",
+        lambda: (memory["available"] - memory["cached"](), memory["total"]),
+    )
+
+    assert cache_mod.memory_available()[1] == 20 * mib
+    assert not Tier(str(tmp_path)).memory_backed
+
+    # tiers stored in memory keep memory_reserve of the memory free
+    tier = Tier(CACHE_DIR, memory_reserve=0.1)
+    assert tier.memory_backed
+    assert tier.capacity(0) == 8 * mib
+    assert tier.capacity(2 * mib) == 10 * mib
+    assert tier.excess(2 * mib) == 0
+
+    memory["available"] = 0
+    assert tier.excess(4 * mib) == 2 * mib
+
+    # under pressure the blocks prefetched furthest ahead are dropped
+    path = tmp_path / "pressure.bin"
+    data = os.urandom(CACHE_SIZE)
+    path.write_bytes(data)
+
+    memory.update(available=100 * mib, total=4 * BLOCK_SIZE)
+    fs = PrefetchFileSystem(default_block_size=BLOCK_SIZE)
+
+    with fs.open(
+        str(path), "rb", prefetch_storage=list(CACHES.items()), memory_reserve=0.5
+    ) as f:
+        assert f.cache.wait(3, timeout=5)
+
+        # memory held by the cache is no longer available
+        memory.update(available=4 * BLOCK_SIZE, cached=lambda: sum(f.cache.used))
+        f.stream._relieve()
+        f.cache.evict()
+        assert f.cache.state[3] == BlockCache.EVICTED
+        assert f.cache.state[2] == BlockCache.EVICTED
+        assert f.cache.state[1] == BlockCache.READY
+
+        # dropped blocks are read from the source
+        assert f.read() == data
+
+    cleanup("pressure.bin")
+
+
+def test_calibrate(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(calibrate_mod, "_results", {})
+    slow, fast = tmp_path / "slow", tmp_path / "fast"
+    slow.mkdir()
+    fast.mkdir()
+
+    result = calibrate_mod.calibrate(str(slow), nbytes=2 ** 20, block_size=2 ** 18)
+    assert result["write"] > 0 and result["read"] > 0
+    # the temporary file is removed
+    assert os.listdir(slow) == []
+
+    # tiers are only measured once, results persist across processes
+    def measure(path, **kwargs):
+        assert path == str(fast)
+        return {"write": 2.0 * result["write"], "read": 2.0 * result["read"]}
+
+    monkeypatch.setattr(calibrate_mod, "measure", measure)
+    monkeypatch.setattr(calibrate_mod, "_results", {})
+    assert calibrate_mod.calibrate(str(slow)) == result
+
+    tiers = [Tier(str(slow), 0), Tier(str(fast), 0)]
+    assert [t.path for t in calibrate_mod.order_tiers(tiers)] == [str(fast), str(slow)]
+
+    # streams prefetch to the fastest tier first
+    fname = tmp_path / "data.bin"
+    fname.write_bytes(os.urandom(BLOCK_SIZE))
+    fs = PrefetchFileSystem(calibrate=True, default_block_size=BLOCK_SIZE // 4)
+    with fs.open(
+        str(fname), "rb", prefetch_storage=[(str(slow), 0), (str(fast), 0)]
+    ) as f:
+        assert [t.path for t in f.stream.tiers] == [str(fast), str(slow)]
+        assert f.read() == fname.read_bytes()
+
+
 def test_get_block(create_cached):
 
     cc = dict(create_cached)
@@ -201,10 +423,12 @@ def test_get_block(create_cached):
         block_size=BLOCK_SIZE,
         prefetch_storage=list(CACHES.items()),
     ) as f:
-        cf_, offset = f._get_block()
+        bid, offset = f._get_block()
+        available = f.cache.available(bid)
 
     print(cc)
-    assert cf_.name == cc["cf_"].name
+    assert bid == 0
+    assert available
     assert offset == cc["fidx"]
     cleanup(os.path.basename(cc["s3_path"]))
 
@@ -220,12 +444,16 @@ def test_fetch_prefetched(create_cached):
         prefetch_storage=list(CACHES.items()),
     ) as f:
         data = f._fetch_prefetched(0, cc["nbytes"])
+        state = bytes(f.cache.state[:3])
 
     actual = cc["f"].read(cc["nbytes"])
 
     assert len(data) == len(actual) == cc["nbytes"]
     assert data == actual
-    assert os.path.exists(f"{cc['cf_'].name}{DELETE_STR}")
+    # blocks read entirely are flagged for eviction
+    assert state[0] in (BlockCache.CONSUMED, BlockCache.EVICTED)
+    assert state[1] in (BlockCache.CONSUMED, BlockCache.EVICTED)
+    assert state[2] in (BlockCache.EMPTY, BlockCache.READY)
     cleanup(os.path.basename(cc["s3_path"]))
 
 
@@ -240,12 +468,535 @@ def test_read_cached(create_cached):
         prefetch_storage=list(CACHES.items()),
     ) as f:
         data = f.read(cc["nbytes"])
+        f.cache.wait(3)
+        # blocks left behind after a rewind are fetched from S3 again
+        f.cache.evict()
+        f.seek(0)
+        rewind = f.read(cc["nbytes"])
 
-    assert data == cc["f"].read(cc["nbytes"])
-    assert os.path.exists(f"{cc['cf_'].name}{DELETE_STR}")
+    actual = cc["f"].read(cc["nbytes"])
+    assert data == actual
+    assert rewind == actual
     cleanup(os.path.basename(cc["s3_path"]))
 
 
+def test_shared_stream(create_main_file):
+    fs = S3PrefetchFileSystem()
+    s3_path = str(create_main_file)
+
+    with S3FileSystem().open(s3_path, "rb") as f:
+        actual = f.read()
+
+    opts = dict(block_size=BLOCK_SIZE, prefetch_storage=list(CACHES.items()))
+    with fs.open(s3_path, "rb", **opts) as f1, fs.open(s3_path, "rb", **opts) as f2:
+        # a single prefetch stream is shared by both readers
+        assert f1.stream is f2.stream
+
+        assert f1.read() == actual
+        # blocks are retained until the slowest reader has read them
+        assert all(s != BlockCache.CONSUMED for s in f1.cache.state)
+
+        assert f2.read(2 * BLOCK_SIZE) == actual[: 2 * BLOCK_SIZE]
+        assert f2.cache.state[0] in (BlockCache.CONSUMED, BlockCache.EVICTED)
+        assert f2.cache.state[2] not in (BlockCache.CONSUMED, BlockCache.EVICTED)
+
+    assert fs._streams == {}
+    assert f1.stream.closed
+    cleanup(os.path.basename(s3_path))
+
+
+def test_lagging_reader(tmp_path):
+    path = tmp_path / "lagging.bin"
+    actual = os.urandom(4 * CACHE_SIZE)
+    path.write_bytes(actual)
+
+    # the file is four times the size of the tier
+    fs = PrefetchFileSystem()
+    opts = dict(block_size=BLOCK_SIZE // 2, prefetch_storage=[(CACHE_DIR, 1)])
+    with fs.open(str(path), "rb", **opts) as f1, fs.open(str(path), "rb", **opts) as f2:
+        assert f1.stream is f2.stream
+
+        # a reader stalled on the first block doesn't hold back the other
+        assert f2.read(10) == actual[:10]
+        assert f1.read() == actual
+        assert f1.cache.state[0] in (BlockCache.CONSUMED, BlockCache.EVICTED)
+
+        # the lagging reader fetches the released blocks from the source
+        assert f2.read() == actual[10:]
+
+    cleanup("lagging.bin")
+
+
+def test_forward_seek(tmp_path):
+    header = os.urandom(HEADER_SIZE)
+    data = [header + os.urandom(2 * CACHE_SIZE) for _ in range(3)]
+    paths = []
+    for i, d in enumerate(data):
+        paths.append(str(tmp_path / f"skipped{i}.bin"))
+        with open(paths[-1], "wb") as f:
+            f.write(d)
+    actual = data[0] + b"".join(d[HEADER_SIZE:] for d in data[1:])
+
+    # each file is twice the size of the tier
+    fs = PrefetchFileSystem()
+    with fs.open(
+        paths,
+        "rb",
+        block_size=BLOCK_SIZE // 2,
+        header_bytes=HEADER_SIZE,
+        prefetch_storage=[(CACHE_DIR, 1)],
+    ) as f:
+        assert f.read(10) == actual[:10]
+
+        # blocks seeked over don't hold the tier, within and across files
+        for pos in (3 * CACHE_SIZE, 3 * CACHE_SIZE + 10, 5 * CACHE_SIZE + 1):
+            f.seek(pos)
+            assert f.read(BLOCK_SIZE) == actual[pos : pos + BLOCK_SIZE]
+
+        # skipped blocks that were not prefetched are not fetched
+        bid = f.cache.find(0, 2 * CACHE_SIZE - 1)
+        assert f.cache.state[bid] == BlockCache.EVICTED
+        assert f.cache.location[bid] is None
+
+        f.seek(0)
+        assert f.read() == actual
+
+    cleanup("skipped")
+
+
+def test_plan(create_main_file):
+    fs = S3PrefetchFileSystem()
+    s3_path = str(create_main_file)
+
+    with S3FileSystem().open(s3_path, "rb") as f:
+        actual = f.read()
+
+    plan = [(s3_path, 0, 1000), (s3_path, 1000, 5000), (s3_path, 600000, 700000)]
+
+    with fs.open(
+        s3_path,
+        "rb",
+        block_size=BLOCK_SIZE,
+        prefetch_storage=list(CACHES.items()),
+        plan=plan,
+    ) as f:
+        assert f.cache.blocks == [(0, 0, 5000, 0), (0, 600000, 700000, 600000)]
+
+        assert f.read(5000) == actual[:5000]
+        f.seek(600000)
+        assert f.read(100000) == actual[600000:700000]
+
+        # reads outside of the plan are fetched on demand
+        f.seek(300000)
+        assert f.read(10) == actual[300000:300010]
+        f.seek(590000)
+        assert f.read(20000) == actual[590000:610000]
+
+    # overlapping ranges planned apart share a single block
+    plan = [(s3_path, 0, 300000), (s3_path, 600000, 605000), (s3_path, 100000, 200000)]
+    with fs.open(
+        s3_path,
+        "rb",
+        block_size=BLOCK_SIZE,
+        prefetch_storage=list(CACHES.items()),
+        plan=plan,
+    ) as f:
+        cache = f.cache
+        assert all(cache.wait(bid) for bid in range(len(cache.blocks)))
+        assert f.read(300000) == actual[:300000]
+        f.seek(600000)
+        assert f.read(5000) == actual[600000:605000]
+        # evicting the blocks read doesn't punch holes under the re-read region
+        with cache.cond:
+            assert cache.cond.wait_for(lambda: cache.state[0] == cache.EVICTED, 5)
+        f.seek(100000)
+        assert f.read(100000) == actual[100000:200000]
+
+    with pytest.raises(ValueError):
+        with fs.open(s3_path, "rb", plan=[("s3trk/other.bin", 0, 10)]) as f:
+            pass
+
+    cleanup(os.path.basename(s3_path))
+
+
+def test_access_trace(tmp_path):
+    trace = AccessTrace(["a", "b"])
+    trace.record(0, 0, 10)
+    trace.record(0, 10, 20)
+    trace.record(1, 30, 10)
+    trace.record(1, 100, 5)
+    trace.record(1, 105, 0)
+
+    path = str(tmp_path / "trace.json")
+    trace.save(path)
+    loaded = AccessTrace.load(path)
+
+    assert loaded.file_list == ["a", "b"]
+    assert loaded.to_plan() == [("a", 0, 30), ("b", 30, 40), ("b", 100, 105)]
+
+    # re-reads are left out of the plan, in the order ranges were first read
+    trace.record(0, 5, 10)
+    trace.record(1, 35, 20)
+    trace.record(0, 40, 10)
+    assert trace.to_plan() == [
+        ("a", 0, 30),
+        ("b", 30, 40),
+        ("b", 100, 105),
+        ("b", 40, 55),
+        ("a", 40, 50),
+    ]
+
+
+def test_record_replay(create_main_file, tmp_path):
+    fs = S3PrefetchFileSystem()
+    s3_path = str(create_main_file)
+    trace = str(tmp_path / "trace.json")
+
+    with S3FileSystem().open(s3_path, "rb") as f:
+        actual = f.read()
+
+    opts = dict(
+        block_size=BLOCK_SIZE,
+        prefetch_storage=list(CACHES.items()),
+        record=trace,
+        replay=trace,
+    )
+
+    def run():
+        with fs.open(s3_path, "rb", **opts) as f:
+            assert f.read(100) == actual[:100]
+            assert f.read(900) == actual[100:1000]
+            f.seek(600000)
+            assert f.read(5000) == actual[600000:605000]
+            return f.cache.blocks
+
+    # the first run learns the reads, later ones only prefetch what is read
+    assert len(run()) == len(block_layout([CACHE_SIZE], BLOCK_SIZE))
+    assert AccessTrace.load(trace).to_plan() == [
+        (s3_path, 0, 1000),
+        (s3_path, 600000, 605000),
+    ]
+    assert run() == [(0, 0, 1000, 0), (0, 600000, 605000, 600000)]
+
+    # readers that read nothing keep the trace
+    with fs.open(s3_path, "rb", **opts) as f:
+        pass
+    assert len(AccessTrace.load(trace).to_plan()) == 2
+
+    # ranges read again after a seek backwards are prefetched once
+    def seek_back():
+        with fs.open(s3_path, "rb", **opts) as f:
+            assert f.read(300000) == actual[:300000]
+            f.seek(600000)
+            assert f.read(5000) == actual[600000:605000]
+            cache = f.cache
+            with cache.cond:
+                assert cache.cond.wait_for(lambda: cache.state[0] == cache.EVICTED, 5)
+            f.seek(100000)
+            assert f.read(100000) == actual[100000:200000]
+
+    os.remove(trace)
+    seek_back()
+    assert AccessTrace.load(trace).to_plan() == [
+        (s3_path, 0, 300000),
+        (s3_path, 600000, 605000),
+    ]
+    seek_back()
+
+    cleanup(os.path.basename(s3_path))
+
+
+def test_resume(tmp_path, monkeypatch):
+    block_size = BLOCK_SIZE // 4
+    path = tmp_path / "resumed.bin"
+    data = os.urandom(8 * block_size)
+    path.write_bytes(data)
+    checkpoint = str(tmp_path / "resumed.ckpt")
+    opts = dict(prefetch_storage=list(CACHES.items()), resume=checkpoint)
+
+    # a reader crashes after reading two blocks, leaving its cache files
+    crash = f"""
+import os
+from prefetch import PrefetchFileSystem
+fs = PrefetchFileSystem(default_block_size={block_size})
+f = fs.open({str(path)!r}, "rb", **{opts!r})
+assert f.resume_offset == 0
+f.read(1)
+assert f.cache.wait(7)
+f.read(2 * {block_size} - 1)
+os._exit(0)
+"""
+    root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+    subprocess.run([sys.executable, "-c", crash], cwd=root, check=True)
+    assert Checkpoint.load(checkpoint).offset == 2 * block_size
+
+    fetched = []
+    read_range = stream_mod._read_range
+
+    def count(fs, path, start, end, *args, **kwargs):
+        fetched.append(start)
+        return read_range(fs, path, start, end, *args, **kwargs)
+
+    monkeypatch.setattr(stream_mod, "_read_range", count)
+    fs = PrefetchFileSystem(default_block_size=block_size)
+
+    with fs.open(str(path), "rb", **opts) as f:
+        assert f.resume_offset == 2 * block_size
+        f.seek(f.resume_offset)
+        assert f.read() == data[2 * block_size :]
+        # blocks left by the crashed reader are not fetched again
+        assert fetched == []
+
+        # nor are the blocks before the checkpoint prefetched
+        f.seek(0)
+        assert f.read(2 * block_size) == data[: 2 * block_size]
+        assert fetched == []
+
+    # files that changed since are read from scratch
+    os.utime(path, (0, 0))
+    with fs.open(str(path), "rb", **opts) as f:
+        assert f.resume_offset == 0
+        assert f.read() == data
+
+    # once read to the end, a rerun prefetches all blocks again
+    assert not os.path.exists(checkpoint)
+    fetched.clear()
+    with fs.open(str(path), "rb", **opts) as f:
+        assert f.resume_offset == 0
+        assert f.read() == data
+        assert len(fetched) == 8
+
+    cleanup("resumed.bin")
+
+
+def test_pinned_header(create_header_files):
+    fs = S3PrefetchFileSystem()
+    s3_paths, actual = create_header_files
+
+    with fs.open(
+        s3_paths,
+        "rb",
+        header_bytes=HEADER_SIZE,
+        block_size=BLOCK_SIZE,
+        prefetch_storage=list(CACHES.items()),
+    ) as f:
+        # the global header is not part of the rolling blocks
+        assert all(b[0] > 0 for b in f.cache.blocks)
+        assert f.size == len(actual)
+
+        assert f.read(HEADER_SIZE) == actual[:HEADER_SIZE]
+        assert f.read() == actual[HEADER_SIZE:]
+        assert f.tell() == len(actual)
+        assert f.path == s3_paths[-1]
+
+        # seeking back to the header is served from memory
+        f.seek(10)
+        assert f.read(100) == actual[10:110]
+        assert f.path == s3_paths[0]
+
+        # seek and tell are relative to the concatenated stream
+        f.seek(HEADER_SIZE + BLOCK_SIZE + 10)
+        assert f.path == s3_paths[2]
+        assert f.tell() == HEADER_SIZE + BLOCK_SIZE + 10
+        assert f.read(20) == actual[HEADER_SIZE + BLOCK_SIZE + 10 :][:20]
+        f.seek(-5, os.SEEK_END)
+        assert f.read() == actual[-5:]
+
+    cleanup("part_")
+
+
+def test_iter_blocks(create_header_files):
+    fs = S3PrefetchFileSystem()
+    s3_paths, actual = create_header_files
+
+    with fs.open(
+        s3_paths,
+        "rb",
+        header_bytes=HEADER_SIZE,
+        block_size=BLOCK_SIZE,
+        prefetch_storage=list(CACHES.items()),
+    ) as f:
+        f.seek(5)
+        out = []
+        for view in f.iter_blocks():
+            assert view.readonly
+            out.append(bytes(view))
+            if len(out) == 2:
+                # blocks are not evicted while their view is held
+                bid = f.cache.find(1, HEADER_SIZE)
+                assert f.cache.state[bid] == f.cache.CONSUMED
+                f.cache.evict()
+                assert f.cache.state[bid] != f.cache.EVICTED
+                assert bytes(view) == actual[HEADER_SIZE : HEADER_SIZE + BLOCK_SIZE]
+                # views map the block, no copy is made
+                assert isinstance(view.obj, mmap.mmap)
+
+        assert b"".join(out) == actual[5:]
+        # the pinned header, then one view per block
+        assert [len(o) for o in out[:2]] == [HEADER_SIZE - 5, BLOCK_SIZE]
+        assert f.cache.state[bid] in (f.cache.CONSUMED, f.cache.EVICTED)
+        assert f.tell() == len(actual)
+        assert list(f.iter_blocks()) == []
+
+    with fs.open(
+        s3_paths,
+        "rb",
+        header_bytes=HEADER_SIZE,
+        block_size=BLOCK_SIZE,
+        prefetch_storage=list(CACHES.items()),
+    ) as f:
+        # stopping early leaves the position past the last view, both for
+        # the header and for prefetched blocks
+        for pos, mapped in ((5, False), (HEADER_SIZE + 5, True)):
+            f.seek(pos)
+            blocks = f.iter_blocks()
+            view = next(blocks)
+            assert isinstance(view.obj, mmap.mmap) == mapped
+            loc = f.tell()
+            assert loc == pos + len(view)
+            blocks.close()
+            assert f.read(10) == actual[loc : loc + 10]
+
+    cleanup("part_")
+
+
+def test_read_ranges(create_header_files):
+    fs = S3PrefetchFileSystem()
+    s3_paths, actual = create_header_files
+
+    ranges = [
+        (10, 100),
+        (HEADER_SIZE - 10, HEADER_SIZE + 10),
+        (HEADER_SIZE + BLOCK_SIZE - 100, HEADER_SIZE + BLOCK_SIZE + 100),
+        (50, 60),
+        (500, 500),
+        (len(actual) - 10, len(actual) + 10),
+        (HEADER_SIZE + 2 * BLOCK_SIZE, HEADER_SIZE + 3 * BLOCK_SIZE + 1000),
+        (HEADER_SIZE, HEADER_SIZE + BLOCK_SIZE),
+    ]
+
+    with fs.open(
+        s3_paths,
+        "rb",
+        header_bytes=HEADER_SIZE,
+        block_size=BLOCK_SIZE,
+        prefetch_storage=list(CACHES.items()),
+    ) as f:
+        f.seek(100)
+        assert f.cache.wait(1)
+        out = f.read_ranges(ranges)
+        assert out == [actual[start:end] for start, end in ranges]
+        # the file position is unchanged
+        assert f.tell() == 100
+
+        # blocks that were read entirely are released
+        assert f.cache.state[0] in (BlockCache.CONSUMED, BlockCache.EVICTED)
+        assert f.cache.state[1] not in (BlockCache.CONSUMED, BlockCache.EVICTED)
+
+        # released blocks are fetched from the source
+        assert f.read_ranges(ranges[-2:], max_gap=0) == out[-2:]
+
+    cleanup("part_")
+
+
+def test_stream_range(create_main_file):
+    s3_path = str(create_main_file)
+    fs = S3FileSystem()
+    bucket, key, version_id = fs.split_path(s3_path)
+
+    chunks = []
+    nbytes = _stream_range(
+        fs,
+        bucket,
+        key,
+        version_id,
+        100,
+        100 + BLOCK_SIZE,
+        lambda data, pos: chunks.append((pos, data)),
+        chunk_size=BLOCK_SIZE // 8,
+    )
+
+    with fs.open(s3_path, "rb") as f:
+        f.seek(100)
+        actual = f.read(BLOCK_SIZE)
+
+    assert nbytes == BLOCK_SIZE
+    assert len(chunks) >= 8
+    assert all(len(data) <= BLOCK_SIZE // 8 for _, data in chunks)
+
+    # every chunk is handed over along with its position in the range
+    pos = 0
+    for p, data in chunks:
+        assert p == pos
+        pos += len(data)
+    assert b"".join(data for _, data in chunks) == actual
+
+
+def test_protocol(create_main_file):
+    s3_path = str(create_main_file)
+
+    with S3FileSystem().open(s3_path, "rb") as f:
+        actual = f.read()
+
+    fs = fsspec.filesystem("s3prefetch")
+    assert isinstance(fs, S3PrefetchFileSystem)
+    assert fs.unstrip_protocol(s3_path) == f"s3prefetch://{s3_path}"
+
+    with fsspec.open(
+        f"s3prefetch://{s3_path}",
+        "rb",
+        default_block_size=BLOCK_SIZE,
+        prefetch_storage=list(CACHES.items()),
+    ) as f:
+        assert isinstance(f, S3PrefetchFile)
+        assert f.blocksize == BLOCK_SIZE
+        assert f.read() == actual
+
+    assert f.fs._streams == {}
+    cleanup(os.path.basename(s3_path))
+
+
+def test_cat_ranges(create_main_file, monkeypatch):
+    fs = S3PrefetchFileSystem(default_block_size=BLOCK_SIZE)
+    s3_path = str(create_main_file)
+
+    with S3FileSystem().open(s3_path, "rb") as f:
+        actual = f.read()
+
+    requests = []
+    cat_file = S3FileSystem._cat_file
+
+    async def _cat_file(self, path, start=None, end=None, **kwargs):
+        requests.append((start, end))
+        return await cat_file(self, path, start=start, end=end, **kwargs)
+
+    monkeypatch.setattr(S3FileSystem, "_cat_file", _cat_file)
+
+    # whole files are fetched in concurrent blocks
+    assert fs.cat_file(f"s3prefetch://{s3_path}") == actual
+    assert sorted(requests) == [(i, i + BLOCK_SIZE) for i in range(0, CACHE_SIZE, BLOCK_SIZE)]
+
+    requests.clear()
+    assert fs.cat_file(s3_path, start=-100) == actual[-100:]
+    assert requests == [(CACHE_SIZE - 100, CACHE_SIZE)]
+
+    # nearby ranges are coalesced into a single request
+    requests.clear()
+    starts = [1000, 0, 500, 20000, -10]
+    ends = [2000, 100, 1500, 20010, None]
+    out = fs.cat_ranges([s3_path] * 5, starts, ends, max_gap=1000)
+    assert out == [actual[s:e] for s, e in zip(starts, ends)]
+    assert sorted(requests) == [(0, 2000), (20000, 20010), (CACHE_SIZE - 10, CACHE_SIZE)]
+
+    # failed ranges are returned in place
+    out = fs.cat_ranges([s3_path, f"{BUCKET_NAME}/missing.bin"], 0, 10)
+    assert out[0] == actual[:10]
+    assert isinstance(out[1], FileNotFoundError)
+
+    with pytest.raises(FileNotFoundError):
+        fs.cat_ranges([f"{BUCKET_NAME}/missing.bin"], 0, 10, on_error="raise")
+
+
 def test_read_uncached(create_main_file):
     fs = S3PrefetchFileSystem()
     s3_path = str(create_main_file)
@@ -263,6 +1014,251 @@ def test_read_uncached(create_main_file):
     cleanup(os.path.basename(s3_path))
 
 
+def test_sendfile(create_main_file, tmp_path, monkeypatch):
+    fs = S3PrefetchFileSystem()
+    s3_path = str(create_main_file)
+    with S3FileSystem().open(s3_path, "rb") as f:
+        expected = f.read()
+
+    sent = []
+    sendfile = os.sendfile
+
+    def count(out_fd, in_fd, offset, count):
+        sent.append(count)
+        return sendfile(out_fd, in_fd, offset, count)
+
+    monkeypatch.setattr(os, "sendfile", count)
+
+    with fs.open(
+        s3_path, "rb", block_size=BLOCK_SIZE, prefetch_storage=list(CACHES.items())
+    ) as f:
+        head = f.read(10)
+        f.cache.wait(1)
+
+        with open(tmp_path / "out.bin", "wb") as out:
+            assert f.sendfile(out, BLOCK_SIZE) == BLOCK_SIZE
+            # O_APPEND files are written through user space
+            with open(tmp_path / "out.bin", "ab") as append:
+                assert f.sendfile(append) == CACHE_SIZE - BLOCK_SIZE - 10
+                assert f.sendfile(append) == 0
+
+    assert head + (tmp_path / "out.bin").read_bytes() == expected
+    # prefetched blocks are copied by the kernel
+    assert sent
+    cleanup(os.path.basename(s3_path))
+
+
+def test_open_async(create_main_file):
+    fs = S3PrefetchFileSystem()
+    s3_path = str(create_main_file)
+    with S3FileSystem().open(s3_path, "rb") as f:
+        expected = f.read()
+
+    cache = _block_cache("async.bin")
+
+    async def wait_block():
+        # the writer thread wakes up the event loop
+        writer = threading.Timer(0.1, lambda: cache.complete(0))
+        writer.start()
+        assert not await cache.wait_async(0, timeout=0.01)
+        assert await cache.wait_async(0, timeout=5)
+
+    async def read(offset):
+        async with fs.open_async(
+            s3_path, block_size=BLOCK_SIZE, prefetch_storage=list(CACHES.items())
+        ) as f:
+            f.seek(offset)
+            head = await f.read(10)
+            return head + await f.read()
+
+    async def main():
+        await wait_block()
+
+        # a single event loop drives concurrent readers
+        return await asyncio.gather(*[read(i * 1000) for i in range(4)])
+
+    results = asyncio.run(main())
+    assert results == [expected[i * 1000 :] for i in range(4)]
+
+    f = asyncio.run(fs.open_async(s3_path, block_size=BLOCK_SIZE).open())
+    assert f.size == len(expected)
+    asyncio.run(f.close())
+    assert f.closed
+
+    cache.close()
+    cleanup(os.path.basename(s3_path))
+
+
+def test_open_async_loop(tmp_path, monkeypatch):
+    path = tmp_path / "looped.bin"
+    data = os.urandom(4 * BLOCK_SIZE)
+    path.write_bytes(data)
+    checkpoint = str(tmp_path / "looped.ckpt")
+
+    # threads each call is made from
+    threads = {"read": [], "cache": [], "save": []}
+
+    def record(name, fn):
+        def wrapper(*args, **kwargs):
+            threads[name].append(threading.get_ident())
+            return fn(*args, **kwargs)
+
+        return wrapper
+
+    monkeypatch.setattr(PrefetchFile, "read", record("read", PrefetchFile.read))
+    monkeypatch.setattr(BlockCache, "read", record("cache", BlockCache.read))
+    monkeypatch.setattr(Checkpoint, "save", record("save", Checkpoint.save))
+
+    fs = PrefetchFileSystem()
+
+    async def main():
+        async with fs.open_async(
+            str(path),
+            block_size=BLOCK_SIZE,
+            prefetch_storage=list(CACHES.items()),
+            resume=checkpoint,
+        ) as f:
+            # all blocks are prefetched before reading
+            assert await f._run(lambda: f.f.cache.wait(len(f.f.cache.blocks) - 1))
+            return await f.read(10) + await f.read()
+
+    assert asyncio.run(main()) == data
+
+    # prefetched data is read on the loop, the checkpoint is saved off it
+    loop = threading.get_ident()
+    assert loop in threads["cache"]
+    assert loop not in threads["read"]
+    assert threads["save"] and loop not in threads["save"]
+
+    cleanup("looped.bin")
+
+
+def test_close(create_main_file, monkeypatch):
+    fs = S3PrefetchFileSystem()
+    s3_path = str(create_main_file)
+    stalled = threading.Event()
+    inner_stream = stream_mod._inner_stream
+
+    # the transfer of the second block never completes
+    async def stall(fs, bucket, key, version_id, start, end, *args):
+        if start > 0:
+            stalled.set()
+            await asyncio.sleep(60)
+        return await inner_stream(fs, bucket, key, version_id, start, end, *args)
+
+    monkeypatch.setattr(stream_mod, "_inner_stream", stall)
+
+    with fs.open(
+        s3_path, "rb", block_size=BLOCK_SIZE, prefetch_storage=list(CACHES.items())
+    ) as f:
+        assert len(f.read(10)) == 10
+        assert stalled.wait(5)
+        stream = f.stream
+        start = monotonic()
+
+    # the transfer is cancelled and the tiers released before close returns
+    assert monotonic() - start < 2
+    assert not stream.fetch_thread.is_alive()
+    assert not stream.evict_thread.is_alive()
+    assert stream.inflight == set()
+    assert list(Path(CACHE_DIR).glob(os.path.basename(s3_path) + "*")) == []
+
+
+def test_lazy_open(create_main_file, monkeypatch):
+    fs = S3PrefetchFileSystem()
+    s3_path = str(create_main_file)
+    opts = dict(block_size=BLOCK_SIZE, prefetch_storage=list(CACHES.items()))
+
+    with S3FileSystem().open(s3_path, "rb") as f:
+        actual = f.read()
+
+    # files closed without being read never start prefetching
+    with fs.open(s3_path, "rb", **opts) as f:
+        assert f.size == len(actual)
+        assert fs._streams == {}
+    assert f.stream is None
+    assert list(Path(CACHE_DIR).glob(os.path.basename(s3_path) + "*")) == []
+
+    # small reads are served directly while the prefetcher is stalled
+    async def stall(*args):
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(stream_mod, "_inner_stream", stall)
+
+    with fs.open(s3_path, "rb", race_bytes=1000, **opts) as f:
+        assert f.read(100) == actual[:100]
+        assert f.stream is not None
+        assert f.cache.state[0] == BlockCache.EMPTY
+
+    cleanup(os.path.basename(s3_path))
+
+
+def test_eviction_policies():
+    keep = KeepLastBlocks(2)
+    assert [keep.consumed(b, 10, 10 * b, 10 * b + 10) for b in range(3)] == [[], [], [0]]
+    assert keep.reclaim() == [1, 2]
+
+    lru = LRUEviction(25 / 1024 ** 2)
+    assert lru.consumed(0, 10, 0, 10) == [] and lru.consumed(1, 10, 10, 20) == []
+    lru.accessed(0)
+    assert lru.consumed(2, 10, 20, 30) == [1]
+
+    pinned = PinnedRanges([(0, 5)], policy=KeepLastBlocks(0))
+    assert pinned.consumed(0, 10, 0, 10) == []
+    assert pinned.consumed(1, 10, 10, 20) == [1]
+    assert pinned.reclaim() == []
+
+    assert type(get_policy(None)) is EvictionPolicy
+    assert get_policy("keep-last:3").k == 3
+    assert get_policy("lru:1").budget == 2 ** 20
+    with pytest.raises(ValueError):
+        get_policy("keep-last")
+
+
+def test_backward_seek(create_main_file):
+    fs = S3PrefetchFileSystem()
+    s3_path = str(create_main_file)
+    opts = dict(block_size=BLOCK_SIZE, prefetch_storage=list(CACHES.items()))
+
+    with S3FileSystem().open(s3_path, "rb") as f:
+        actual = f.read()
+
+    for eviction, refetched in [(None, True), ("keep-last:1", False)]:
+        with fs.open(s3_path, "rb", eviction=eviction, **opts) as f:
+            assert f.read(2 * BLOCK_SIZE) == actual[: 2 * BLOCK_SIZE]
+
+            cache = f.cache
+            with cache.cond:
+                # the blocks released are evicted by the stream
+                assert cache.cond.wait_for(
+                    lambda: cache.state[0] == cache.EVICTED
+                    and cache.state[1] == (cache.EVICTED if refetched else cache.READY),
+                    5,
+                )
+
+            fetched = []
+            fetch_range = f.stream.fetch_range
+            f.stream.fetch_range = lambda *args: fetched.append(args) or fetch_range(*args)
+
+            # a short rewind into the last block read
+            f.seek(-10, os.SEEK_CUR)
+            assert f.read(10) == actual[2 * BLOCK_SIZE - 10 : 2 * BLOCK_SIZE]
+            assert bool(fetched) == refetched
+
+    # retained blocks are released when the tiers are too full to read on
+    with fs.open(
+        s3_path,
+        "rb",
+        eviction=KeepLastBlocks(4),
+        block_size=BLOCK_SIZE,
+        prefetch_storage=[(CACHE_DIR, 2 * BLOCK_SIZE / 2 ** 20)],
+    ) as f:
+        assert f.read() == actual
+        assert f.eviction.retained and len(f.eviction.retained) < 4
+
+    cleanup(os.path.basename(s3_path))
+
+
 def test_multi_files(create_multi_files):
     fs = S3PrefetchFileSystem()
     s3 = S3FileSystem()
@@ -289,3 +1285,127 @@ def test_multi_files(create_multi_files):
             s3file.close()
 
     cleanup(os.path.basename("random"))
+
+
+def test_local_engine(tmp_path):
+    # the engine runs over any fsspec filesystem, here local files
+    header = os.urandom(HEADER_SIZE)
+    paths = [str(tmp_path / "header.bin")]
+    data = [header]
+    with open(paths[0], "wb") as f:
+        f.write(header)
+
+    for i in range(3):
+        paths.append(str(tmp_path / f"local_{i}.bin"))
+        part = os.urandom(BLOCK_SIZE + 1000 * i)
+        with open(paths[-1], "wb") as f:
+            f.write(os.urandom(HEADER_SIZE) + part)
+        data.append(part)
+    data = b"".join(data)
+
+    fs = PrefetchFileSystem(default_block_size=BLOCK_SIZE // 4)
+
+    with fs.open(
+        paths,
+        "rb",
+        header_bytes=HEADER_SIZE,
+        prefetch_storage=list(CACHES.items()),
+    ) as f:
+        assert isinstance(f, PrefetchFile)
+        assert f.size == len(data)
+        assert f.read(HEADER_SIZE + 10) == data[: HEADER_SIZE + 10]
+        assert f.read() == data[HEADER_SIZE + 10 :]
+
+        # evicted ranges are read from the target filesystem
+        f.seek(BLOCK_SIZE)
+        assert f.read(100) == data[BLOCK_SIZE : BLOCK_SIZE + 100]
+
+    assert fs._streams == {}
+
+    # chained URLs prefetch from the target filesystem
+    with fsspec.open(
+        f"prefetch::file://{paths[1]}",
+        "rb",
+        prefetch={"prefetch_storage": list(CACHES.items())},
+    ) as f:
+        assert f.read() == Path(paths[1]).read_bytes()
+
+    assert sorted(fs.ls(str(tmp_path), detail=False)) == sorted(paths)
+    cleanup("header.bin")
+    cleanup("local_")
+
+
+def test_upload(s3):
+    fs = S3PrefetchFileSystem()
+    part_size = 5 * 2 ** 20
+    data = os.urandom(3 * part_size + 123)
+    s3_path = os.path.join(BUCKET_NAME, "upload.bin")
+
+    # staging is limited to two parts at once
+    with fs.open(
+        s3_path,
+        "wb",
+        block_size=part_size,
+        prefetch_storage=[(CACHE_DIR, 11)],
+        concurrency=2,
+    ) as f:
+        for i in range(0, len(data), 2 ** 20):
+            f.write(data[i : i + 2 ** 20])
+        assert f.uploads is not None
+        assert all(u <= 11 * 2 ** 20 for u in f.uploads.used)
+
+    assert list(Path(CACHE_DIR).glob("upload.bin.*")) == []
+    # uploaded in 4 parts
+    assert S3FileSystem().info(s3_path)["ETag"].strip('"').endswith("-4")
+    assert S3FileSystem().cat_file(s3_path) == data
+
+    # small files are uploaded in a single request
+    with fs.open(os.path.join(BUCKET_NAME, "small.bin"), "wb") as f:
+        f.write(b"small")
+        assert f.uploads is None
+    assert S3FileSystem().cat_file(os.path.join(BUCKET_NAME, "small.bin")) == b"small"
+
+
+def test_upload_stream():
+    class SlowS3:
+        """Stand-in filesystem whose uploads wait for a signal"""
+
+        def __init__(self):
+            self.go = threading.Event()
+            self.bodies = {}
+
+        def call_s3(self, method, *args, **kwargs):
+            self.go.wait()
+            self.bodies[kwargs["PartNumber"]] = kwargs["Body"]
+            if kwargs["PartNumber"] == 4:
+                raise OSError("upload failed")
+            return {"ETag": str(kwargs["PartNumber"])}
+
+    fs = SlowS3()
+    part = os.urandom(400 * 1024)
+    uploads = UploadStream(
+        fs, BUCKET_NAME, "stream.bin", "id", [Tier(CACHE_DIR, space=1)], concurrency=2
+    )
+
+    # two parts fit in the tier, the third waits for an upload to complete
+    uploads.stage(part)
+    uploads.stage(part)
+    staged = Thread(target=uploads.stage, args=(part,))
+    staged.start()
+    staged.join(0.5)
+    assert staged.is_alive()
+
+    fs.go.set()
+    staged.join()
+    assert uploads.finish() == [
+        {"PartNumber": i, "ETag": str(i)} for i in (1, 2, 3)
+    ]
+    assert fs.bodies == {i: part for i in (1, 2, 3)}
+    assert not os.path.exists(uploads.paths[0])
+
+    # failed uploads are raised on the next call
+    uploads = UploadStream(fs, BUCKET_NAME, "stream.bin", "id", [Tier(CACHE_DIR)], first_part=4)
+    uploads.stage(part)
+    with pytest.raises(OSError):
+        uploads.finish()
+
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+import io
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from ..formats import trk
+
+
+N_SCALARS = 2
+N_PROPERTIES = 1
+
+
+def _trk_file(lengths, byteorder="<", nb_streamlines=None):
+    rng = np.random.default_rng(0)
+
+    header = np.zeros((), dtype=trk.header_dtype.newbyteorder(byteorder))
+    header["id_string"] = b"TRACK"
+    header["voxel_sizes"] = 1
+    header["nb_scalars_per_point"] = N_SCALARS
+    header["nb_properties_per_streamline"] = N_PROPERTIES
+    header["nb_streamlines"] = len(lengths) if nb_streamlines is None else nb_streamlines
+    header["version"] = 2
+    header["hdr_size"] = trk.HEADER_SIZE
+
+    records = [header.tobytes()]
+    streamlines = []
+    for n in lengths:
+        data = rng.random((n, 3 + N_SCALARS), dtype=np.float32)
+        props = rng.random(N_PROPERTIES, dtype=np.float32)
+        records.append(np.array(n, dtype=f"{byteorder}i4").tobytes())
+        records.append(data.astype(f"{byteorder}f4").tobytes())
+        records.append(props.astype(f"{byteorder}f4").tobytes())
+        streamlines.append((data, props))
+
+    return b"".join(records), streamlines
+
+
+@pytest.mark.parametrize("byteorder", ["<", ">"])
+def test_load(byteorder):
+    lengths = [5, 1, 30, 7, 0, 12]
+    data, streamlines = _trk_file(lengths, byteorder)
+
+    # small reads so that records straddle batches
+    batch = trk.load(io.BytesIO(data), read_size=64)
+
+    assert list(batch.lengths) == lengths
+    assert list(batch.offsets) == list(np.cumsum([0] + lengths[:-1]))
+    assert batch.points.shape == (sum(lengths), 3)
+    assert batch.scalars.shape == (sum(lengths), N_SCALARS)
+    assert batch.properties.shape == (len(lengths), N_PROPERTIES)
+
+    for i, (points, props) in enumerate(streamlines):
+        o, n = batch.offsets[i], batch.lengths[i]
+        assert np.array_equal(batch.points[o : o + n], points[:, :3])
+        assert np.array_equal(batch.scalars[o : o + n], points[:, 3:])
+        assert np.array_equal(batch.properties[i], props)
+
+
+def test_iter_batches():
+    lengths = list(range(1, 50))
+    data, _ = _trk_file(lengths)
+
+    f = io.BytesIO(data)
+    header = trk.read_header(f)
+    assert header["nb_streamlines"] == len(lengths)
+
+    batches = list(trk.iter_batches(f, header=header, read_size=256))
+    assert len(batches) > 1
+    assert [n for b in batches for n in b.lengths] == lengths
+
+    # the node counts don't require the points to be parsed
+    counts = trk.count_nodes(io.BytesIO(data), read_size=256)
+    assert list(counts) == lengths
+
+
+def test_streamline_count():
+    # only nb_streamlines streamlines are read when the count is known
+    data, _ = _trk_file([3, 4, 5], nb_streamlines=2)
+    assert list(trk.count_nodes(io.BytesIO(data))) == [3, 4]
+
+    # a count of 0 means the file is read to the end
+    data, _ = _trk_file([3, 4, 5], nb_streamlines=0)
+    assert list(trk.count_nodes(io.BytesIO(data))) == [3, 4, 5]
+
+
+def test_invalid():
+    data, _ = _trk_file([3, 4])
+
+    with pytest.raises(ValueError):
+        trk.load(io.BytesIO(b"NOTTRK" + data[6:]))
+
+    with pytest.raises(ValueError):
+        trk.load(io.BytesIO(data[:-8]))
+
+    empty = trk.load(io.BytesIO(_trk_file([])[0]))
+    assert empty.points.shape == (0, 3)
+    assert empty.scalars.shape == (0, N_SCALARS)
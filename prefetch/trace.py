@@ -0,0 +1,82 @@
+import os
+import json
+
+from .cache import _cover
+
+
+class AccessTrace:
+    """Sequence of byte ranges read from a list of files
+
+    Contiguous reads of the same file are coalesced as they are recorded,
+    such that sequential readers issuing many small reads produce a trace of
+    only a few ranges. A trace can be saved and converted into a prefetch
+    plan the next time the same files are opened.
+
+    Parameters
+    ----------
+    file_list : list of str
+        Files the recorded reads refer to
+    """
+
+    version = 1
+
+    def __init__(self, file_list):
+        self.file_list = list(file_list)
+        # [file_idx, offset, length] of each read
+        self.reads = []
+
+    def record(self, file_idx, offset, length):
+        """Append a read of length bytes at offset of file file_idx"""
+        if length <= 0:
+            return
+
+        if self.reads:
+            last = self.reads[-1]
+            if last[0] == file_idx and last[1] + last[2] == offset:
+                last[2] += length
+                return
+        self.reads.append([file_idx, offset, length])
+
+    def to_plan(self):
+        """Convert the trace to a prefetch plan of (path, start, end) tuples
+
+        Ranges are in the order they were first read, re-reads (e.g. after a
+        seek backwards) are left out such that the ranges never overlap.
+        """
+        covered = [[] for _ in self.file_list]
+        plan = []
+        for file_idx, offset, length in self.reads:
+            for start, end in _cover(covered[file_idx], offset, offset + length):
+                path = self.file_list[file_idx]
+                if plan and plan[-1][0] == path and plan[-1][2] == start:
+                    plan[-1] = (path, plan[-1][1], end)
+                else:
+                    plan.append((path, start, end))
+        return plan
+
+    def save(self, path):
+        """Write the trace to path"""
+        tmp_path = f"{path}.tmp"
+
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"version": self.version, "files": self.file_list, "reads": self.reads},
+                f,
+                separators=(",", ":"),
+            )
+
+        # concurrent readers of the trace never see a partial file
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a trace written by save"""
+        with open(path, "r") as f:
+            data = json.load(f)
+
+        if data.get("version") != cls.version:
+            raise ValueError(f"Unsupported trace version {data.get('version')}")
+
+        trace = cls(data["files"])
+        trace.reads = [list(r) for r in data["reads"]]
+        return trace
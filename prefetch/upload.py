@@ -0,0 +1,207 @@
+import os
+import threading
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import _allocate, _punch_hole
+
+
+class UploadStream:
+    """Parts of a multipart upload, staged in storage tiers and uploaded concurrently
+
+    Every tier holds a single staging file parts are appended to. Once a part
+    is uploaded its region of the staging file is released by punching a
+    hole. Staging blocks while no tier can admit the next part, such that the
+    producer never runs more than the tiers' budget ahead of the uploads.
+
+    Parameters
+    ----------
+    fs : S3FileSystem
+        Filesystem to upload to
+    bucket : str
+        Bucket of the object
+    key : str
+        Key of the object
+    upload_id : str
+        Id of the multipart upload
+    tiers : list of Tier
+        Storage tiers to stage parts in
+    concurrency : int
+        Maximum number of parts uploaded at once
+    first_part : int
+        Number of the first part staged
+    s3_additional_kwargs : dict
+        Additional arguments passed to S3 requests
+    """
+
+    def __init__(
+        self,
+        fs,
+        bucket,
+        key,
+        upload_id,
+        tiers,
+        concurrency=4,
+        first_part=1,
+        s3_additional_kwargs=None,
+    ):
+        self.fs = fs
+        self.bucket = bucket
+        self.key = key
+        self.upload_id = upload_id
+        self.tiers = tiers
+        self.s3_additional_kwargs = s3_additional_kwargs or {}
+
+        name = f"{os.path.basename(key)}.{uuid4().hex[:8]}.upload"
+        self.paths = [os.path.join(t.path, name) for t in self.tiers]
+        self.used = [0] * len(self.tiers)
+        self.parts = []
+        self.error = None
+        self.closed = False
+
+        self.next_part = first_part
+        self.cond = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=max(concurrency, 1))
+
+        self._fds = [None] * len(self.tiers)
+        # next free position of each staging file
+        self._ends = [0] * len(self.tiers)
+        self._pending = 0
+
+    def stage(self, data):
+        """Stage data as the next part and upload it in the background
+
+        Raises the error of any failed upload.
+        """
+        nbytes = len(data)
+
+        with self.cond:
+            while True:
+                self._raise()
+
+                tier = next(
+                    (
+                        t
+                        for t in range(len(self.tiers))
+                        if self.tiers[t].admit(self.used[t], nbytes)
+                    ),
+                    None,
+                )
+                # with no upload in flight no space will be freed, the part is
+                # then uploaded from memory
+                if tier is not None or self._pending == 0:
+                    break
+                self.cond.wait(1)
+
+            part = self.next_part
+            self.next_part += 1
+            self._pending += 1
+
+            offset = None
+            if tier is not None:
+                offset = self._ends[tier]
+                self._ends[tier] += nbytes
+                self.used[tier] += nbytes
+
+        if tier is None:
+            self._upload(part, None, None, nbytes, data)
+            return
+
+        try:
+            fd = self._fd(tier)
+            _allocate(fd, offset, nbytes)
+            os.pwrite(fd, data, offset)
+        except Exception:
+            self._release(tier, offset, nbytes)
+            raise
+
+        self.pool.submit(self._upload, part, tier, offset, nbytes, None)
+
+    def finish(self):
+        """Wait for all uploads, returns the uploaded parts in order"""
+        self.pool.shutdown(wait=True)
+
+        with self.cond:
+            error = self.error
+            parts = sorted(self.parts, key=lambda p: p["PartNumber"])
+        self.close()
+
+        if error is not None:
+            raise error
+        return parts
+
+    def close(self):
+        """Stop uploading and delete the staging files"""
+        with self.cond:
+            # parts not yet started are dropped
+            self.closed = True
+        self.pool.shutdown(wait=True)
+
+        with self.cond:
+            self.cond.wait_for(lambda: self._pending == 0)
+
+            for i, fd in enumerate(self._fds):
+                if fd is None:
+                    continue
+                os.close(fd)
+                try:
+                    os.remove(self.paths[i])
+                except FileNotFoundError:
+                    pass
+            self._fds = [None] * len(self.tiers)
+
+    def _raise(self):
+        if self.error is not None:
+            raise self.error
+        if self.closed:
+            raise ValueError("I/O operation on closed upload.")
+
+    def _fd(self, tier):
+        with self.cond:
+            if self._fds[tier] is None:
+                self._fds[tier] = os.open(
+                    self.paths[tier], os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600
+                )
+            return self._fds[tier]
+
+    def _release(self, tier, offset, nbytes):
+        if tier is not None and self._fds[tier] is not None:
+            # space of staging files that can't punch holes is only
+            # reclaimed when they are deleted
+            _punch_hole(self._fds[tier], offset, nbytes)
+
+        with self.cond:
+            if tier is not None:
+                self.used[tier] -= nbytes
+            self._pending -= 1
+            self.cond.notify_all()
+
+    def _upload(self, part, tier, offset, nbytes, data):
+        try:
+            if self.closed:
+                return
+            if data is None:
+                data = os.pread(self._fds[tier], nbytes, offset)
+
+            out = self.fs.call_s3(
+                "upload_part",
+                self.s3_additional_kwargs,
+                Bucket=self.bucket,
+                Key=self.key,
+                PartNumber=part,
+                UploadId=self.upload_id,
+                Body=data,
+            )
+
+            header = {"PartNumber": part, "ETag": out["ETag"]}
+            if "ChecksumSHA256" in out:
+                header["ChecksumSHA256"] = out["ChecksumSHA256"]
+
+            with self.cond:
+                self.parts.append(header)
+        except Exception as e:
+            with self.cond:
+                if self.error is None:
+                    self.error = e
+        finally:
+            self._release(tier, offset, nbytes)
@@ -22,6 +22,14 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     install_requires=["s3fs"],
+    extras_require={"trk": ["numpy"]},
+    entry_points={
+        "fsspec.specs": [
+            "s3prefetch = prefetch.core:S3PrefetchFileSystem",
+            "prefetch = prefetch.core:PrefetchFileSystem",
+        ],
+        "console_scripts": ["rolling-prefetch = prefetch.cli:main"],
+    },
     packages=setuptools.find_packages(),
     python_requires=">=3.7",
 )